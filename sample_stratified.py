@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Stratified sampling of labelled videos with link-based materialization.
+#
+# Generalizes sample_10_per_emotion.py: any number of label CSVs, per-class
+# quotas and seed from the command line, rows grouped in a single pass. With the
+# same seed a class draws the same rows as DataFrame.sample(n, random_state=seed)
+# did. Selected videos are hardlinked (default), symlinked, copied by a worker
+# pool, or only listed in a manifest, instead of shutil.copy2'd one by one.
+#
+# Usage:
+#   python sample_stratified.py --source mer2023-test-labels/test1-label.csv "mer2023test1&2/test1" .avi \
+#       --source mer2023-test-labels/test2-label.csv "mer2023test1&2/test2" .mp4 \
+#       --per_class 1000 --output_dir 1k_per_emotion --combined
+#   python sample_stratified.py --source labels.csv videos .mp4 --per_class 10 --quota neutral=20 --mode symlink
+#   python sample_stratified.py --source data/MELD_test_subset/test_labels_subset.csv data/MELD_test_subset/test_subset .mp4 \
+#       Emotion "dia{Dialogue_ID}_utt{Utterance_ID}" --mode manifest
+
+import os
+import csv
+import shutil
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+MODES = ['hardlink', 'symlink', 'copy', 'manifest']
+
+
+def read_groups(label_file, class_column='discrete'):
+    """Rows of a label CSV grouped by class in one pass, classes in order of first appearance."""
+    groups = {}
+    with open(label_file, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            groups.setdefault(row[class_column], []).append(row)
+        return groups, reader.fieldnames
+
+def stratified_sample(groups, per_class, quotas=None, seed=42):
+    """Up to quota rows of every class; quotas overrides per_class for listed classes.
+
+    Each class gets a fresh RandomState(seed), which is what
+    DataFrame.sample(n, random_state=seed) uses, so picks match the old script.
+    """
+    quotas = quotas or {}
+    selected = []
+    for label, rows in groups.items():
+        n = min(quotas.get(label, per_class), len(rows))
+        if n <= 0:
+            continue
+        picks = np.random.RandomState(seed).choice(len(rows), size=n, replace=False)
+        selected.extend(rows[i] for i in picks)
+    return selected
+
+def video_name(row, name_spec='name'):
+    """Video file name (without extension) of a label row: a column name or a format string over the columns."""
+    return name_spec.format(**row) if '{' in name_spec else row[name_spec]
+
+def scan_videos(video_dir, video_ext):
+    """name -> path of every video in a directory, from a single directory scan."""
+    videos = {}
+    if not os.path.isdir(video_dir):
+        return videos
+    with os.scandir(video_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(video_ext):
+                videos[entry.name[:-len(video_ext)]] = entry.path
+    return videos
+
+
+def _materialize_one(source_path, destination_path, mode):
+    if os.path.lexists(destination_path):
+        os.remove(destination_path)
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(source_path), destination_path)
+        return 'symlink'
+    if mode == 'hardlink':
+        try:
+            os.link(source_path, destination_path)
+            return 'hardlink'
+        except OSError:
+            pass  # Different filesystem or no link support: fall back to a copy
+    shutil.copy2(source_path, destination_path)
+    return 'copy'
+
+def materialize(pairs, mode='hardlink', workers=8):
+    """Create destination files for (source_path, destination_path) pairs. Returns a Counter of methods used.
+
+    Every mode runs on a thread pool: links are cheap, but a hardlink that falls
+    back to a copy (e.g. across filesystems) is as slow as copy mode, and links on
+    network filesystems are round trips too.
+    """
+    used = Counter()
+    if mode == 'manifest':
+        return used
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for method in executor.map(lambda p: _materialize_one(p[0], p[1], mode), pairs):
+            used[method] += 1
+    return used
+
+def write_rows(path, rows, fieldnames):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def parse_quotas(items):
+    quotas = {}
+    for item in items or []:
+        label, _, n = item.rpartition('=')
+        quotas[label] = int(n)
+    return quotas
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stratified sample of labelled videos, materialized with links')
+    parser.add_argument('--source', nargs='+', action='append', required=True,
+                        metavar='LABEL_CSV VIDEO_DIR VIDEO_EXT [CLASS_COLUMN [NAME]]',
+                        help='Label CSV, its video directory and extension, optionally the class column and the '
+                             'video name column or format (e.g. "dia{Dialogue_ID}_utt{Utterance_ID}")')
+    parser.add_argument('--output_dir', type=str, default='10_per_emotion_experiment')
+    parser.add_argument('--class_column', type=str, default='discrete', help='Default class column of sources')
+    parser.add_argument('--name', type=str, default='name', help='Default video name column or format of sources')
+    parser.add_argument('--per_class', type=int, default=10)
+    parser.add_argument('--quota', action='append', help='Per-class override, e.g. --quota neutral=20')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--combined', action='store_true',
+                        help='Also sample over all sources together (written to sample_combined.csv)')
+    parser.add_argument('--mode', type=str, default='hardlink', choices=MODES,
+                        help='hardlink (falls back to copy across filesystems), symlink, copy or manifest only')
+    parser.add_argument('--workers', type=int, default=8, help='Files linked or copied in parallel')
+    args = parser.parse_args()
+
+    quotas = parse_quotas(args.quota)
+    for source in args.source:
+        if not 3 <= len(source) <= 5:
+            parser.error('--source takes LABEL_CSV VIDEO_DIR VIDEO_EXT [CLASS_COLUMN [NAME]]')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    manifest_rows = []
+    all_groups = {}
+    fieldnames_all = []
+    written = set()
+    for source in args.source:
+        label_file, video_dir, video_ext = source[:3]
+        class_column = source[3] if len(source) > 3 else args.class_column
+        name_spec = source[4] if len(source) > 4 else args.name
+        if not os.path.exists(label_file):
+            print(f"Warning: {label_file} does not exist. Skipping.")
+            continue
+        groups, fieldnames = read_groups(label_file, class_column)
+        print(f"\n{label_file}: " + ", ".join(f"{label}: {len(rows)}" for label, rows in groups.items()))
+        for label, rows in groups.items():
+            all_groups.setdefault(label, []).extend(rows)
+        fieldnames_all.extend(f for f in fieldnames if f not in fieldnames_all)
+
+        selected = stratified_sample(groups, args.per_class, quotas, args.seed)
+        name = os.path.splitext(os.path.basename(label_file))[0]
+        if name in written:
+            name = f"{name}_{len(written)}"
+        written.add(name)
+        write_rows(os.path.join(args.output_dir, f"sample_{name}.csv"), selected, fieldnames)
+        print(f"Saved {len(selected)} samples from {label_file}")
+
+        videos = scan_videos(video_dir, video_ext)
+        destination_dir = os.path.join(args.output_dir, f"videos-{video_ext.lstrip('.')}")
+        os.makedirs(destination_dir, exist_ok=True)
+        for row in selected:
+            name = video_name(row, name_spec)
+            source_path = videos.get(name)
+            manifest_rows.append({
+                'name': name,
+                'class': row[class_column],
+                'label_file': label_file,
+                'source_path': source_path or '',
+                'destination_path': os.path.join(destination_dir, name + video_ext) if source_path else '',
+            })
+
+    if args.combined:
+        selected = stratified_sample(all_groups, args.per_class, quotas, args.seed)
+        write_rows(os.path.join(args.output_dir, "sample_combined.csv"), selected, fieldnames_all)
+        print(f"\nSaved {len(selected)} samples across all sources to sample_combined.csv")
+
+    found = [r for r in manifest_rows if r['source_path']]
+    missing = [r for r in manifest_rows if not r['source_path']]
+    write_rows(os.path.join(args.output_dir, "manifest.csv"), manifest_rows,
+               ['name', 'class', 'label_file', 'source_path', 'destination_path'])
+
+    used = materialize([(r['source_path'], r['destination_path']) for r in found], args.mode, args.workers)
+    print(f"\n{len(found)} videos in manifest.csv; " +
+          (", ".join(f"{n} {method}" for method, n in used.items()) or "no files created"))
+    if missing:
+        print(f"Could not find {len(missing)} video files")
+        print("First 10 missing:", [r['name'] for r in missing[:10]])
@@ -1,46 +1,228 @@
+# Token and character statistics of the annotation text fields.
+#
+# Streams any number of annotation files (JSON arrays such as
+# MER_final_annotations_with_*tokens_peak_frame_desc.json, JSONL files, or
+# directories of JSONL shards from annotation_store.py export) and tokenizes
+# every text field in batches across threads. Writes per-file, per-field
+# percentiles and histograms as JSON; --plot_dir additionally saves histogram PNGs.
+#
+# Usage:
+#   python scripts/analyze_number_of_tokens.py data/MER_test_subset/MER_final_annotations_with_*tokens_peak_frame_desc.json \
+#       data/MELD_test_subset/revised_final_annotations.json --output token_stats.json
+#   python scripts/analyze_number_of_tokens.py annotations.jsonl --fields visual_objective_description --tokenizer hf:/models/qwen
+
+import os
+import re
+import sys
 import json
-import tiktoken
-import matplotlib.pyplot as plt
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 # Path to the JSON file
 json_path = 'data/MER_test_subset/MER_final_annotations_with_500tokens_peak_frame_desc.json'
 
-# Load the data
-with open(json_path, 'r') as f:
-    data = json.load(f)
-
-token_counts = []
-char_counts = []
-
-# Use OpenAI's tiktoken for GPT-3.5/4 tokenizer
-encoding = tiktoken.encoding_for_model('gpt-4o')
-
-for obj in data:
-    desc = obj.get('visual_objective_description', '')
-    if desc:
-        tokens = encoding.encode(desc)
-        token_counts.append(len(tokens))
-        char_counts.append(len(desc))
-
-# Plot token distribution
-plt.figure(figsize=(10, 5))
-plt.hist(token_counts, bins=30, alpha=0.7, color='blue', edgecolor='black')
-plt.title('Token Count Distribution for visual_objective_description')
-plt.xlabel('Number of Tokens')
-plt.ylabel('Frequency')
-plt.grid(True)
-plt.show()
-
-# Plot character distribution
-plt.figure(figsize=(10, 5))
-plt.hist(char_counts, bins=30, alpha=0.7, color='green', edgecolor='black')
-plt.title('Character Count Distribution for visual_objective_description')
-plt.xlabel('Number of Characters')
-plt.ylabel('Frequency')
-plt.grid(True)
-plt.show()
-
-# Print averages
-print(f'Average number of tokens: {np.mean(token_counts):.2f}')
-print(f'Average number of characters: {np.mean(char_counts):.2f}')
+PERCENTILES = [50, 90, 95, 99]
+DEFAULT_BINS = 30
+CHUNK_SIZE = 1 << 20
+
+
+# --- Streaming readers ---
+def iter_json_array(path, chunk_size=CHUNK_SIZE):
+    """Objects of a top-level JSON array, decoded one at a time without loading the whole file.
+
+    Decoding moves a read offset through the buffer; the consumed part is only
+    dropped when the next chunk is read, so every record is copied once.
+    """
+    decoder = json.JSONDecoder()
+    # Whitespace and the commas between elements
+    skip = re.compile(r'[\s,]*').match
+    with open(path, 'r') as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f'{path} is not a JSON array')
+        pos = 1
+        eof = False
+        while True:
+            pos = skip(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                obj, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # Object continues in the next chunk
+                more = f.read(chunk_size)
+                eof = not more
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            yield obj
+
+def iter_records(path):
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.jsonl'):
+                yield from iter_records(os.path.join(path, name))
+    elif path.endswith('.jsonl'):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        yield from iter_json_array(path)
+
+def text_fields(record, fields=None):
+    """(field, text) for every string field, or list-of-strings field joined with ', '."""
+    for field, value in record.items():
+        if fields and field not in fields:
+            continue
+        if isinstance(value, list) and value and all(isinstance(v, str) for v in value):
+            value = ', '.join(value)
+        if isinstance(value, str) and field != 'video_id':
+            yield field, value
+
+
+# --- Tokenizers: callables from a list of texts to a list of token counts ---
+def load_tokenizer(spec):
+    """tiktoken:<model or encoding>, hf:<local path or name>, whitespace or chars."""
+    kind, _, name = spec.partition(':')
+    if kind == 'tiktoken':
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(name or 'gpt-4o')
+        except KeyError:
+            encoding = tiktoken.get_encoding(name)
+        # Special-token strings in descriptions are counted as plain text
+        return lambda texts: [len(t) for t in encoding.encode_ordinary_batch(texts, num_threads=1)]
+    if kind == 'hf':
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(name, local_files_only=True, trust_remote_code=True)
+        return lambda texts: [len(ids) for ids in tokenizer(texts, add_special_tokens=False)['input_ids']]
+    if kind == 'whitespace':
+        return lambda texts: [len(t.split()) for t in texts]
+    if kind == 'chars':
+        return lambda texts: [len(t) for t in texts]
+    raise ValueError(f'Unknown tokenizer: {spec}')
+
+
+# --- Statistics ---
+def summarize(values, bins=DEFAULT_BINS):
+    values = np.asarray(values)
+    if len(values) == 0:
+        return {'count': 0}
+    counts, edges = np.histogram(values, bins=bins)
+    summary = {
+        'count': int(len(values)),
+        'sum': int(values.sum()),
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        'min': int(values.min()),
+        'max': int(values.max()),
+    }
+    for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary[f'p{p}'] = float(v)
+    summary['histogram'] = {'counts': counts.tolist(), 'edges': edges.tolist()}
+    return summary
+
+def analyze(paths, tokenize, fields=None, threads=4, batch_size=256, bins=DEFAULT_BINS):
+    """{path: {field: {'tokens': stats, 'characters': stats, 'empty': n}}} over all files."""
+    tokens, chars, empty = {}, {}, {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = []
+
+        def flush(batch):
+            keys = [key for key, _ in batch]
+            pending.append((keys, executor.submit(tokenize, [text for _, text in batch])))
+            # Bound the work in flight so memory stays flat on large inputs
+            while len(pending) > 2 * threads:
+                collect(*pending.pop(0))
+
+        def collect(keys, future):
+            for key, n in zip(keys, future.result()):
+                tokens.setdefault(key, []).append(n)
+
+        batch = []
+        for path in paths:
+            for record in iter_records(path):
+                for field, text in text_fields(record, fields):
+                    key = (path, field)
+                    if not text:
+                        empty[key] = empty.get(key, 0) + 1
+                        continue
+                    chars.setdefault(key, []).append(len(text))
+                    batch.append((key, text))
+                    if len(batch) >= batch_size:
+                        flush(batch)
+                        batch = []
+        if batch:
+            flush(batch)
+        for item in pending:
+            collect(*item)
+
+    report = {}
+    for key in sorted(set(chars) | set(empty)):
+        path, field = key
+        report.setdefault(path, {})[field] = {
+            'tokens': summarize(tokens.get(key, []), bins),
+            'characters': summarize(chars.get(key, []), bins),
+            'empty': empty.get(key, 0),
+        }
+    return report
+
+def save_plots(report, plot_dir):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    os.makedirs(plot_dir, exist_ok=True)
+    for path, fields in report.items():
+        name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+        for field, stats in fields.items():
+            for unit, color in (('tokens', 'blue'), ('characters', 'green')):
+                hist = stats[unit].get('histogram')
+                if not hist:
+                    continue
+                edges = hist['edges']
+                plt.figure(figsize=(10, 5))
+                plt.stairs(hist['counts'], edges, fill=True, alpha=0.7, color=color, edgecolor='black')
+                plt.title(f'{unit.capitalize()} Count Distribution for {field} ({name})')
+                plt.xlabel(f'Number of {unit.capitalize()}')
+                plt.ylabel('Frequency')
+                plt.grid(True)
+                plt.savefig(os.path.join(plot_dir, f'{name}__{field}__{unit}.png'))
+                plt.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Token and character statistics of annotation text fields')
+    parser.add_argument('paths', nargs='*', default=[json_path], help='JSON/JSONL annotation files or JSONL directories')
+    parser.add_argument('--fields', nargs='+', help='Only these fields (default: every text field)')
+    parser.add_argument('--tokenizer', type=str, default='tiktoken:gpt-4o',
+                        help='tiktoken:<model|encoding>, hf:<local tokenizer path>, whitespace or chars')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--batch_size', type=int, default=256, help='Texts per tokenizer call')
+    parser.add_argument('--bins', type=int, default=DEFAULT_BINS)
+    parser.add_argument('--output', type=str, help='Where to write the JSON report (default: stdout)')
+    parser.add_argument('--plot_dir', type=str, help='Optional: save histogram PNGs here')
+    args = parser.parse_args()
+
+    report = analyze(args.paths, load_tokenizer(args.tokenizer), args.fields, args.threads, args.batch_size,
+                     args.bins)
+    report = {'tokenizer': args.tokenizer, 'files': report}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        sys.stdout.write('\n')
+    if args.plot_dir:
+        save_plots(report['files'], args.plot_dir)
+
+    for path, fields in report['files'].items():
+        for field, stats in fields.items():
+            if stats['tokens']['count']:
+                print(f"{path} {field}: {stats['tokens']['mean']:.2f} tokens, "
+                      f"{stats['characters']['mean']:.2f} characters on average", file=sys.stderr)
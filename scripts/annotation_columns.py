@@ -0,0 +1,366 @@
+# Columnar binary export of final annotation files for training data loaders.
+#
+# A final annotation file (MER_final_annotations_*.json, MELD's
+# revised_final_annotations.json, or JSONL) is one big JSON array. Loading it
+# means parsing every record and turning every raw_AU_values_at_peak dict into a
+# tensor again, every epoch. `export` writes the records once as column files in
+# row shards, with a manifest:
+#   au.f32                     raw_AU_values_at_peak as a dense (rows, AUs) float32 matrix, NaN where missing
+#   <field>.f64                numeric fields (peak_time, valence), NaN where missing
+#   <field>.utf8 + .offsets    text fields as concatenated UTF-8 and int64 offsets (rows + 1)
+#   <field>.lists              list fields (visual_expression_description): item offsets per row
+#   fields.u8                  whether each row has each field, and whether it is null
+# AnnotationColumns memory-maps the files. Only the rows that are read get
+# decoded, and the AU matrix is used as is (torch.from_numpy, no copy).
+# `--format parquet` writes one Parquet file with the same columns instead
+# (needs pyarrow; read it with pyarrow.parquet.read_table(path, memory_map=True)).
+#
+# Usage:
+#   python scripts/annotation_columns.py export data/MER_test_subset/MER_final_annotations.json data/MER_test_subset/annotations_columns
+#   python scripts/annotation_columns.py check data/MER_test_subset/MER_final_annotations.json data/MER_test_subset/annotations_columns
+#   python scripts/annotation_columns.py info data/MER_test_subset/annotations_columns
+
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+MANIFEST_FILE = 'manifest.json'
+DEFAULT_ROWS_PER_SHARD = 100000
+AU_FIELD = 'raw_AU_values_at_peak'
+AU_FILE = 'au.f32'
+STATES_FILE = 'fields.u8'
+ABSENT, PRESENT, NULL = 0, 1, 2
+
+
+def read_records(path):
+    """Records of a final annotation .json (one array) or .jsonl file."""
+    with open(path, 'r') as f:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+def _kind(value):
+    if isinstance(value, str):
+        return 'text'
+    if isinstance(value, bool):
+        return 'json'
+    if isinstance(value, (int, float)):
+        return 'float'
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return 'text_list'
+    return 'json'
+
+def infer_schema(records):
+    """(fields in first-seen order with their kind, sorted AU names)."""
+    fields, au_names = {}, set()
+    for record in records:
+        for field, value in record.items():
+            if field == AU_FIELD:
+                au_names.update((value or {}).keys())
+                fields.setdefault(field, 'au')
+            elif value is None:
+                fields.setdefault(field, None)
+            elif fields.get(field) is None:
+                fields[field] = _kind(value)
+            elif fields[field] != _kind(value):
+                # Fields whose values do not agree on a kind are kept as JSON text
+                fields[field] = 'json'
+    return {field: kind or 'json' for field, kind in fields.items()}, sorted(au_names)
+
+
+# --- Writing ---
+def _write_array(path, array):
+    tmp_path = f'{path}.tmp'
+    np.ascontiguousarray(array).tofile(tmp_path)
+    os.replace(tmp_path, path)
+
+def _encode_texts(texts):
+    data = [t.encode('utf-8') for t in texts]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(d) for d in data], out=offsets[1:])
+    return np.frombuffer(b''.join(data), dtype=np.uint8), offsets
+
+def _text_value(value, kind):
+    if value is None:
+        return ''
+    return json.dumps(value, ensure_ascii=False) if kind == 'json' else value
+
+def write_shard(shard_dir, records, fields, au_names):
+    os.makedirs(shard_dir, exist_ok=True)
+    for field, kind in fields.items():
+        values = [record.get(field) for record in records]
+        if kind == 'au':
+            au_index = {name: i for i, name in enumerate(au_names)}
+            matrix = np.full((len(records), len(au_names)), np.nan, dtype=np.float32)
+            for row, au_values in enumerate(values):
+                for name, value in (au_values or {}).items():
+                    matrix[row, au_index[name]] = np.nan if value is None else value
+            _write_array(os.path.join(shard_dir, AU_FILE), matrix)
+        elif kind == 'float':
+            _write_array(os.path.join(shard_dir, f'{field}.f64'),
+                         np.array([np.nan if v is None else v for v in values], dtype=np.float64))
+        elif kind == 'text_list':
+            items = [item for value in values for item in (value or [])]
+            lists = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(value or []) for value in values], out=lists[1:])
+            data, offsets = _encode_texts(items)
+            _write_array(os.path.join(shard_dir, f'{field}.lists'), lists)
+            _write_array(os.path.join(shard_dir, f'{field}.utf8'), data)
+            _write_array(os.path.join(shard_dir, f'{field}.offsets'), offsets)
+        else:
+            data, offsets = _encode_texts([_text_value(v, kind) for v in values])
+            _write_array(os.path.join(shard_dir, f'{field}.utf8'), data)
+            _write_array(os.path.join(shard_dir, f'{field}.offsets'), offsets)
+    # Per row and field: absent, present or null, so records round-trip with the same keys
+    states = np.array([[ABSENT if field not in record else NULL if record[field] is None else PRESENT
+                        for field in fields] for record in records], dtype=np.uint8)
+    _write_array(os.path.join(shard_dir, STATES_FILE), states.reshape(len(records), len(fields)))
+
+def export_columns(records, export_dir, rows_per_shard=DEFAULT_ROWS_PER_SHARD, source=None):
+    """Write records as column shards plus manifest.json. Returns the manifest."""
+    fields, au_names = infer_schema(records)
+    os.makedirs(export_dir, exist_ok=True)
+    shards = []
+    for start in range(0, max(len(records), 1), rows_per_shard):
+        rows = records[start:start + rows_per_shard]
+        name = f'shard_{len(shards):04d}'
+        write_shard(os.path.join(export_dir, name), rows, fields, au_names)
+        shards.append({'name': name, 'rows': len(rows)})
+    manifest = {'rows': len(records), 'fields': fields, 'au_names': au_names, 'shards': shards,
+                'source': source, 'created': time.time()}
+    # The manifest is replaced last, once every shard it lists is complete
+    tmp_path = os.path.join(export_dir, f'{MANIFEST_FILE}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(export_dir, MANIFEST_FILE))
+    return manifest
+
+def export_parquet(records, path):
+    """Same columns as export_columns in one Parquet file, one float32 column per AU."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    fields, au_names = infer_schema(records)
+    columns = {}
+    for field, kind in fields.items():
+        values = [record.get(field) for record in records]
+        if kind == 'au':
+            for name in au_names:
+                columns[name] = pa.array([(v or {}).get(name) for v in values], type=pa.float32())
+        elif kind == 'float':
+            columns[field] = pa.array(values, type=pa.float64())
+        elif kind == 'text_list':
+            columns[field] = pa.array(values, type=pa.list_(pa.string()))
+        else:
+            columns[field] = pa.array([None if v is None else _text_value(v, kind) for v in values], type=pa.string())
+    table = pa.table(columns).replace_schema_metadata({'au_names': json.dumps(au_names),
+                                                       'fields': json.dumps(fields)})
+    pq.write_table(table, path)
+    return len(records)
+
+
+# --- Reading ---
+def _map(path, dtype, shape):
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+class TextColumn:
+    """Lazily decoded text column over all shards: column[i] decodes only row i."""
+
+    def __init__(self, parts, starts):
+        self.parts = parts  # (utf8 bytes, offsets) per shard
+        self.starts = starts
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def locate(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        shard = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return shard, i - int(self.starts[shard])
+
+    def __getitem__(self, i):
+        shard, row = self.locate(i)
+        data, offsets = self.parts[shard]
+        return bytes(data[offsets[row]:offsets[row + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class TextListColumn(TextColumn):
+    """List-of-text column: column[i] is the list of row i."""
+
+    def __init__(self, parts, lists, starts):
+        super().__init__(parts, starts)
+        self.lists = lists
+
+    def __getitem__(self, i):
+        shard, row = self.locate(i)
+        data, offsets = self.parts[shard]
+        first, last = self.lists[shard][row], self.lists[shard][row + 1]
+        return [bytes(data[offsets[j]:offsets[j + 1]]).decode('utf-8') for j in range(first, last)]
+
+
+class AnnotationColumns:
+    """Read-only, memory-mapped view of an export written by export_columns."""
+
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, MANIFEST_FILE), 'r') as f:
+            manifest = json.load(f)
+        self.export_dir = export_dir
+        self.fields = manifest['fields']
+        self.au_names = manifest['au_names']
+        self.shards = manifest['shards']
+        self.starts = np.concatenate([[0], np.cumsum([s['rows'] for s in self.shards])]).astype(np.int64)
+        self._columns = {}
+        self._video_index = None
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def _path(self, shard, name):
+        return os.path.join(self.export_dir, shard['name'], name)
+
+    def _text_parts(self, field, lists=None):
+        """(utf8, offsets) per shard; list columns have one offset per item instead of per row."""
+        parts = []
+        for i, shard in enumerate(self.shards):
+            items = int(lists[i][-1]) if lists is not None else shard['rows']
+            offsets = _map(self._path(shard, f'{field}.offsets'), np.int64, (items + 1,))
+            data = _map(self._path(shard, f'{field}.utf8'), np.uint8, (int(offsets[-1]),))
+            parts.append((data, offsets))
+        return parts
+
+    def shard_au(self, shard_index):
+        """AU matrix of one shard, memory-mapped (no copy)."""
+        shard = self.shards[shard_index]
+        return _map(self._path(shard, AU_FILE), np.float32, (shard['rows'], len(self.au_names)))
+
+    def column(self, field):
+        """AU matrix (field 'au' or raw_AU_values_at_peak), a float64 array, or a lazy text column.
+
+        With one shard numeric columns are the memory-mapped file itself; with
+        several they are concatenated once and cached.
+        """
+        field = AU_FIELD if field == 'au' else field
+        if field in self._columns:
+            return self._columns[field]
+        kind = self.fields[field]
+        if kind == 'au':
+            parts = [self.shard_au(i) for i in range(len(self.shards))]
+        elif kind == 'float':
+            parts = [_map(self._path(s, f'{field}.f64'), np.float64, (s['rows'],)) for s in self.shards]
+        elif kind == 'text_list':
+            lists = [_map(self._path(s, f'{field}.lists'), np.int64, (s['rows'] + 1,)) for s in self.shards]
+            column = self._columns[field] = TextListColumn(self._text_parts(field, lists), lists, self.starts)
+            return column
+        else:
+            column = self._columns[field] = TextColumn(self._text_parts(field), self.starts)
+            return column
+        column = self._columns[field] = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return column
+
+    @property
+    def au(self):
+        """raw_AU_values_at_peak of every row as a (rows, len(au_names)) float32 matrix."""
+        return self.column(AU_FIELD)
+
+    def _states(self):
+        if STATES_FILE not in self._columns:
+            parts = [_map(self._path(s, STATES_FILE), np.uint8, (s['rows'], len(self.fields))) for s in self.shards]
+            self._columns[STATES_FILE] = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return self._columns[STATES_FILE]
+
+    def index(self, video_id):
+        """Row of a video_id."""
+        if self._video_index is None:
+            self._video_index = {video_id: i for i, video_id in enumerate(self.column('video_id'))}
+        return self._video_index[video_id]
+
+    def __getitem__(self, i):
+        """Row i as a record dict with the same fields and values as the source JSON."""
+        record = {}
+        for (field, kind), state in zip(self.fields.items(), self._states()[i]):
+            if state != PRESENT:
+                if state == NULL:
+                    record[field] = None
+                continue
+            value = self.column(field)[i]
+            if kind == 'au':
+                # Shortest repr of the float32 value, e.g. 0.06 rather than 0.05999999865889549
+                record[field] = {name: float(str(v)) for name, v in zip(self.au_names, value) if not np.isnan(v)}
+            elif kind == 'float':
+                record[field] = float(value)
+            elif kind == 'json':
+                record[field] = json.loads(value)
+            else:
+                record[field] = value
+        return record
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def check_roundtrip(records, columns):
+    """Rows whose record does not match the source. AU values are compared at float32 precision."""
+    mismatched = []
+    if len(records) != len(columns):
+        return [f'{len(records)} source records, {len(columns)} rows']
+    for i, record in enumerate(records):
+        expected = dict(record)
+        if isinstance(expected.get(AU_FIELD), dict):
+            expected[AU_FIELD] = {k: float(str(np.float32(v))) for k, v in expected[AU_FIELD].items() if v is not None}
+        if columns[i] != expected:
+            mismatched.append(record.get('video_id', i))
+    return mismatched
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Columnar binary export of final annotations and a memory-mapped loader')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    export = sub.add_parser('export', help='Write column shards (or a Parquet file) from annotation files')
+    export.add_argument('inputs', nargs='+', type=str, help='Final annotation .json/.jsonl files, then the output')
+    export.add_argument('--rows_per_shard', type=int, default=DEFAULT_ROWS_PER_SHARD)
+    export.add_argument('--format', choices=['numpy', 'parquet'], default='numpy')
+
+    check = sub.add_parser('check', help='Compare an export with its source file(s)')
+    check.add_argument('inputs', nargs='+', type=str, help='Final annotation .json/.jsonl files, then the export dir')
+
+    info = sub.add_parser('info', help='Rows, fields and shards of an export')
+    info.add_argument('export_dir', type=str)
+
+    args = parser.parse_args()
+
+    if args.command in ('export', 'check'):
+        if len(args.inputs) < 2:
+            parser.error('give at least one input file and the output')
+        *paths, output = args.inputs
+        records = [record for path in paths for record in read_records(path)]
+
+    if args.command == 'export':
+        start = time.time()
+        if args.format == 'parquet':
+            export_parquet(records, output)
+        else:
+            export_columns(records, output, args.rows_per_shard, source=paths)
+        print(f'Wrote {len(records)} records to {output} in {time.time() - start:.1f}s')
+    elif args.command == 'check':
+        mismatched = check_roundtrip(records, AnnotationColumns(output))
+        print(f'{len(records) - len(mismatched)} of {len(records)} records match'
+              + (f'; first mismatches: {mismatched[:10]}' if mismatched else ''))
+    else:
+        columns = AnnotationColumns(args.export_dir)
+        print(f'{len(columns)} rows in {len(columns.shards)} shards, {len(columns.au_names)} AUs')
+        for field, kind in columns.fields.items():
+            print(f'  {field}: {kind}')
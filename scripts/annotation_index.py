@@ -0,0 +1,409 @@
+# Bitset index over final annotations for fast subset queries.
+#
+# Every sample gets a row; every condition below is a bitset over the rows
+# (packed uint8, one bit per row):
+#   AU04>=moderately   the AU's intensity at the peak reaches that level of
+#                      map_au_intensity. AU04>=barely means the AU shows up in
+#                      visual_expression_description at all (value > 0.1).
+#   discrete=angry     one posting per discrete emotion label
+#   valence=negative   one posting per valence bin (VALENCE_BINS)
+# Levels come from raw_AU_values_at_peak, or from the phrases in
+# visual_expression_description for records without raw values. A query ANDs
+# (and ORs within one field) a few bitsets, so it takes milliseconds even for
+# hundreds of thousands of samples. Updates re-index only the records given,
+# whether from annotation files or from the annotation_store.py change log.
+# MELD's final annotations carry no discrete or valence: pass its label CSV
+# (Dialogue_ID, Utterance_ID, Emotion) with --labels, as well as MER's
+# (name, discrete, valence) where the annotations lack them.
+#
+# Usage:
+#   python scripts/annotation_index.py build data/MER_test_subset/MER_final_annotations.json
+#   python scripts/annotation_index.py update --store data/MER_test_subset/annotations.sqlite
+#   python scripts/annotation_index.py build data/MELD_test_subset/revised_final_annotations.json \
+#       --labels data/MELD_test_subset/test_labels_subset.csv
+#   python scripts/annotation_index.py query --discrete angry --au AU04:moderately
+#   python scripts/annotation_index.py query --discrete neutral --au "Lip Corner Puller" --count
+
+import os
+import sys
+import ast
+import csv
+import json
+import time
+import argparse
+
+import numpy as np
+
+from au_extraction import AU_PHRASES, map_au_intensity
+
+index_dir = 'data/MER_test_subset/annotation_index'
+
+INDEX_FILE = 'index.json'
+BITS_FILE = 'bits.u8'
+VALENCE_FILE = 'valence.f64'
+
+LEVELS = ['barely', 'slightly', 'moderately', 'strongly', 'very strongly']
+PHRASE_THRESHOLD = 0.1  # au_values_at_peak only describes AUs above this
+# (name, lower bound inclusive, upper bound exclusive)
+VALENCE_BINS = [
+    ('very negative', -np.inf, -1.5),
+    ('negative', -1.5, -0.5),
+    ('neutral', -0.5, 0.5),
+    ('positive', 0.5, 1.5),
+    ('very positive', 1.5, np.inf),
+]
+
+_PHRASE_TO_AU = {phrase.lower(): au for au, phrase in AU_PHRASES.items()}
+
+
+def resolve_au(name):
+    """AU code of 'AU04', 'au4' or a phrase such as 'Lip Corner Puller'."""
+    key = name.strip()
+    if key.upper().startswith('AU') and key[2:].isdigit():
+        code = f'AU{int(key[2:]):02d}'
+        if code in AU_PHRASES:
+            return code
+    if key.lower() in _PHRASE_TO_AU:
+        return _PHRASE_TO_AU[key.lower()]
+    raise ValueError(f'Unknown AU {name!r}; use a code or phrase from AU_PHRASES')
+
+def au_levels(record):
+    """{AU: level index in LEVELS} of the AUs described at the peak of one record."""
+    levels = {}
+    values = record.get('raw_AU_values_at_peak')
+    if values:
+        for au, value in values.items():
+            if au in AU_PHRASES and value is not None and value > PHRASE_THRESHOLD:
+                levels[au] = LEVELS.index(map_au_intensity(value))
+        return levels
+    # No raw values: read the level back from phrases like "moderately Lip Corner Puller"
+    phrases = record.get('visual_expression_description') or []
+    if isinstance(phrases, str):
+        # Some exports store the list as its Python repr; skip anything else rather than read characters
+        try:
+            phrases = ast.literal_eval(phrases)
+        except (ValueError, SyntaxError):
+            phrases = []
+        if not isinstance(phrases, list):
+            phrases = []
+    for phrase in phrases:
+        if not isinstance(phrase, str):
+            continue
+        for level in sorted(LEVELS, key=len, reverse=True):
+            if phrase.startswith(level + ' ') and phrase[len(level) + 1:].lower() in _PHRASE_TO_AU:
+                levels[_PHRASE_TO_AU[phrase[len(level) + 1:].lower()]] = LEVELS.index(level)
+                break
+    return levels
+
+def valence_bin(valence):
+    for name, low, high in VALENCE_BINS:
+        if low <= valence < high:
+            return name
+    return None
+
+def label_bitsets(record):
+    """Names of the discrete and valence bitsets one record belongs to."""
+    names = []
+    if record.get('discrete'):
+        names.append(f"discrete={record['discrete']}")
+    valence = record.get('valence')
+    if isinstance(valence, (int, float)) and valence_bin(valence) is not None:
+        names.append(f'valence={valence_bin(valence)}')
+    return names
+
+def record_bitsets(record):
+    """Names of the bitsets one record belongs to."""
+    names = [f'{au}>={LEVELS[level]}' for au, top in au_levels(record).items() for level in range(top + 1)]
+    return names + label_bitsets(record)
+
+def load_labels(csv_path):
+    """video_id -> {'discrete'[, 'valence']} from a MELD or MER label CSV.
+
+    MELD rows (Dialogue_ID, Utterance_ID, Emotion) map to dia{D}_utt{U}.mp4;
+    MER rows (name, discrete, valence) to {name}.mp4.
+    """
+    labels = {}
+    with open(csv_path, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        fields = reader.fieldnames or []
+        if {'Dialogue_ID', 'Utterance_ID', 'Emotion'} <= set(fields):
+            for row in reader:
+                labels[f"dia{row['Dialogue_ID']}_utt{row['Utterance_ID']}.mp4"] = {'discrete': row['Emotion']}
+        elif {'name', 'discrete', 'valence'} <= set(fields):
+            for row in reader:
+                label = {'discrete': row['discrete']}
+                if row['valence'].strip():
+                    label['valence'] = float(row['valence'])
+                labels[row['name'] + '.mp4'] = label
+        else:
+            raise ValueError(f'{csv_path}: expected MELD (Dialogue_ID, Utterance_ID, Emotion) '
+                             f'or MER (name, discrete, valence) columns, got {fields}')
+    return labels
+
+
+class AnnotationIndex:
+    def __init__(self, index_dir=index_dir, fresh=False):
+        """Load the index in index_dir, or start an empty one (also when fresh is set)."""
+        self.index_dir = index_dir
+        self.video_ids = []
+        self.rows = {}
+        self.names = {}  # bitset name -> row of self.bits
+        self.bits = np.zeros((0, 0), dtype=np.uint8)
+        self.valence = np.zeros(0, dtype=np.float64)
+        self.last_seq = 0
+        index_path = os.path.join(index_dir, INDEX_FILE)
+        if os.path.exists(index_path) and not fresh:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            self.video_ids = index['video_ids']
+            self.rows = {video_id: i for i, video_id in enumerate(self.video_ids)}
+            self.names = {name: i for i, name in enumerate(index['names'])}
+            self.last_seq = index['last_seq']
+            nbytes = (len(self.video_ids) + 7) // 8
+            self.bits = np.fromfile(os.path.join(index_dir, BITS_FILE), dtype=np.uint8).reshape(len(self.names),
+                                                                                                 nbytes)
+            self.valence = np.fromfile(os.path.join(index_dir, VALENCE_FILE), dtype=np.float64)
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def __contains__(self, video_id):
+        return video_id in self.rows
+
+    def _ensure_capacity(self, rows):
+        nbytes = (rows + 7) // 8
+        if nbytes > self.bits.shape[1]:
+            # Grow geometrically so appending samples one batch at a time stays cheap
+            grown = np.zeros((self.bits.shape[0], max(nbytes, 2 * self.bits.shape[1])), dtype=np.uint8)
+            grown[:, :self.bits.shape[1]] = self.bits
+            self.bits = grown
+        if rows > len(self.valence):
+            self.valence = np.concatenate([self.valence, np.full(max(rows, 2 * len(self.valence)) - len(self.valence),
+                                                                 np.nan)])
+
+    def _bitset_row(self, name):
+        if name not in self.names:
+            self.names[name] = len(self.names)
+            self.bits = np.vstack([self.bits, np.zeros((1, self.bits.shape[1]), dtype=np.uint8)])
+        return self.names[name]
+
+    def _set_valence(self, row, record):
+        valence = record.get('valence')
+        self.valence[row] = valence if isinstance(valence, (int, float)) else np.nan
+
+    def update(self, records, labels=None):
+        """Add new records and re-index changed ones. Returns (added, updated).
+
+        labels (load_labels) fill in or override each record's discrete and valence.
+        """
+        added = updated = 0
+        for record in records:
+            video_id = record['video_id']
+            if labels and video_id in labels:
+                record = {**record, **labels[video_id]}
+            row = self.rows.get(video_id)
+            if row is None:
+                row = self.rows[video_id] = len(self.video_ids)
+                self.video_ids.append(video_id)
+                self._ensure_capacity(len(self.video_ids))
+                added += 1
+            else:
+                updated += 1
+            byte, bit = row >> 3, np.uint8(0x80 >> (row & 7))  # np.packbits bit order
+            self.bits[:, byte] &= ~bit
+            for name in record_bitsets(record):
+                # New bitsets replace self.bits, so look the row up before indexing it
+                bitset_row = self._bitset_row(name)
+                self.bits[bitset_row, byte] |= bit
+            self._set_valence(row, record)
+        return added, updated
+
+    def relabel(self, labels):
+        """Replace the discrete and valence bitsets of indexed rows from load_labels. Returns rows relabeled."""
+        discrete_rows = [row for name, row in self.names.items() if name.startswith('discrete=')]
+        valence_rows = [row for name, row in self.names.items() if name.startswith('valence=')]
+        relabeled = 0
+        for video_id, label in labels.items():
+            row = self.rows.get(video_id)
+            if row is None:
+                continue
+            byte, bit = row >> 3, np.uint8(0x80 >> (row & 7))
+            # MELD labels carry no valence, so only clear the fields the label replaces
+            self.bits[discrete_rows + (valence_rows if 'valence' in label else []), byte] &= ~bit
+            for name in label_bitsets(label):
+                bitset_row = self._bitset_row(name)
+                self.bits[bitset_row, byte] |= bit
+            if 'valence' in label:
+                self._set_valence(row, label)
+            relabeled += 1
+        return relabeled
+
+    def update_from_store(self, store, labels=None):
+        """Re-index the records changed in an annotation_store.AnnotationStore since the last update."""
+        last_seq = store.last_seq()
+        changed = store.changed_since(self.last_seq)
+        result = self.update((record for record in (store.get(video_id) for video_id in sorted(changed)) if record),
+                             labels)
+        self.last_seq = last_seq
+        return result
+
+    def save(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        nbytes = (len(self.video_ids) + 7) // 8
+        for name, array in ((BITS_FILE, self.bits[:, :nbytes]), (VALENCE_FILE, self.valence[:len(self.video_ids)])):
+            path = os.path.join(self.index_dir, name)
+            np.ascontiguousarray(array).tofile(f'{path}.tmp')
+            os.replace(f'{path}.tmp', path)
+        tmp_path = os.path.join(self.index_dir, f'{INDEX_FILE}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'video_ids': self.video_ids, 'names': sorted(self.names, key=self.names.get),
+                       'last_seq': self.last_seq, 'levels': LEVELS,
+                       'valence_bins': [[name, low, high] for name, low, high in VALENCE_BINS],
+                       'updated': time.time()}, f)
+        os.replace(tmp_path, os.path.join(self.index_dir, INDEX_FILE))
+
+    # --- Queries ---
+    def bitset(self, name):
+        """Packed bits of one bitset; all zeros for a label no record has."""
+        nbytes = (len(self.video_ids) + 7) // 8
+        if name not in self.names:
+            return np.zeros(nbytes, dtype=np.uint8)
+        return self.bits[self.names[name], :nbytes]
+
+    def _all(self):
+        mask = np.zeros((len(self.video_ids) + 7) // 8, dtype=np.uint8)
+        mask[:len(self.video_ids) // 8] = 0xFF
+        if len(self.video_ids) % 8:
+            mask[-1] = (0xFF << (8 - len(self.video_ids) % 8)) & 0xFF
+        return mask
+
+    def mask(self, discrete=None, au=None, not_au=None, valence_bins=None, valence_range=None):
+        """Packed bits of the rows matching every given condition.
+
+        discrete and valence_bins match any of their labels. au maps AU codes
+        or phrases to the lowest level they must reach (None: described at all);
+        every entry must hold. not_au excludes rows where any of those AUs is described.
+        """
+        mask = self._all()
+        if discrete:
+            any_of = np.zeros_like(mask)
+            for label in [discrete] if isinstance(discrete, str) else discrete:
+                any_of |= self.bitset(f'discrete={label}')
+            mask &= any_of
+        if valence_bins:
+            any_of = np.zeros_like(mask)
+            for name in [valence_bins] if isinstance(valence_bins, str) else valence_bins:
+                if name not in {b[0] for b in VALENCE_BINS}:
+                    raise ValueError(f'Unknown valence bin {name!r}')
+                any_of |= self.bitset(f'valence={name}')
+            mask &= any_of
+        for name, level in (au or {}).items():
+            level = level or LEVELS[0]
+            if level not in LEVELS:
+                raise ValueError(f'Unknown level {level!r}; use one of {LEVELS}')
+            mask &= self.bitset(f'{resolve_au(name)}>={level}')
+        for name in not_au or []:
+            mask &= ~self.bitset(f'{resolve_au(name)}>={LEVELS[0]}')
+        if valence_range is not None:
+            low, high = valence_range
+            values = self.valence[:len(self.video_ids)]
+            with np.errstate(invalid='ignore'):
+                in_range = (values >= (-np.inf if low is None else low)) & (values <= (np.inf if high is None else high))
+            mask &= np.packbits(in_range)
+        return mask
+
+    def query(self, **conditions):
+        """video_ids matching mask(**conditions), in the order they were indexed."""
+        rows = np.flatnonzero(np.unpackbits(self.mask(**conditions))[:len(self.video_ids)])
+        return [self.video_ids[i] for i in rows]
+
+    def count(self, **conditions):
+        return int(np.unpackbits(self.mask(**conditions))[:len(self.video_ids)].sum())
+
+
+def parse_au_condition(text):
+    """'AU04:moderately' -> ('AU04', 'moderately'); 'Lip Corner Puller' -> ('Lip Corner Puller', None)."""
+    name, _, level = text.partition(':')
+    return name, level.strip() or None
+
+def read_records(paths):
+    from annotation_columns import read_records as read_file
+    for path in paths:
+        yield from read_file(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='AU bitset and label index over final annotations')
+    parser.add_argument('--index_dir', type=str, default=index_dir)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build = sub.add_parser('build', help='Index annotation files from scratch')
+    build.add_argument('paths', nargs='+', type=str, help='Final annotation .json/.jsonl files')
+    build.add_argument('--labels', type=str,
+                       help='MELD (Dialogue_ID, Utterance_ID, Emotion) or MER (name, discrete, valence) label CSV')
+
+    update = sub.add_parser('update', help='Add or re-index records from files or the annotation store')
+    update.add_argument('paths', nargs='*', type=str)
+    update.add_argument('--store', type=str, help='annotation_store.py SQLite file; applies changes since the last update')
+    update.add_argument('--labels', type=str,
+                        help='Label CSV as for build; also relabels indexed rows not in the files or store changes')
+
+    query = sub.add_parser('query', help='Print the video_ids matching every condition')
+    query.add_argument('--discrete', nargs='+', help='Any of these emotion labels')
+    query.add_argument('--au', action='append', default=[],
+                       help='AU code or phrase, optionally with a minimum level: AU04:moderately, "Lip Corner Puller"')
+    query.add_argument('--not_au', action='append', default=[], help='AU that must not be described')
+    query.add_argument('--valence_bin', nargs='+', choices=[b[0] for b in VALENCE_BINS])
+    query.add_argument('--valence_min', type=float)
+    query.add_argument('--valence_max', type=float)
+    query.add_argument('--count', action='store_true', help='Only print the number of matches')
+
+    sub.add_parser('info', help='Rows and bitset sizes')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = AnnotationIndex(args.index_dir, fresh=True)
+        labels = load_labels(args.labels) if args.labels else None
+        added, _ = index.update(read_records(args.paths), labels)
+        index.save()
+        print(f'Indexed {added} records, {len(index.names)} bitsets in {args.index_dir}')
+        if labels is not None:
+            print(f'{sum(video_id in index for video_id in labels)} of {len(labels)} labels matched a record')
+    elif args.command == 'update':
+        if not args.paths and not args.store and not args.labels:
+            parser.error('give annotation files, --store or --labels')
+        index = AnnotationIndex(args.index_dir)
+        labels = load_labels(args.labels) if args.labels else None
+        if labels:
+            # Rows the files and store changes below leave alone still get the new labels
+            print(f'Relabeled {index.relabel(labels)} indexed records')
+        added, updated = index.update(read_records(args.paths), labels)
+        if args.store:
+            from annotation_store import AnnotationStore
+            store = AnnotationStore(args.store)
+            store_added, store_updated = index.update_from_store(store, labels)
+            store.close()
+            added, updated = added + store_added, updated + store_updated
+        index.save()
+        print(f'Added {added} and re-indexed {updated} records; {len(index)} in the index')
+    elif args.command == 'query':
+        index = AnnotationIndex(args.index_dir)
+        valence_range = None
+        if args.valence_min is not None or args.valence_max is not None:
+            valence_range = (args.valence_min, args.valence_max)
+        start = time.perf_counter()
+        conditions = dict(discrete=args.discrete, au=dict(parse_au_condition(a) for a in args.au),
+                          not_au=args.not_au, valence_bins=args.valence_bin, valence_range=valence_range)
+        if args.count:
+            print(index.count(**conditions))
+        else:
+            for video_id in index.query(**conditions):
+                print(video_id)
+        print(f'{(time.perf_counter() - start) * 1000:.2f} ms', file=sys.stderr)
+    else:
+        index = AnnotationIndex(args.index_dir)
+        print(f'{len(index)} rows, {len(index.names)} bitsets of {(len(index) + 7) // 8} bytes, '
+              f'last store change {index.last_seq}')
+        for name in sorted(index.names):
+            print(f'  {name}: {int(np.unpackbits(index.bitset(name)).sum())}')
@@ -0,0 +1,264 @@
+# Incremental store of final annotation records keyed by video_id.
+#
+# Records live in a SQLite file; every field change is appended to a change log
+# with a sequence number. Exports are sharded JSONL directories (part_XXXX.jsonl,
+# shard chosen by crc32 of the video_id) with a manifest holding the last change
+# applied, so re-exporting after patching a few hundred samples only rewrites the
+# shards those samples fall in. A single JSON/JSONL file can still be written
+# from the store in one streaming pass.
+#
+# Usage:
+#   python scripts/annotation_store.py import data/MER_test_subset/MER_final_annotations.json
+#   python scripts/annotation_store.py patch-dir audio_description data/MER_test_subset/test_subset_gwen_description
+#   python scripts/annotation_store.py labels data/MER_test_subset/test_labels_subset.csv
+#   python scripts/annotation_store.py set sample_00000007.mp4 valence -1.5
+#   python scripts/annotation_store.py export data/MER_test_subset/annotations_export
+#   python scripts/annotation_store.py log --since 120
+
+import os
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import argparse
+
+store_path = 'data/MER_test_subset/annotations.sqlite'
+export_dir = 'data/MER_test_subset/annotations_export'
+
+DEFAULT_SHARDS = 64
+MANIFEST_FILE = 'manifest.json'
+
+
+def shard_of(video_id, num_shards):
+    return zlib.crc32(video_id.encode('utf-8')) % num_shards
+
+
+class AnnotationStore:
+    def __init__(self, path=store_path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS records (
+                    position INTEGER PRIMARY KEY,
+                    video_id TEXT NOT NULL UNIQUE,
+                    crc INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    video_id TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    old TEXT,
+                    new TEXT,
+                    source TEXT,
+                    time REAL NOT NULL
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_changes_video ON changes (video_id)")
+
+    def get(self, video_id):
+        row = self.conn.execute("SELECT data FROM records WHERE video_id = ?", (video_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def last_seq(self):
+        return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def _upsert(self, video_id, fields, source, now, create=True):
+        row = self.conn.execute("SELECT data FROM records WHERE video_id = ?", (video_id,)).fetchone()
+        if row is None and not create:
+            return None
+        record = json.loads(row[0]) if row else {'video_id': video_id}
+        changes = []
+        for field, value in fields.items():
+            if field in record and record[field] == value:
+                continue
+            old = json.dumps(record[field], ensure_ascii=False) if field in record else None
+            changes.append((video_id, field, old, json.dumps(value, ensure_ascii=False), source, now))
+            record[field] = value
+        if row is None:
+            self.conn.execute("INSERT INTO records (video_id, crc, data, version, updated) VALUES (?, ?, ?, 1, ?)",
+                              (video_id, zlib.crc32(video_id.encode('utf-8')),
+                               json.dumps(record, ensure_ascii=False), now))
+        elif changes:
+            self.conn.execute("UPDATE records SET data = ?, version = version + 1, updated = ? WHERE video_id = ?",
+                              (json.dumps(record, ensure_ascii=False), now, video_id))
+        self.conn.executemany("INSERT INTO changes (video_id, field, old, new, source, time) VALUES (?, ?, ?, ?, ?, ?)",
+                              changes)
+        return len(changes)
+
+    def upsert(self, video_id, fields, source=None):
+        """Set fields of one record, creating it if needed. Returns the number of fields that changed."""
+        return self.upsert_many([(video_id, fields)], source)
+
+    def upsert_many(self, items, source=None, create=True, missing=None):
+        """Apply (video_id, fields) pairs in one transaction. Unchanged values are not logged.
+
+        With create=False only existing records are updated; the video_ids that
+        match no record are appended to `missing` (if given) instead of being
+        inserted as stub records.
+        """
+        now = time.time()
+        changed = 0
+        with self.conn:
+            for video_id, fields in items:
+                n = self._upsert(video_id, fields, source, now, create)
+                if n is None:
+                    if missing is not None:
+                        missing.append(video_id)
+                    continue
+                changed += n
+        return changed
+
+    def import_records(self, records, source='import'):
+        return self.upsert_many(((r['video_id'], {k: v for k, v in r.items() if k != 'video_id'}) for r in records),
+                                source)
+
+    def changed_since(self, seq):
+        return {row[0] for row in self.conn.execute("SELECT DISTINCT video_id FROM changes WHERE seq > ?", (seq,))}
+
+    def changes(self, since=0, video_id=None):
+        query = "SELECT seq, video_id, field, old, new, source, time FROM changes WHERE seq > ?"
+        params = [since]
+        if video_id:
+            query += " AND video_id = ?"
+            params.append(video_id)
+        for seq, vid, field, old, new, source, t in self.conn.execute(query + " ORDER BY seq", params):
+            yield {'seq': seq, 'video_id': vid, 'field': field, 'old': json.loads(old) if old is not None else None,
+                   'new': json.loads(new), 'source': source, 'time': t}
+
+    def records(self, shard=None, num_shards=None):
+        """Records in insertion order, optionally only one export shard."""
+        if shard is None:
+            cursor = self.conn.execute("SELECT data FROM records ORDER BY position")
+        else:
+            cursor = self.conn.execute("SELECT data FROM records WHERE crc % ? = ? ORDER BY position",
+                                       (num_shards, shard))
+        for (data,) in cursor:
+            yield json.loads(data)
+
+    def close(self):
+        self.conn.close()
+
+
+def export_shards(store, export_dir, num_shards=DEFAULT_SHARDS, full=False):
+    """Bring a sharded JSONL export up to date, rewriting only shards with changed records.
+
+    Returns the list of shard numbers written.
+    """
+    from combine_all_results import write_records
+
+    os.makedirs(export_dir, exist_ok=True)
+    manifest_path = os.path.join(export_dir, MANIFEST_FILE)
+    manifest = None
+    if os.path.exists(manifest_path) and not full:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['num_shards'] != num_shards:
+            manifest = None
+
+    last_seq = store.last_seq()
+    if manifest is None:
+        shards = list(range(num_shards))
+        counts = {}
+    else:
+        changed = store.changed_since(manifest['last_seq'])
+        shards = sorted({shard_of(video_id, num_shards) for video_id in changed})
+        counts = manifest['counts']
+
+    for shard in shards:
+        path = os.path.join(export_dir, f'part_{shard:04d}.jsonl')
+        counts[str(shard)] = write_records(store.records(shard, num_shards), path, 'jsonl')
+
+    manifest = {'num_shards': num_shards, 'last_seq': last_seq, 'counts': counts,
+                'records': sum(counts.values()), 'updated': time.time()}
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return shards
+
+
+def labels_from_csv(csv_path):
+    from combine_all_results import load_labels
+    return list(load_labels(csv_path).items())
+
+def fields_from_dir(field, directory):
+    """(video_id, {field: text}) for every description/caption file in a stage output directory."""
+    from combine_all_results import index_dir, read_text, read_description
+    items = []
+    for suffix, read in (('.txt', read_text), ('.csv', read_description)):
+        for sample_id, path in index_dir(directory, suffix).items():
+            items.append((f'{sample_id}.mp4', {field: read(path)}))
+    return items
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incremental annotation store with change log and sharded export')
+    parser.add_argument('--store', type=str, default=store_path)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    imp = sub.add_parser('import', help='Upsert records from a final annotations JSON or JSONL file')
+    imp.add_argument('path', type=str)
+
+    patch = sub.add_parser('patch-dir', help='Upsert one field from a directory of stage outputs (.txt or .csv)')
+    patch.add_argument('field', type=str, help='e.g. audio_description, caption, visual_objective_description')
+    patch.add_argument('directory', type=str)
+
+    labels = sub.add_parser('labels', help='Upsert discrete and valence from a label CSV')
+    labels.add_argument('csv_path', type=str)
+
+    set_field = sub.add_parser('set', help='Set one field of one record')
+    set_field.add_argument('video_id', type=str)
+    set_field.add_argument('field', type=str)
+    set_field.add_argument('value', type=str, help='JSON value; plain text is stored as a string')
+
+    export = sub.add_parser('export', help='Update the sharded JSONL export, or write one .json/.jsonl file')
+    export.add_argument('path', type=str, nargs='?', default=export_dir)
+    export.add_argument('--num_shards', type=int, default=DEFAULT_SHARDS)
+    export.add_argument('--full', action='store_true', help='Rewrite every shard')
+
+    log = sub.add_parser('log', help='Print the change log as JSONL')
+    log.add_argument('--since', type=int, default=0)
+    log.add_argument('--video_id', type=str)
+
+    args = parser.parse_args()
+    store = AnnotationStore(args.store)
+
+    if args.command == 'import':
+        with open(args.path, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()] if args.path.endswith('.jsonl') else json.load(f)
+        print(f'{store.import_records(records, source=args.path)} fields changed')
+    elif args.command in ('patch-dir', 'labels'):
+        # Like add_discrete_and_valence_to_annotations, these only fill in records that already exist
+        if args.command == 'patch-dir':
+            items, source = fields_from_dir(args.field, args.directory), args.directory
+        else:
+            items, source = labels_from_csv(args.csv_path), args.csv_path
+        missing = []
+        print(f'{store.upsert_many(items, source=source, create=False, missing=missing)} fields changed')
+        if missing:
+            print(f'{len(missing)} ids match no record and were skipped: {", ".join(missing[:20])}'
+                  + (' ...' if len(missing) > 20 else ''))
+    elif args.command == 'set':
+        try:
+            value = json.loads(args.value)
+        except json.JSONDecodeError:
+            value = args.value
+        print(f'{store.upsert(args.video_id, {args.field: value}, source="cli")} fields changed')
+    elif args.command == 'export':
+        if args.path.endswith('.json') or args.path.endswith('.jsonl'):
+            from combine_all_results import write_records
+            count = write_records(store.records(), args.path, 'jsonl' if args.path.endswith('.jsonl') else 'json')
+            print(f'Wrote {count} records to {args.path}')
+        else:
+            shards = export_shards(store, args.path, args.num_shards, args.full)
+            print(f'Rewrote {len(shards)} of {args.num_shards} shards in {args.path}')
+    else:
+        for change in store.changes(args.since, args.video_id):
+            sys.stdout.write(json.dumps(change, ensure_ascii=False) + '\n')
+    store.close()
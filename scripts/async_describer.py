@@ -0,0 +1,305 @@
+# Concurrent GPT-4o peak frame descriptions.
+#
+# Same output as peak_frame_description.py (one CSV per video in
+# openai_test_subset_peak_frame_description/), but requests run concurrently
+# under a cap on in-flight calls and requests/tokens-per-minute budgets, with
+# exponential backoff on 429 and 5xx responses. Videos that already have an
+# output CSV are skipped, so an interrupted run can simply be restarted.
+#
+# Usage:
+#   python scripts/async_describer.py --concurrency 16 --rpm 500 --tpm 300000
+#   python scripts/async_describer.py --base_url http://127.0.0.1:8000/v1   # local mock server
+
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import openai
+from dotenv import load_dotenv
+
+import telemetry
+from prompts import VISION_PROMPT
+
+video_dir = "./data/MER_test_subset/test_subset"
+csv_dir = "./data/MER_test_subset/test_subset_au"
+out_dir = "./data/MER_test_subset/openai_test_subset_peak_frame_description"
+frames_dir = "./data/MER_test_subset/test_subset_frames"
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError,
+                    openai.APITimeoutError)
+
+
+class RateLimiter:
+    """Token buckets for requests-per-minute and tokens-per-minute budgets."""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm or 0)
+        self.tokens = float(tpm or 0)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens):
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        # Holding the lock while waiting keeps requests in FIFO order
+        async with self.lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.rpm and self.requests < 1:
+                    wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+                if self.tpm and self.tokens < tokens:
+                    wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    if self.rpm:
+                        self.requests -= 1
+                    if self.tpm:
+                        self.tokens -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+    def refund(self, tokens):
+        """Give back budget that was reserved but not used (e.g. a short completion)."""
+        if self.tpm and tokens > 0:
+            self.tokens = min(self.tpm, self.tokens + tokens)
+
+
+def retry_delay(error, attempt, base_delay=1.0, max_delay=60.0):
+    """Exponential backoff with jitter, honouring a Retry-After header when the API sends one."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        try:
+            if retry_after is not None:
+                return min(max_delay, float(retry_after))
+        except ValueError:
+            pass
+    return min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+async def describe_sample(client, limiter, semaphore, job, args, failures):
+    from vision_io import load_frame, build_vision_messages, write_description
+    from au_extraction import find_peak_frame
+    from image_payload import encode_frame, DEFAULT_PAYLOAD
+    from response_cache import content_hash, dhash, params_key
+    from budget_variants import write_variants
+
+    sample_id, video_path, csv_path, out_path = job
+    async with semaphore:
+        try:
+            # Frame decoding and PNG encoding are blocking; keep them off the event loop
+            frame_index, _ = await asyncio.to_thread(find_peak_frame, csv_path)
+            image = await asyncio.to_thread(load_frame, video_path, frame_index, args.frames_dir)
+            encoded = await asyncio.to_thread(encode_frame, image, args.payload, csv_path, frame_index)
+        except Exception as e:
+            failures.append({"sample_id": sample_id, "stage": "frame", "error": str(e), "attempts": 0})
+            print(f"Error processing {sample_id}: {e}")
+            return False
+
+        cache_key = content_key = image_hash = None
+        if args.cache is not None:
+            try:
+                content_key = await asyncio.to_thread(content_hash, image)
+                image_hash = await asyncio.to_thread(dhash, image)
+                cache_key = params_key(args.model, args.prompt, args.max_tokens,
+                                       {**DEFAULT_PAYLOAD, **args.payload})
+                cached = await asyncio.to_thread(args.cache.get, content_key, image_hash, cache_key,
+                                                 args.cache_max_distance, sample_id)
+                if cached is not None:
+                    write_description(out_path, frame_index, cached)
+                    if args.budgets:
+                        write_variants(os.path.dirname(out_path), sample_id, frame_index, cached, args.budgets,
+                                       args.encoding)
+                    print(f"Saved: {out_path} (cached)")
+                    return True
+            except Exception as e:
+                failures.append({"sample_id": sample_id, "stage": "cache", "error": f"{e.__class__.__name__}: {e}",
+                                 "attempts": 0})
+                print(f"Error processing {sample_id}: {e}")
+                return False
+
+        messages = build_vision_messages(encoded["url"], args.prompt, encoded["detail"])
+        # Only used to pace requests against the tokens-per-minute budget
+        estimate = len(args.prompt) // 4 + encoded["image_tokens"] + args.max_tokens
+        with telemetry.span("gpt4o", sample_id) as span:
+            for attempt in range(args.max_retries + 1):
+                span["attempts"] = attempt + 1
+                if attempt:
+                    # The failed attempt's reservation was not spent on a completion
+                    limiter.refund(estimate)
+                await limiter.acquire(estimate)
+                try:
+                    response = await client.chat.completions.create(
+                        model=args.model,
+                        messages=messages,
+                        max_tokens=args.max_tokens,
+                    )
+                except RETRYABLE_ERRORS as e:
+                    if attempt == args.max_retries:
+                        failures.append({"sample_id": sample_id, "stage": "request", "error": str(e),
+                                         "status_code": getattr(e, "status_code", None), "attempts": attempt + 1})
+                        print(f"Giving up on {sample_id} after {attempt + 1} attempts: {e}")
+                        span["error"] = f"{e.__class__.__name__}: {e}"
+                        return False
+                    delay = retry_delay(e, attempt, args.base_delay, args.max_delay)
+                    print(f"Retrying {sample_id} in {delay:.1f}s ({e.__class__.__name__})")
+                    await asyncio.sleep(delay)
+                    continue
+                except openai.APIError as e:
+                    # Other 4xx errors will not succeed on retry
+                    failures.append({"sample_id": sample_id, "stage": "request", "error": str(e),
+                                     "status_code": getattr(e, "status_code", None), "attempts": attempt + 1})
+                    print(f"Error processing {sample_id}: {e}")
+                    span["error"] = f"{e.__class__.__name__}: {e}"
+                    return False
+
+                telemetry.record_usage(response.model or args.model, response.usage)
+                break
+        if response.usage is not None:
+            limiter.refund(estimate - response.usage.total_tokens)
+        try:
+            choice = response.choices[0]
+            text = choice.message.content
+            if text is None:
+                # e.g. finish_reason "content_filter": nothing to write or cache
+                raise ValueError(f"Empty response (finish_reason {choice.finish_reason!r})")
+            if args.cache is not None:
+                await asyncio.to_thread(args.cache.put, content_key, image_hash, cache_key, text, sample_id)
+            write_description(out_path, frame_index, text)
+            if args.budgets:
+                write_variants(os.path.dirname(out_path), sample_id, frame_index, text, args.budgets, args.encoding)
+        except Exception as e:
+            failures.append({"sample_id": sample_id, "stage": "response", "error": f"{e.__class__.__name__}: {e}",
+                             "attempts": attempt + 1})
+            print(f"Error processing {sample_id}: {e}")
+            return False
+        print(f"Saved: {out_path} ({encoded['bytes']} bytes, ~{encoded['image_tokens']} image tokens)")
+        return True
+
+
+async def describe_all(jobs, args):
+    """Describe every job concurrently. Returns (succeeded, failures)."""
+    client = openai.AsyncOpenAI(base_url=args.base_url, max_retries=0, timeout=args.request_timeout)
+    limiter = RateLimiter(args.rpm, args.tpm)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    failures = []
+    try:
+        results = await asyncio.gather(*(describe_sample(client, limiter, semaphore, job, args, failures)
+                                         for job in jobs), return_exceptions=True)
+    finally:
+        await client.close()
+    # Anything describe_sample did not handle itself must not take the other samples (or the report) down
+    for job, result in zip(jobs, results):
+        if isinstance(result, BaseException):
+            failures.append({"sample_id": job[0], "stage": "unexpected",
+                             "error": f"{result.__class__.__name__}: {result}", "attempts": None})
+            print(f"Error processing {job[0]}: {result}")
+    return sum(result is True for result in results), failures
+
+
+def list_jobs(video_dir, csv_dir, out_dir, overwrite=False):
+    jobs = []
+    for video_file in sorted(os.listdir(video_dir)):
+        if not video_file.endswith('.mp4'):
+            continue
+        sample_id = os.path.splitext(video_file)[0]
+        csv_path = os.path.join(csv_dir, sample_id + ".csv")
+        out_path = os.path.join(out_dir, sample_id + ".csv")
+        if not os.path.exists(csv_path):
+            print(f"CSV not found for {video_file}, skipping.")
+            continue
+        if os.path.exists(out_path) and not overwrite:
+            continue
+        jobs.append((sample_id, os.path.join(video_dir, video_file), csv_path, out_path))
+    return jobs
+
+
+if __name__ == "__main__":
+    load_dotenv()  # Load environment variables from .env file
+
+    parser = argparse.ArgumentParser(description="Describe AU peak frames with concurrent, rate-limited GPT-4o calls")
+    parser.add_argument("--video_dir", type=str, default=video_dir)
+    parser.add_argument("--csv_dir", type=str, default=csv_dir)
+    parser.add_argument("--out_dir", type=str, default=out_dir)
+    parser.add_argument("--frames_dir", type=str, default=frames_dir)
+    parser.add_argument("--model", type=str, default="gpt-4o")
+    parser.add_argument("--max_tokens", type=int, default=500)
+    parser.add_argument("--budgets", nargs="+", type=int,
+                        help="Optional: also write variants cut to these token budgets to <out_dir>_<budget>tokens; "
+                             "the request uses the largest budget as max_tokens")
+    parser.add_argument("--prompt_file", type=str, help="Optional: text file overriding the default prompt")
+    parser.add_argument("--image_format", type=str, default="png", choices=["png", "jpeg", "webp"])
+    parser.add_argument("--quality", type=int, help="JPEG/WebP quality")
+    parser.add_argument("--max_side", type=int, help="Optional: downscale so the longer side is at most this")
+    parser.add_argument("--crop_face", action="store_true",
+                        help="Crop to the OpenFace face region (needs CSVs from au_extraction.py --landmarks)")
+    parser.add_argument("--detail", type=str, default="auto", choices=["auto", "low", "high"])
+    parser.add_argument("--cache", type=str, dest="cache_path",
+                        help="Optional: SQLite response cache, e.g. data/MER_test_subset/response_cache.sqlite")
+    parser.add_argument("--cache_read_only", action="store_true", help="Use cached responses but never add new ones")
+    parser.add_argument("--cache_max_distance", type=int, default=0,
+                        help="Opt-in: also reuse cached frames of the same sample whose perceptual hash "
+                             "differs in up to this many bits (0: identical frames only)")
+    parser.add_argument("--cache_max_mb", type=float, default=512)
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of requests in flight")
+    parser.add_argument("--rpm", type=int, help="Optional: requests-per-minute budget")
+    parser.add_argument("--tpm", type=int, help="Optional: tokens-per-minute budget")
+    parser.add_argument("--max_retries", type=int, default=5)
+    parser.add_argument("--base_delay", type=float, default=1.0, help="First backoff delay in seconds")
+    parser.add_argument("--max_delay", type=float, default=60.0, help="Longest backoff delay in seconds")
+    parser.add_argument("--request_timeout", type=float, default=120.0)
+    parser.add_argument("--base_url", type=str, help="Optional: API base URL, e.g. a local mock server")
+    parser.add_argument("--failure_report", type=str, help="Where to write failures (default: <out_dir>/failures.json)")
+    parser.add_argument("--overwrite", action="store_true", help="Re-describe videos that already have an output")
+    parser.add_argument("--limit", type=int, help="Optional: Limit the number of videos")
+    args = parser.parse_args()
+
+    args.prompt = VISION_PROMPT
+    args.encoding = None
+    if args.budgets:
+        from budget_variants import load_encoding
+        args.max_tokens = max(args.budgets)
+        args.encoding = load_encoding(args.model)
+    args.payload = {"format": args.image_format, "quality": args.quality, "max_side": args.max_side,
+                    "crop_face": args.crop_face, "detail": args.detail}
+    if args.prompt_file:
+        with open(args.prompt_file, "r") as f:
+            args.prompt = f.read().strip()
+
+    args.cache = None
+    if args.cache_path:
+        from response_cache import ResponseCache
+        args.cache = ResponseCache(args.cache_path, max_bytes=int(args.cache_max_mb * 1024 * 1024),
+                                   read_only=args.cache_read_only)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    jobs = list_jobs(args.video_dir, args.csv_dir, args.out_dir, args.overwrite)
+    if args.limit:
+        jobs = jobs[:args.limit]
+    print(f"Found {len(jobs)} videos to describe")
+
+    start = time.time()
+    succeeded, failures = asyncio.run(describe_all(jobs, args))
+
+    report_path = args.failure_report or os.path.join(args.out_dir, "failures.json")
+    with open(report_path, "w") as f:
+        json.dump(failures, f, indent=2)
+    if args.cache is not None:
+        stats = args.cache.stats()["session"]
+        print(f"Cache: {stats['hits']} hits, {stats['near_hits']} near hits, {stats['misses']} misses")
+    print(f"\nDescribed {succeeded}/{len(jobs)} videos in {time.time() - start:.1f}s; "
+          f"{len(failures)} failures written to {report_path}")
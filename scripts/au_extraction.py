@@ -6,6 +6,13 @@ import argparse
 import pandas as pd
 import glob
 import json
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import telemetry
+from au_store import compute_peaks, compute_top_peaks
 # AU to facial phrase mapping
 AU_PHRASES = {
     'AU01': 'Inner Brow Raiser',
@@ -41,7 +48,7 @@ def map_au_intensity(value):
     else:
         return "very strongly"
 
-def extract_au_from_video(video_path, output_dir, openface_bin_path):
+def extract_au_from_video(video_path, output_dir, openface_bin_path, timeout=None, quiet=False, landmarks=False):
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
@@ -52,93 +59,192 @@ def extract_au_from_video(video_path, output_dir, openface_bin_path):
         "-aus",                      # Enable AU detection
         "-out_dir", output_dir       # Where to save the .csv output
     ]
+    if landmarks:
+        command.append("-2Dfp")      # 2D landmarks, used to crop the face for vision requests
 
     print(f"Processing: {os.path.basename(video_path)}")
     print(f"Running command:\n{' '.join(command)}\n")
-    subprocess.run(command, check=True)
+    subprocess.run(command, check=True, timeout=timeout, stdout=subprocess.DEVNULL if quiet else None)
     print(f"AU data saved to: {output_dir}")
 
+def peak_position(df):
+    """Row of the emotional peak in one OpenFace table; the heuristic itself lives in au_store.compute_peaks."""
+    return int(compute_peaks(df.to_numpy(dtype=float), list(df.columns), [len(df)])[0])
+
+def frame_number(df, position):
+    """Video frame index of a CSV row. Dense CSVs have one row per frame; the sparse
+    CSVs of coarse_au.py keep the original 1-based frame number in `frame`."""
+    if 'frame' in df.columns and position >= 0:
+        return int(df['frame'].iloc[position]) - 1
+    return position
+
+def peak_from_dataframe(df):
+    peak_frame_index = frame_number(df, peak_position(df))
+    return peak_frame_index, peak_frame_index/30
+
 def find_peak_frame(au_data_path):
     # === LOAD AU DATA ===
     df = pd.read_csv(au_data_path)
+    return peak_from_dataframe(df)
+
+
+def find_peak_frames(au_data_path, k=3, min_distance=30):
+    """Up to k peak frames (strongest first) with non-maximum suppression; the first is find_peak_frame's."""
+    df = pd.read_csv(au_data_path)
+    positions = compute_top_peaks(df.to_numpy(dtype=float), list(df.columns), [len(df)], k, min_distance)[0]
+    return [frame_number(df, p) for p in positions]
 
-    # Extract AU presence and intensity columns
-    au_presence_cols = [col for col in df.columns if "_c" in col]
-    au_intensity_cols = [col for col in df.columns if "_r" in col]
 
-    # Step 1: Identify most frequently occurring AUs
-    au_frequencies = df[au_presence_cols].sum().sort_values(ascending=False)
-    most_frequent_aus = au_frequencies.head(3).index.str.replace("_c", "")
+def au_values_at_peak(df, peak_index):
+    if peak_index >= len(df):
+        peak_index = len(df) // 2  # fallback to middle if peak invalid
+    row = df.iloc[peak_index]
 
-    # Step 2: Sum the intensity values of these AUs for each frame
-    relevant_intensity_cols = [au + "_r" for au in most_frequent_aus]
-    df["emotion_sum"] = df[relevant_intensity_cols].sum(axis=1)
+    au_phrases = []
+    peak_aus = {}
 
-    # Step 3: Find emotional peak frame
-    peak_frame_index = df["emotion_sum"].idxmax()
-    return peak_frame_index, peak_frame_index/30
+    for au in AU_PHRASES.keys():
+        if f"{au}_r" in row:
+            value = row[f"{au}_r"]
+            if value > 0.1:
+                intensity = map_au_intensity(value)
+                phrase = AU_PHRASES[au]
+                full_phrase = f"{intensity} {phrase}"
+                au_phrases.append(full_phrase)
+            peak_aus[au]=value
 
+    return au_phrases, peak_aus
 
 def parse_au_intensity(openface_csv_path, peak_index):
     try:
         df = pd.read_csv(openface_csv_path)
-        if peak_index >= len(df):
-            peak_index = len(df) // 2  # fallback to middle if peak invalid
-        row = df.iloc[peak_index]
-
-        au_phrases = []
-        peak_aus = {}
-
-        for au in AU_PHRASES.keys():
-            if f"{au}_r" in row:
-                value = row[f"{au}_r"]
-                if value > 0.1:
-                    intensity = map_au_intensity(value)
-                    phrase = AU_PHRASES[au]
-                    full_phrase = f"{intensity} {phrase}"
-                    au_phrases.append(full_phrase)
-                peak_aus[au]=value
-
-        return au_phrases, peak_aus
+        return au_values_at_peak(df, peak_index)
     except Exception as e:
         print(f"[ERROR] AU parsing failed for {openface_csv_path}: {e}")
         return [], []
 
-def process_video_files(video_files, output_dir, openface_bin_path):
-    """Process multiple video files and extract AU data"""
+def extract_au_isolated(video_path, output_dir, openface_bin_path, timeout=None, retries=0, quiet=False,
+                        landmarks=False, on_attempt=None):
+    """Run OpenFace in a private scratch folder and move its outputs into output_dir.
+
+    Parallel OpenFace runs must not share an -out_dir, so each video gets its own
+    folder under output_dir/.work and only finished outputs are moved over.
+    Returns the number of attempts used; on_attempt(n) is called as attempt n starts.
+    """
+    video_name = os.path.basename(video_path).split('.')[0]
+    work_dir = os.path.join(output_dir, ".work", video_name)
+    with telemetry.span("openface", video_name) as span:
+        for attempt in range(1, retries + 2):
+            span["attempts"] = attempt
+            if on_attempt is not None:
+                on_attempt(attempt)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            try:
+                extract_au_from_video(video_path, work_dir, openface_bin_path, timeout=timeout, quiet=quiet,
+                                      landmarks=landmarks)
+                if not os.path.exists(os.path.join(work_dir, f"{video_name}.csv")):
+                    raise RuntimeError(f"OpenFace did not write {video_name}.csv")
+                for entry in os.listdir(work_dir):
+                    os.replace(os.path.join(work_dir, entry), os.path.join(output_dir, entry))
+                return attempt
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired, RuntimeError) as e:
+                if attempt > retries:
+                    raise
+                print(f"Retrying {video_name} (attempt {attempt} failed: {e})")
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+def remove_work_dir(output_dir):
+    """Remove output_dir/.work once every job is done. Only removed if empty, so the
+    scratch folders of another run writing to the same output_dir are left alone."""
+    try:
+        os.rmdir(os.path.join(output_dir, ".work"))
+    except OSError:
+        pass
+
+def summarize_video(csv_path):
+    """Peak frame and AU phrases for one OpenFace CSV, in the au_results.json format."""
+    # Parse the CSV once for both the peak and the AU values at the peak
+    df = pd.read_csv(csv_path)
+    position = peak_position(df)
+    peak_index = frame_number(df, position)
+    peak_time = peak_index/30
+    au_phrases, peak_aus = au_values_at_peak(df, position)
+    return {
+        'peak_frame': peak_index,
+        'peak_time': peak_time,
+        'au_phrases': au_phrases,
+        'au_data': peak_aus
+    }
+
+def process_video_files(video_files, output_dir, openface_bin_path, workers=1, timeout=None, retries=0,
+                        manifest_path=None, landmarks=False, coarse=None):
+    """Process multiple video files and extract AU data
+
+    With workers > 1, up to that many OpenFace processes run at once, each in its
+    own scratch folder. Every finished or failed video is appended to
+    manifest_path (JSON lines) as soon as it completes. coarse is an optional
+    dict of coarse_au.coarse_to_fine options (stride, scale, windows, radius)
+    that replaces the dense OpenFace run.
+    """
     results = {}
-    
-    for video_path in video_files:
-        try:
+    manifest_lock = threading.Lock()
+    # video_path -> attempts started, so failures record the attempts actually made
+    attempts_made = {}
+
+    def record(entry):
+        if manifest_path is None:
+            return
+        with manifest_lock, open(manifest_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def process_one(video_path):
+        start = time.time()
+        video_name = os.path.basename(video_path).split('.')[0]
+        if coarse is not None:
+            from coarse_au import coarse_to_fine
+            for attempts in range(1, retries + 2):
+                attempts_made[video_path] = attempts
+                try:
+                    coarse_to_fine(video_path, output_dir, openface_bin_path, timeout=timeout, **coarse)
+                    break
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired, RuntimeError) as e:
+                    if attempts > retries:
+                        raise
+                    print(f"Retrying {video_name} (attempt {attempts} failed: {e})")
+        else:
+            # OpenFace's own progress output is unreadable once several runs interleave
+            attempts = extract_au_isolated(video_path, output_dir, openface_bin_path, timeout, retries,
+                                           quiet=workers > 1, landmarks=landmarks,
+                                           on_attempt=lambda n: attempts_made.__setitem__(video_path, n))
+        return summarize_video(os.path.join(output_dir, f"{video_name}.csv")), attempts, time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(process_one, video_path): video_path for video_path in video_files}
+        for done, future in enumerate(as_completed(futures), 1):
+            video_path = futures[future]
             # Get video filename without extension
             video_name = os.path.basename(video_path).split('.')[0]
-            
-            # Extract AUs from video
-            extract_au_from_video(video_path, output_dir, openface_bin_path)
-            
-            # Find peak frame in the extracted data
-            csv_path = os.path.join(output_dir, f"{video_name}.csv")
-            peak_index, peak_time = find_peak_frame(csv_path)
-            
-            # Parse AU intensities at peak frame
-            au_phrases, peak_aus = parse_au_intensity(csv_path, peak_index)
-            
+            try:
+                result, attempts, seconds = future.result()
+            except Exception as e:
+                status = "timeout" if isinstance(e, subprocess.TimeoutExpired) else "failed"
+                print(f"Error processing {video_path}: {e}")
+                record({"video": video_name, "status": status, "error": str(e),
+                        "attempts": attempts_made.get(video_path, 0)})
+                continue
+
             # Store results
-            results[video_name] = {
-                'peak_frame': peak_index,
-                'peak_time': peak_time,
-                'au_phrases': au_phrases,
-                'au_data': peak_aus
-            }
-            
-            print(f"Processed {video_name}:")
-            print(f"  Peak frame: {peak_index} (at {peak_time:.2f} seconds)")
-            print(f"  AU phrases: {', '.join(au_phrases)}")
+            results[video_name] = result
+            record({"video": video_name, "status": "ok", "attempts": attempts, "seconds": round(seconds, 3),
+                    "peak_frame": int(result['peak_frame'])})
+
+            print(f"[{done}/{len(futures)}] Processed {video_name}:")
+            print(f"  Peak frame: {result['peak_frame']} (at {result['peak_time']:.2f} seconds)")
+            print(f"  AU phrases: {', '.join(result['au_phrases'])}")
             print("-----------------------------------")
-            
-        except Exception as e:
-            print(f"Error processing {video_path}: {e}")
-    
+
+    remove_work_dir(output_dir)
     return results
 
 if __name__ == "__main__":
@@ -154,6 +260,21 @@ if __name__ == "__main__":
                        help="Optional: Limit the number of files to process")
     parser.add_argument("--specific_files", nargs='+', 
                        help="Specific files to process (overrides other options)")
+    parser.add_argument("--workers", type=int, default=1,
+                       help="Number of OpenFace processes to run in parallel")
+    parser.add_argument("--timeout", type=float,
+                       help="Optional: Per-video OpenFace timeout in seconds")
+    parser.add_argument("--retries", type=int, default=0,
+                       help="Number of times to retry a failed or timed out video")
+    parser.add_argument("--landmarks", action="store_true",
+                       help="Also write 2D landmarks (needed to crop faces for vision requests)")
+    parser.add_argument("--coarse_stride", type=int,
+                       help="Optional: coarse-to-fine mode; first pass on every n-th frame (see coarse_au.py)")
+    parser.add_argument("--coarse_scale", type=float, help="Optional: downscale factor of the coarse pass")
+    parser.add_argument("--coarse_windows", type=int, default=3, help="Candidate peaks refined densely")
+    parser.add_argument("--coarse_radius", type=int, help="Frames on each side of a candidate (default: 2 * stride)")
+    parser.add_argument("--manifest", type=str,
+                       help="JSON lines file recording each video's status (default: <output_dir>/manifest.jsonl)")
     
     args = parser.parse_args()
     
@@ -177,7 +298,14 @@ if __name__ == "__main__":
     print(f"Found {len(video_files)} video files to process")
     
     # Process the selected video files
-    results = process_video_files(video_files, args.output_dir, args.openface_bin)
+    manifest_path = args.manifest or os.path.join(args.output_dir, "manifest.jsonl")
+    coarse = None
+    if args.coarse_stride:
+        coarse = {"stride": args.coarse_stride, "scale": args.coarse_scale, "windows": args.coarse_windows,
+                  "radius": args.coarse_radius}
+    results = process_video_files(video_files, args.output_dir, args.openface_bin, workers=args.workers,
+                                  timeout=args.timeout, retries=args.retries, manifest_path=manifest_path,
+                                  landmarks=args.landmarks, coarse=coarse)
     
     # save the results to a json file
     with open(os.path.join(args.output_dir, "au_results.json"), "w") as f:
@@ -0,0 +1,290 @@
+# Columnar store for OpenFace AU time series.
+#
+# All test_subset_au/*.csv files are parsed once into a single float32 matrix
+# (one row per frame, one column per OpenFace column) that is memory-mapped on
+# load, plus a small JSON index of where each video's rows start. The peak
+# heuristic from find_peak_frame lives here as compute_peaks(), a vectorized
+# kernel that handles one video or thousands in a single call, and
+# compute_top_peaks() picks several peaks per video with non-maximum suppression.
+#
+# Usage:
+#   python scripts/au_store.py build --csv_dir data/MER_test_subset/test_subset_au
+#   python scripts/au_store.py peaks --output peaks.json
+
+import os
+import json
+import glob
+import argparse
+
+import numpy as np
+
+csv_dir = 'data/MER_test_subset/test_subset_au'
+store_dir = 'data/MER_test_subset/au_store'
+
+VALUES_FILE = 'values.f32'
+INDEX_FILE = 'index.json'
+FPS = 30
+TOP_AUS = 3
+AU_DECIMALS = 2
+
+
+def _segment_rows(lengths):
+    """Segment id of every row when segments of the given lengths are concatenated."""
+    return np.repeat(np.arange(len(lengths)), lengths)
+
+def emotion_sums(values, columns, lengths, top_aus=TOP_AUS):
+    """Per-frame emotion_sum curve of every video in one pass.
+
+    values holds the rows of all videos concatenated (len(values) == sum(lengths)).
+    For each video this picks the `top_aus` most frequently present AUs (the
+    "_c" columns) and sums their "_r" intensities per frame. Returns the curve
+    for all rows, aligned with values.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    nonempty = np.flatnonzero(lengths > 0)
+    if len(nonempty) == 0:
+        return np.zeros(0)
+
+    # OpenFace writes two decimals. Snapping the float32 values back to those
+    # decimals gives the same doubles pandas parses from the CSV, so sums (and
+    # their argmax) match find_peak_frame on the raw CSV bit for bit.
+    values = np.round(np.nan_to_num(np.asarray(values, dtype=np.float64)) * 10 ** AU_DECIMALS) / 10 ** AU_DECIMALS
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])[nonempty]
+    seg = _segment_rows(lengths)
+
+    presence_cols = [i for i, c in enumerate(columns) if "_c" in c]
+    col_index = {c: i for i, c in enumerate(columns)}
+    # Intensity column for each presence column; AUs without one (AU28) read from
+    # an all-zero column appended at the end.
+    zero_col = values.shape[1]
+    intensity_for_presence = np.array(
+        [col_index.get(columns[i].replace("_c", "_r"), zero_col) for i in presence_cols], dtype=np.int64)
+    values = np.hstack([values, np.zeros((len(values), 1))])
+
+    # Step 1: most frequently occurring AUs per video. Sorting descending the way
+    # pandas' sort_values(ascending=False) does keeps tie-breaking identical.
+    counts = np.add.reduceat(values[:, presence_cols], starts, axis=0)
+    reversed_order = np.argsort(counts[:, ::-1], axis=1, kind="quicksort")
+    order = (counts.shape[1] - 1 - reversed_order)[:, ::-1]
+    top = intensity_for_presence[order[:, :top_aus]]
+
+    # Step 2: per-frame sum of those AUs' intensities
+    full_top = np.zeros((len(lengths), top.shape[1]), dtype=np.int64)
+    full_top[nonempty] = top
+    return np.take_along_axis(values, full_top[seg], axis=1).sum(axis=1)
+
+def compute_peaks(values, columns, lengths, top_aus=TOP_AUS):
+    """Emotional peak frame of every video in one pass.
+
+    The peak is the first frame with the highest emotion_sum (see
+    emotion_sums), relative to the video's first row. Videos without rows get -1.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    peaks = np.full(len(lengths), -1, dtype=np.int64)
+    nonempty = np.flatnonzero(lengths > 0)
+    if len(nonempty) == 0:
+        return peaks
+    emotion_sum = emotion_sums(values, columns, lengths, top_aus)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])[nonempty]
+    seg = _segment_rows(lengths)
+
+    # First frame reaching each video's maximum
+    seg_max = np.maximum.reduceat(emotion_sum, starts)
+    full_max = np.zeros(len(lengths))
+    full_max[nonempty] = seg_max
+    candidates = np.flatnonzero(emotion_sum == full_max[seg])
+    first_seg, first = np.unique(seg[candidates], return_index=True)
+    all_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    peaks[first_seg] = candidates[first] - all_starts[first_seg]
+    return peaks
+
+def top_k_peaks(curve, k=3, min_distance=FPS):
+    """Up to k peak frames of one emotion_sum curve, with non-maximum suppression.
+
+    Frames are taken in order of decreasing value (earlier frame first on ties,
+    so the first pick is compute_peaks' peak); every pick suppresses the frames
+    within min_distance of it. Returned strongest first.
+    """
+    curve = np.asarray(curve)
+    suppressed = np.zeros(len(curve), dtype=bool)
+    picks = []
+    for frame in np.argsort(-curve, kind="stable"):
+        if len(picks) >= k:
+            break
+        if suppressed[frame]:
+            continue
+        picks.append(int(frame))
+        suppressed[max(0, frame - min_distance):frame + min_distance + 1] = True
+    return picks
+
+def compute_top_peaks(values, columns, lengths, k=3, min_distance=FPS, top_aus=TOP_AUS):
+    """top_k_peaks for every video; a list of frame lists aligned with lengths."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    emotion_sum = emotion_sums(values, columns, lengths, top_aus)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return [top_k_peaks(emotion_sum[start:start + n], k, min_distance) for start, n in zip(starts, lengths)]
+
+
+def build_store(csv_files, store_dir):
+    """Parse every CSV once and write the columnar store. Returns the index."""
+    import pandas as pd
+
+    os.makedirs(store_dir, exist_ok=True)
+    columns = None
+    videos, starts, lengths = [], [], []
+    rows = 0
+    tmp_values = os.path.join(store_dir, VALUES_FILE + '.tmp')
+    with open(tmp_values, 'wb') as out:
+        for csv_path in csv_files:
+            video_id = os.path.splitext(os.path.basename(csv_path))[0]
+            try:
+                df = pd.read_csv(csv_path)
+            except Exception as e:
+                print(f"[ERROR] Could not read {csv_path}: {e}")
+                continue
+            if columns is None:
+                columns = list(df.columns)
+            # Missing columns become NaN so every video shares one layout
+            block = df.reindex(columns=columns).to_numpy(dtype=np.float32)
+            out.write(np.ascontiguousarray(block).tobytes())
+            videos.append(video_id)
+            starts.append(rows)
+            lengths.append(len(block))
+            rows += len(block)
+
+    index = {'columns': columns or [], 'rows': rows, 'videos': videos, 'starts': starts, 'lengths': lengths}
+    os.replace(tmp_values, os.path.join(store_dir, VALUES_FILE))
+    with open(os.path.join(store_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+class AUStore:
+    """Read-only, memory-mapped view of a store written by build_store."""
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, INDEX_FILE), 'r') as f:
+            index = json.load(f)
+        self.columns = index['columns']
+        self.videos = index['videos']
+        self.starts = np.asarray(index['starts'], dtype=np.int64)
+        self.lengths = np.asarray(index['lengths'], dtype=np.int64)
+        self.video_index = {v: i for i, v in enumerate(self.videos)}
+        self.column_index = {c: i for i, c in enumerate(self.columns)}
+        if index['rows']:
+            self.values = np.memmap(os.path.join(store_dir, VALUES_FILE), dtype=np.float32, mode='r',
+                                    shape=(index['rows'], len(self.columns)))
+        else:
+            self.values = np.zeros((0, len(self.columns)), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.videos)
+
+    def __contains__(self, video_id):
+        return video_id in self.video_index
+
+    def video(self, video_id):
+        """All frames of one video as a (frames, columns) view, without copying."""
+        i = self.video_index[video_id]
+        return self.values[self.starts[i]:self.starts[i] + self.lengths[i]]
+
+    def frame(self, video_id, frame_idx):
+        return self.video(video_id)[frame_idx]
+
+    def rows_for(self, video_ids):
+        """Concatenated rows and per-video lengths for the given videos."""
+        idx = np.array([self.video_index[v] for v in video_ids], dtype=np.int64)
+        lengths = self.lengths[idx]
+        if len(idx) == len(self.videos) and np.array_equal(idx, np.arange(len(idx))):
+            return self.values, lengths
+        offsets = np.repeat(self.starts[idx] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return self.values[np.arange(lengths.sum()) + offsets], lengths
+
+    def peaks(self, video_ids=None, fps=FPS):
+        """Peak frame, peak time and AU intensities at the peak for many videos at once.
+
+        Returns a dict of arrays aligned with `video_ids` (default: every video):
+        'video_ids', 'peak_frame', 'peak_time', and 'au_values' with one column
+        per AU in AU_PHRASES (NaN where OpenFace has no intensity for that AU).
+        """
+        from au_extraction import AU_PHRASES
+
+        video_ids = list(self.videos if video_ids is None else video_ids)
+        values, lengths = self.rows_for(video_ids)
+        peak_frame = compute_peaks(values, self.columns, lengths)
+
+        au_names = list(AU_PHRASES.keys())
+        au_cols = [self.column_index.get(f"{au}_r", -1) for au in au_names]
+        au_values = np.full((len(video_ids), len(au_names)), np.nan, dtype=np.float32)
+        valid = peak_frame >= 0
+        if valid.any():
+            peak_rows = (np.concatenate([[0], np.cumsum(lengths)[:-1]]) + peak_frame)[valid]
+            at_peak = np.asarray(values[peak_rows])
+            for j, col in enumerate(au_cols):
+                if col >= 0:
+                    au_values[valid, j] = at_peak[:, col]
+            if 'frame' in self.column_index:
+                # Row position -> video frame; differs for sparse coarse-to-fine CSVs
+                peak_frame[valid] = at_peak[:, self.column_index['frame']].astype(np.int64) - 1
+        return {
+            'video_ids': video_ids,
+            'peak_frame': peak_frame,
+            'peak_time': peak_frame / fps,
+            'au_names': au_names,
+            'au_values': au_values,
+        }
+
+    def top_peaks(self, video_ids=None, k=3, min_distance=FPS):
+        """video_id -> up to k peak frames (strongest first) separated by more than min_distance frames."""
+        video_ids = list(self.videos if video_ids is None else video_ids)
+        values, lengths = self.rows_for(video_ids)
+        top = compute_top_peaks(values, self.columns, lengths, k, min_distance)
+        if 'frame' in self.column_index:
+            # Row position -> video frame; differs for sparse coarse-to-fine CSVs
+            frame_col = self.column_index['frame']
+            starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            top = [[int(values[start + p, frame_col]) - 1 for p in picks] for start, picks in zip(starts, top)]
+        return dict(zip(video_ids, top))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build and query the columnar AU store")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build = sub.add_parser('build', help='Ingest OpenFace CSVs into the store')
+    build.add_argument('--csv_dir', type=str, default=csv_dir)
+    build.add_argument('--store_dir', type=str, default=store_dir)
+
+    peaks = sub.add_parser('peaks', help='Peak frame, time and AU values for every video')
+    peaks.add_argument('--store_dir', type=str, default=store_dir)
+    peaks.add_argument('--output', type=str, help='Optional: write results to this JSON file')
+    peaks.add_argument('--top_k', type=int, default=1, help='Also list this many peaks per video')
+    peaks.add_argument('--min_distance', type=int, default=FPS, help='Frames suppressed around each peak')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        csv_files = sorted(glob.glob(os.path.join(args.csv_dir, '*.csv')))
+        index = build_store(csv_files, args.store_dir)
+        print(f"Stored {len(index['videos'])} videos ({index['rows']} frames) in {args.store_dir}")
+    else:
+        store = AUStore(args.store_dir)
+        result = store.peaks()
+        top = store.top_peaks(k=args.top_k, min_distance=args.min_distance) if args.top_k > 1 else {}
+        output = {}
+        for i, video_id in enumerate(result['video_ids']):
+            output[video_id] = {
+                'peak_frame': int(result['peak_frame'][i]),
+                'peak_time': float(result['peak_time'][i]),
+                'au_data': {au: round(float(v), 2) for au, v in zip(result['au_names'], result['au_values'][i])
+                            if not np.isnan(v)},
+            }
+            if video_id in top:
+                output[video_id]['peak_frames'] = top[video_id]
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(output, f)
+            print(f"Saved peaks for {len(output)} videos to {args.output}")
+        else:
+            for video_id, data in output.items():
+                print(f"{video_id}: peak frame {data['peak_frame']} (at {data['peak_time']:.2f} seconds)")
@@ -0,0 +1,153 @@
+# Shared audio cache for the speech models.
+#
+# Every clip is stored once as 16 kHz mono float32 in a single container file
+# (audio.f32) plus a JSON index of (offset, length) per sample. Readers
+# memory-map the container and get zero-copy slices, so Whisper
+# (transcription.py) and Qwen-Audio (wav_to_qwen_description.py) no longer open
+# and decode a separate WAV per clip each.
+#
+# Clips can be added from the WAVs written by mp4_to_wav.py/demux.py, or straight
+# from the videos with ffmpeg (same decoding as whisper.load_audio), skipping
+# the WAV files altogether. Adding is append-only; existing clips are kept.
+#
+# Usage:
+#   python scripts/audio_cache.py build --video_dir data/MER_test_subset/test_subset --workers 8
+#   python scripts/audio_cache.py build --wav_dir data/MER_test_subset/test_subset_wav
+#   python scripts/audio_cache.py info
+
+import os
+import json
+import glob
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+cache_dir = 'data/MER_test_subset/audio_cache'
+
+SAMPLE_RATE = 16000
+DATA_FILE = 'audio.f32'
+INDEX_FILE = 'index.json'
+
+
+def decode_video(video_path, ffmpeg_bin='ffmpeg'):
+    """16 kHz mono float32 samples of a video's audio track, decoded like whisper.load_audio."""
+    command = [ffmpeg_bin, '-nostdin', '-threads', '0', '-i', video_path, '-f', 's16le', '-ac', '1',
+               '-acodec', 'pcm_s16le', '-ar', str(SAMPLE_RATE), '-']
+    out = subprocess.run(command, capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+class AudioCache:
+    def __init__(self, cache_dir=cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, INDEX_FILE)
+        self.data_path = os.path.join(cache_dir, DATA_FILE)
+        self.clips = {}
+        self.total = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            if index['sample_rate'] != SAMPLE_RATE:
+                raise ValueError(f"{self.index_path} holds {index['sample_rate']} Hz audio, expected {SAMPLE_RATE}")
+            self.clips = {sample_id: tuple(span) for sample_id, span in index['clips'].items()}
+            self.total = index['total']
+        self._data = None
+
+    def __len__(self):
+        return len(self.clips)
+
+    def __contains__(self, sample_id):
+        return sample_id in self.clips
+
+    def sample_ids(self):
+        return list(self.clips)
+
+    def _map(self):
+        if self._data is None or len(self._data) < self.total:
+            self._data = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(self.total,)) \
+                if self.total else np.zeros(0, dtype=np.float32)
+        return self._data
+
+    def get(self, sample_id):
+        """The clip's samples as a read-only view into the memory-mapped container."""
+        offset, length = self.clips[sample_id]
+        return self._map()[offset:offset + length]
+
+    def add_many(self, items):
+        """Append (sample_id, samples) pairs and rewrite the index. Returns the number added."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        added = 0
+        try:
+            with open(self.data_path, 'ab') as f:
+                # Anything past the indexed end is left over from an interrupted run
+                f.truncate(self.total * 4)
+                for sample_id, samples in items:
+                    if sample_id in self.clips:
+                        continue
+                    samples = np.ascontiguousarray(samples, dtype=np.float32)
+                    f.write(samples.tobytes())
+                    self.clips[sample_id] = (self.total, len(samples))
+                    self.total += len(samples)
+                    added += 1
+        finally:
+            self._write_index()
+        self._data = None
+        return added
+
+    def _write_index(self):
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'sample_rate': SAMPLE_RATE, 'total': self.total,
+                       'clips': {sample_id: list(span) for sample_id, span in self.clips.items()}}, f)
+        os.replace(tmp_path, self.index_path)
+
+
+def build_from_files(cache, paths, read, workers=4):
+    """Decode every file not in the cache yet with `workers` threads and append it in order."""
+    todo = [p for p in paths if os.path.splitext(os.path.basename(p))[0] not in cache]
+
+    def load(path):
+        sample_id = os.path.splitext(os.path.basename(path))[0]
+        try:
+            return sample_id, read(path)
+        except Exception as e:
+            print(f'Error decoding {path}: {e}')
+            return sample_id, None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(load, todo)
+        return cache.add_many((sample_id, samples) for sample_id, samples in results if samples is not None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory-mapped float32 audio cache shared by Whisper and Qwen-Audio')
+    parser.add_argument('--cache_dir', type=str, default=cache_dir)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build = sub.add_parser('build', help='Add clips from videos or WAV files')
+    source = build.add_mutually_exclusive_group(required=True)
+    source.add_argument('--video_dir', type=str, help='Decode the audio tracks of *.mp4 files with ffmpeg')
+    source.add_argument('--wav_dir', type=str, help='Read existing 16 kHz WAV files')
+    build.add_argument('--ffmpeg', type=str, default='ffmpeg')
+    build.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+
+    sub.add_parser('info', help='Print the number of clips and total duration')
+
+    args = parser.parse_args()
+    cache = AudioCache(args.cache_dir)
+
+    if args.command == 'build':
+        if args.video_dir:
+            paths = sorted(glob.glob(os.path.join(args.video_dir, '*.mp4')))
+            read = lambda path: decode_video(path, args.ffmpeg)
+        else:
+            from transcription import read_wav
+            paths = sorted(glob.glob(os.path.join(args.wav_dir, '*.wav')))
+            read = read_wav
+        added = build_from_files(cache, paths, read, args.workers)
+        print(f'Added {added} clips; {len(cache)} clips in {args.cache_dir}')
+    else:
+        print(f'{len(cache)} clips, {cache.total / SAMPLE_RATE / 3600:.2f} hours, '
+              f'{cache.total * 4 / 1024 / 1024:.1f} MB in {args.cache_dir}')
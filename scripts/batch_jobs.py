@@ -0,0 +1,293 @@
+# OpenAI Batch API files for peak frame descriptions.
+#
+# build:  writes every vision request into sharded Batch JSONL files (each under
+#         the per-file request and size limits) plus a manifest of custom_ids.
+# ingest: maps downloaded batch output/error files back into
+#         openai_test_subset_peak_frame_description/*.csv and reports failed,
+#         truncated and missing requests, with a retry shard for resubmission.
+#
+# Both steps only touch local files; uploading the shards and downloading the
+# results is done separately (OpenAI dashboard or `openai api files.create`).
+#
+# Usage:
+#   python scripts/batch_jobs.py build --batch_dir data/MER_test_subset/batch
+#   python scripts/batch_jobs.py ingest --batch_dir data/MER_test_subset/batch batch_out_*.jsonl
+
+import os
+import json
+import argparse
+
+import telemetry
+from prompts import VISION_PROMPT
+
+video_dir = "./data/MER_test_subset/test_subset"
+csv_dir = "./data/MER_test_subset/test_subset_au"
+out_dir = "./data/MER_test_subset/openai_test_subset_peak_frame_description"
+batch_dir = "./data/MER_test_subset/batch"
+
+# Batch API limits per input file are 50,000 requests and 200 MB; stay a little under.
+MAX_REQUESTS_PER_SHARD = 50000
+MAX_BYTES_PER_SHARD = 190 * 1024 * 1024
+MANIFEST_FILE = "manifest.json"
+
+
+def make_custom_id(sample_id, frame_index):
+    """Stable id of one request: the same sample and frame always map to the same id."""
+    return f"{sample_id}__frame{int(frame_index)}"
+
+def parse_custom_id(custom_id):
+    sample_id, _, frame = custom_id.rpartition("__frame")
+    return sample_id, int(frame)
+
+def batch_request_line(custom_id, messages, model, max_tokens):
+    return json.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {"model": model, "messages": messages, "max_tokens": max_tokens},
+    }, ensure_ascii=False)
+
+
+class ShardWriter:
+    """Appends JSONL lines, starting a new shard file before either limit would be exceeded."""
+
+    def __init__(self, batch_dir, prefix="requests", max_requests=MAX_REQUESTS_PER_SHARD,
+                 max_bytes=MAX_BYTES_PER_SHARD):
+        self.batch_dir = batch_dir
+        self.prefix = prefix
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.shards = []
+        self.file = None
+        self.count = 0
+        self.size = 0
+
+    def _open_next(self):
+        self.close()
+        path = os.path.join(self.batch_dir, f"{self.prefix}_{len(self.shards):04d}.jsonl")
+        self.file = open(path, "w", encoding="utf-8")
+        self.shards.append({"path": os.path.basename(path), "custom_ids": []})
+        self.count = 0
+        self.size = 0
+
+    def write(self, custom_id, line):
+        data = (line + "\n").encode("utf-8")
+        if len(data) > self.max_bytes:
+            raise ValueError(f"Request {custom_id} is {len(data)} bytes, larger than a whole shard")
+        if self.file is None or self.count >= self.max_requests or self.size + len(data) > self.max_bytes:
+            self._open_next()
+        self.file.write(line + "\n")
+        self.count += 1
+        self.size += len(data)
+        self.shards[-1]["custom_ids"].append(custom_id)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def build_batch_files(video_dir, csv_dir, batch_dir, prompt=VISION_PROMPT, model="gpt-4o", max_tokens=500,
+                      frames_dir=None, max_requests=MAX_REQUESTS_PER_SHARD, max_bytes=MAX_BYTES_PER_SHARD,
+                      payload=None):
+    """Write one Batch API request per video with an AU CSV. Returns the manifest."""
+    from au_extraction import find_peak_frame
+    from vision_io import load_frame, build_vision_messages
+    from image_payload import encode_frame
+
+    os.makedirs(batch_dir, exist_ok=True)
+    writer = ShardWriter(batch_dir, max_requests=max_requests, max_bytes=max_bytes)
+    skipped = []
+    payload_bytes = image_tokens = 0
+    try:
+        for video_file in sorted(os.listdir(video_dir)):
+            if not video_file.endswith(".mp4"):
+                continue
+            sample_id = os.path.splitext(video_file)[0]
+            csv_path = os.path.join(csv_dir, sample_id + ".csv")
+            if not os.path.exists(csv_path):
+                print(f"CSV not found for {video_file}, skipping.")
+                skipped.append(sample_id)
+                continue
+            try:
+                frame_index, _ = find_peak_frame(csv_path)
+                image = load_frame(os.path.join(video_dir, video_file), frame_index, frames_dir)
+                encoded = encode_frame(image, payload, csv_path, frame_index)
+                messages = build_vision_messages(encoded["url"], prompt, encoded["detail"])
+            except Exception as e:
+                print(f"Error processing {video_file}: {e}")
+                skipped.append(sample_id)
+                continue
+            payload_bytes += encoded["bytes"]
+            image_tokens += encoded["image_tokens"]
+            custom_id = make_custom_id(sample_id, frame_index)
+            writer.write(custom_id, batch_request_line(custom_id, messages, model, max_tokens))
+    finally:
+        writer.close()
+
+    manifest = {"model": model, "max_tokens": max_tokens, "prompt": prompt, "shards": writer.shards,
+                "skipped": skipped, "image_bytes": payload_bytes, "estimated_image_tokens": image_tokens}
+    with open(os.path.join(batch_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    return manifest
+
+
+def result_succeeded(item):
+    response = item.get("response") or {}
+    body = response.get("body") or {}
+    return not item.get("error") and response.get("status_code") == 200 and bool(body.get("choices"))
+
+
+def read_batch_results(result_files):
+    """custom_id -> result line, for Batch output and error files alike.
+
+    Lines that fail to parse (e.g. a truncated download) are returned separately,
+    as are custom_ids seen more than once (e.g. an earlier run's error file passed
+    next to a retry's output). A success always wins over an error for the same id;
+    otherwise the first line read is kept.
+    """
+    results, unreadable, duplicates = {}, [], {}
+    for path in result_files:
+        with open(path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    custom_id = item["custom_id"]
+                except (json.JSONDecodeError, KeyError) as e:
+                    unreadable.append({"file": path, "line": line_no, "error": str(e)})
+                    continue
+                previous = results.get(custom_id)
+                if previous is None:
+                    results[custom_id] = item
+                    continue
+                duplicates[custom_id] = duplicates.get(custom_id, 1) + 1
+                if result_succeeded(item) and not result_succeeded(previous):
+                    results[custom_id] = item
+    return results, unreadable, duplicates
+
+def ingest_batch_results(result_files, batch_dir, out_dir, overwrite=True, budgets=None):
+    """Write a description CSV for every successful line and report everything else.
+
+    With budgets, each response's variants cut to those token budgets are written
+    too (see budget_variants.py); none may exceed the batch's max_tokens.
+    """
+    from vision_io import write_description
+
+    with open(os.path.join(batch_dir, MANIFEST_FILE), "r") as f:
+        manifest = json.load(f)
+    encoding = None
+    if budgets:
+        from budget_variants import load_encoding, write_variants
+        if max(budgets) > manifest["max_tokens"]:
+            raise ValueError(f"Budget {max(budgets)} exceeds the batch's max_tokens of {manifest['max_tokens']}")
+        encoding = load_encoding(manifest["model"])
+    results, unreadable, duplicates = read_batch_results(result_files)
+    os.makedirs(out_dir, exist_ok=True)
+
+    report = {"written": 0, "truncated": [], "failed": [], "missing": [], "unreadable": unreadable,
+              "duplicates": duplicates}
+    retry_ids = set()
+    for shard in manifest["shards"]:
+        for custom_id in shard["custom_ids"]:
+            item = results.get(custom_id)
+            if item is None:
+                report["missing"].append(custom_id)
+                retry_ids.add(custom_id)
+                continue
+            response = item.get("response") or {}
+            body = response.get("body") or {}
+            if not result_succeeded(item):
+                report["failed"].append({"custom_id": custom_id, "status_code": response.get("status_code"),
+                                         "error": item.get("error") or body.get("error")})
+                retry_ids.add(custom_id)
+                continue
+            choice = body["choices"][0]
+            if choice.get("finish_reason") == "length":
+                # Hit max_tokens; the text is still usable, same as the synchronous path
+                report["truncated"].append(custom_id)
+            sample_id, frame_index = parse_custom_id(custom_id)
+            telemetry.record_usage(body.get("model"), body.get("usage"), batch=True, sample_id=sample_id)
+            out_path = os.path.join(out_dir, sample_id + ".csv")
+            if os.path.exists(out_path) and not overwrite:
+                continue
+            write_description(out_path, frame_index, choice["message"]["content"])
+            if budgets:
+                write_variants(out_dir, sample_id, frame_index, choice["message"]["content"], budgets, encoding)
+            report["written"] += 1
+
+    # Collect the original request lines of everything that needs another try
+    report["retry_file"] = None
+    if retry_ids:
+        writer = ShardWriter(batch_dir, prefix="retry")
+        try:
+            for shard in manifest["shards"]:
+                with open(os.path.join(batch_dir, shard["path"]), "r", encoding="utf-8") as f:
+                    for line in f:
+                        custom_id = json.loads(line)["custom_id"]
+                        if custom_id in retry_ids:
+                            writer.write(custom_id, line.rstrip("\n"))
+        finally:
+            writer.close()
+        report["retry_file"] = [s["path"] for s in writer.shards]
+
+    with open(os.path.join(batch_dir, "ingest_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and ingest OpenAI Batch API files for frame descriptions")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="Write sharded Batch JSONL request files")
+    build.add_argument("--video_dir", type=str, default=video_dir)
+    build.add_argument("--csv_dir", type=str, default=csv_dir)
+    build.add_argument("--frames_dir", type=str, help="Optional: frames written by demux.py")
+    build.add_argument("--batch_dir", type=str, default=batch_dir)
+    build.add_argument("--model", type=str, default="gpt-4o")
+    build.add_argument("--max_tokens", type=int, default=500)
+    build.add_argument("--prompt_file", type=str, help="Optional: text file overriding the default prompt")
+    build.add_argument("--image_format", type=str, default="png", choices=["png", "jpeg", "webp"])
+    build.add_argument("--quality", type=int, help="JPEG/WebP quality")
+    build.add_argument("--max_side", type=int, help="Optional: downscale so the longer side is at most this")
+    build.add_argument("--crop_face", action="store_true",
+                       help="Crop to the OpenFace face region (needs CSVs from au_extraction.py --landmarks)")
+    build.add_argument("--detail", type=str, default="auto", choices=["auto", "low", "high"])
+    build.add_argument("--max_requests", type=int, default=MAX_REQUESTS_PER_SHARD)
+    build.add_argument("--max_mb", type=float, default=MAX_BYTES_PER_SHARD / 1024 / 1024)
+
+    ingest = sub.add_parser("ingest", help="Map Batch output/error files back to description CSVs")
+    ingest.add_argument("result_files", nargs="+", help="Downloaded batch output and error JSONL files")
+    ingest.add_argument("--batch_dir", type=str, default=batch_dir)
+    ingest.add_argument("--out_dir", type=str, default=out_dir)
+    ingest.add_argument("--keep_existing", action="store_true", help="Do not overwrite existing CSVs")
+    ingest.add_argument("--budgets", nargs="+", type=int,
+                        help="Optional: also write variants cut to these token budgets to <out_dir>_<budget>tokens")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        prompt = VISION_PROMPT
+        if args.prompt_file:
+            with open(args.prompt_file, "r") as f:
+                prompt = f.read().strip()
+        manifest = build_batch_files(args.video_dir, args.csv_dir, args.batch_dir, prompt, args.model,
+                                     args.max_tokens, args.frames_dir, args.max_requests,
+                                     int(args.max_mb * 1024 * 1024),
+                                     payload={"format": args.image_format, "quality": args.quality,
+                                              "max_side": args.max_side, "crop_face": args.crop_face,
+                                              "detail": args.detail})
+        total = sum(len(s["custom_ids"]) for s in manifest["shards"])
+        print(f"Wrote {total} requests in {len(manifest['shards'])} shards to {args.batch_dir}")
+        print(f"Images: {manifest['image_bytes']} bytes, ~{manifest['estimated_image_tokens']} image tokens")
+    else:
+        report = ingest_batch_results(args.result_files, args.batch_dir, args.out_dir,
+                                      overwrite=not args.keep_existing, budgets=args.budgets)
+        print(f"Wrote {report['written']} descriptions to {args.out_dir}")
+        print(f"Truncated: {len(report['truncated'])}, failed: {len(report['failed'])}, "
+              f"missing: {len(report['missing'])}, unreadable lines: {len(report['unreadable'])}, "
+              f"duplicate ids: {len(report['duplicates'])}")
+        if report["retry_file"]:
+            print(f"Requests to resubmit: {', '.join(report['retry_file'])}")
@@ -0,0 +1,536 @@
+# Per-stage throughput benchmark on synthetic data.
+#
+# Generates N synthetic clips per dataset size (AU CSVs in the OpenFace layout,
+# 16 kHz WAVs, peak frames, description/caption files and, when ffmpeg is
+# available, test-pattern videos with a sine audio track) and runs every stage
+# through its real code path. The models and APIs are replaced by stub
+# back-ends with a configurable latency:
+#   openface           au_extraction.extract_au_isolated with a stub FeatureExtraction
+#                      binary that writes the synthetic CSV (or the real one via --openface_bin)
+#   whisper / qwen_audio / blip2
+#                      ModelClient against an in-process model_server (real MicroBatcher
+#                      and HTTP handler, stub model handlers)
+#   gpt4o              async_describer.describe_sample against a stub OpenAI endpoint
+#
+# Each (stage, size) runs in a fresh process, so the reported peak RSS is that of
+# the stage alone (child processes such as ffmpeg and OpenFace are reported
+# separately). Stages whose dependencies are missing are reported as skipped.
+#
+# Usage:
+#   python scripts/benchmark.py --sizes 10 100 1000
+#   python scripts/benchmark.py --stages find_peak_frame combine --sizes 1000 --output bench.json
+#   python scripts/benchmark.py --baseline bench.json --max_regression 0.2   # exit 1 on a slowdown
+
+import os
+import sys
+import csv
+import json
+import time
+import wave
+import shutil
+import asyncio
+import contextlib
+import argparse
+import resource
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import telemetry
+
+work_dir = 'data/benchmark'
+
+SAMPLE_RATE = 16000
+FPS = 30
+AU_R = ['AU01', 'AU02', 'AU04', 'AU05', 'AU06', 'AU07', 'AU09', 'AU10', 'AU12', 'AU14', 'AU15', 'AU17',
+        'AU20', 'AU23', 'AU25', 'AU26', 'AU45']
+AU_C = AU_R[:-1] + ['AU28', 'AU45']
+AU_COLUMNS = (['frame', 'face_id', 'timestamp', 'confidence', 'success'] +
+              [f'{au}_r' for au in AU_R] + [f'{au}_c' for au in AU_C])
+STUB_TEXT = 'A person with a neutral expression looks at the camera.'
+
+STUB_OPENFACE = '''#!{python}
+# Stand-in for OpenFace FeatureExtraction: copies the synthetic CSV of the video
+import os, sys, time, shutil
+args = sys.argv[1:]
+name = os.path.basename(args[args.index('-f') + 1]).split('.')[0]
+out_dir = args[args.index('-out_dir') + 1]
+time.sleep({latency})
+os.makedirs(out_dir, exist_ok=True)
+shutil.copy(os.path.join({source!r}, name + '.csv'), os.path.join(out_dir, name + '.csv'))
+'''
+
+
+# --- Synthetic data ---
+def synthetic_au_table(rng, frames):
+    """OpenFace-style AU table: smooth random intensity curves in [0, 5] and presence flags."""
+    steps = rng.normal(0, 0.15, size=(frames, len(AU_R)))
+    r = np.clip(np.cumsum(steps, axis=0) + rng.uniform(0, 1.5, size=len(AU_R)), 0, 5)
+    c = np.zeros((frames, len(AU_C)))
+    for j, au in enumerate(AU_C):
+        c[:, j] = r[:, AU_R.index(au)] > 1 if au in AU_R else rng.random(frames) < 0.1
+    index = np.arange(frames)
+    return np.column_stack([index + 1, np.zeros(frames), index / FPS, np.full(frames, 0.98), np.ones(frames), r, c])
+
+def write_au_csv(path, table):
+    fmt = ['%d', '%d', '%.3f', '%.2f', '%d'] + ['%.2f'] * (len(AU_R) + len(AU_C))
+    np.savetxt(path, table, fmt=fmt, delimiter=',', header=','.join(AU_COLUMNS), comments='')
+
+def write_wav(path, rng, seconds):
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    signal = 0.3 * np.sin(2 * np.pi * rng.uniform(150, 400) * t) + rng.normal(0, 0.02, len(t))
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes((np.clip(signal, -1, 1) * 32767).astype(np.int16).tobytes())
+
+def write_video(path, seconds, size, ffmpeg_bin='ffmpeg'):
+    command = [ffmpeg_bin, '-hide_banner', '-loglevel', 'error', '-y',
+               '-f', 'lavfi', '-i', f'testsrc=size={size}:rate={FPS}',
+               '-f', 'lavfi', '-i', 'sine=frequency=220:sample_rate=44100',
+               '-t', str(seconds), '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest', path]
+    subprocess.run(command, check=True, capture_output=True)
+
+def generate_dataset(data_dir, n, seconds=4.0, video_size='320x240', seed=0, ffmpeg_bin='ffmpeg',
+                     openface_latency=0.0):
+    """Write a synthetic dataset of n clips (reused when it already exists with the same settings)."""
+    from PIL import Image
+    from demux import frame_path
+    from au_extraction import find_peak_frame
+
+    settings = {'n': n, 'seconds': seconds, 'video_size': video_size, 'seed': seed,
+                'videos': shutil.which(ffmpeg_bin) is not None, 'openface_latency': openface_latency}
+    meta_path = os.path.join(data_dir, 'dataset.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            if json.load(f)['settings'] == settings:
+                return dataset_paths(data_dir)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    paths = dataset_paths(data_dir)
+    for key in ('video_dir', 'au_source', 'wav_dir', 'frames_dir', 'visual_dir', 'audio_dir', 'caption_dir'):
+        os.makedirs(paths[key], exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    width, height = (int(v) for v in video_size.split('x'))
+    with open(paths['labels'], 'w', newline='') as labels:
+        writer = csv.writer(labels)
+        writer.writerow(['name', 'discrete', 'valence'])
+        for i in range(n):
+            sample_id = f'sample_{i:08d}'
+            csv_path = os.path.join(paths['au_source'], f'{sample_id}.csv')
+            write_au_csv(csv_path, synthetic_au_table(rng, int(seconds * FPS)))
+            write_wav(os.path.join(paths['wav_dir'], f'{sample_id}.wav'), rng, seconds)
+            video_path = os.path.join(paths['video_dir'], f'{sample_id}.mp4')
+            if settings['videos']:
+                write_video(video_path, seconds, video_size, ffmpeg_bin)
+            else:
+                open(video_path, 'wb').close()  # Placeholder: only the stub OpenFace reads the name
+
+            # Peak frame as demux.py would have written it, plus every text output combine reads
+            peak, _ = find_peak_frame(csv_path)
+            pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+            os.makedirs(os.path.join(paths['frames_dir'], sample_id), exist_ok=True)
+            Image.fromarray(pixels).save(frame_path(paths['frames_dir'], sample_id, peak))
+            with open(os.path.join(paths['visual_dir'], f'{sample_id}.csv'), 'w', newline='') as f:
+                csv.writer(f).writerows([['peak_frame_index', 'description'], [peak, STUB_TEXT]])
+            for directory in (paths['audio_dir'], paths['caption_dir']):
+                with open(os.path.join(directory, f'{sample_id}.txt'), 'w') as f:
+                    f.write(STUB_TEXT)
+            writer.writerow([sample_id, ['happy', 'sad', 'neutral', 'angry'][i % 4], round(rng.uniform(-2, 2), 2)])
+
+    with open(paths['openface_stub'], 'w') as f:
+        f.write(STUB_OPENFACE.format(python=sys.executable, latency=openface_latency, source=paths['au_source']))
+    os.chmod(paths['openface_stub'], 0o755)
+    with open(meta_path, 'w') as f:
+        json.dump({'settings': settings}, f, indent=2)
+    return paths
+
+def dataset_paths(data_dir):
+    return {
+        'root': data_dir,
+        'video_dir': os.path.join(data_dir, 'videos'),
+        'au_source': os.path.join(data_dir, 'au'),
+        'wav_dir': os.path.join(data_dir, 'wav'),
+        'frames_dir': os.path.join(data_dir, 'frames'),
+        'visual_dir': os.path.join(data_dir, 'visual_description'),
+        'audio_dir': os.path.join(data_dir, 'audio_description'),
+        'caption_dir': os.path.join(data_dir, 'subtitles'),
+        'labels': os.path.join(data_dir, 'labels.csv'),
+        'openface_stub': os.path.join(data_dir, 'FeatureExtraction'),
+        'meta': os.path.join(data_dir, 'dataset.json'),
+    }
+
+def sample_ids(paths):
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(paths['au_source']) if name.endswith('.csv'))
+
+def has_videos(paths):
+    with open(paths['meta'], 'r') as f:
+        return json.load(f)['settings']['videos']
+
+
+# --- Stub back-ends ---
+def start_model_server(latency, per_item, max_batch, max_wait):
+    """model_server's HTTP handler and MicroBatchers on a free port, with stub model handlers."""
+    import base64
+    import io
+    import threading
+    from http.server import ThreadingHTTPServer
+    from PIL import Image
+    from model_server import MicroBatcher, RequestHandler
+    from transcription import read_wav
+
+    def audio_handler(requests):
+        # Decode the inputs like the real handlers, then stand in for the model call
+        for r in requests:
+            read_wav(r['wav_path'])
+        time.sleep(latency + per_item * len(requests))
+        return [STUB_TEXT] * len(requests)
+
+    def blip2_handler(requests):
+        for r in requests:
+            Image.open(io.BytesIO(base64.b64decode(r['image']))).convert('RGB')
+        time.sleep(latency + per_item * len(requests))
+        return [STUB_TEXT] * len(requests)
+
+    RequestHandler.batchers = {name: MicroBatcher(name, handler, max_batch, max_wait) for name, handler in
+                               (('whisper', audio_handler), ('qwen', audio_handler), ('blip2', blip2_handler))}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'127.0.0.1:{server.server_address[1]}'
+
+def start_openai_stub(latency):
+    """Minimal /v1/chat/completions endpoint that answers every request after `latency` seconds."""
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            time.sleep(latency)
+            body = json.dumps({
+                'id': 'chatcmpl-benchmark', 'object': 'chat.completion', 'created': int(time.time()),
+                'model': request.get('model', 'gpt-4o'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': STUB_TEXT}}],
+                'usage': {'prompt_tokens': 1000, 'completion_tokens': 12, 'total_tokens': 1012},
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+
+# --- Stages: each returns the per-clip latencies and the wall time of the timed part ---
+class Skipped(Exception):
+    pass
+
+def run_items(fn, items, workers=1):
+    def timed(item):
+        start = time.perf_counter()
+        fn(item)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        latencies = list(pool.map(timed, items))
+    return latencies, time.perf_counter() - start
+
+def stage_mp4_to_wav(paths, out_dir, opts):
+    from demux import demux_video
+    if not has_videos(paths):
+        raise Skipped('no synthetic videos (ffmpeg not found)')
+    return run_items(lambda s: demux_video(os.path.join(paths['video_dir'], f'{s}.mp4'),
+                                           os.path.join(out_dir, f'{s}.wav'), ffmpeg_bin=opts['ffmpeg']),
+                     sample_ids(paths), opts['workers'])
+
+def stage_mp4_to_wav_moviepy(paths, out_dir, opts):
+    from mp4_to_wav import convert_one
+    if not has_videos(paths):
+        raise Skipped('no synthetic videos (ffmpeg not found)')
+    return run_items(lambda s: convert_one(os.path.join(paths['video_dir'], f'{s}.mp4'),
+                                           os.path.join(out_dir, f'{s}.wav')),
+                     sample_ids(paths), opts['workers'])
+
+def stage_openface(paths, out_dir, opts):
+    from au_extraction import extract_au_isolated
+    openface_bin = opts['openface_bin'] or paths['openface_stub']
+    if opts['openface_bin'] and not has_videos(paths):
+        raise Skipped('the real OpenFace needs synthetic videos (ffmpeg not found)')
+    return run_items(lambda s: extract_au_isolated(os.path.join(paths['video_dir'], f'{s}.mp4'), out_dir,
+                                                   openface_bin, quiet=True),
+                     sample_ids(paths), opts['workers'])
+
+def stage_find_peak_frame(paths, out_dir, opts):
+    from au_extraction import find_peak_frame
+    return run_items(lambda s: find_peak_frame(os.path.join(paths['au_source'], f'{s}.csv')),
+                     sample_ids(paths), opts['workers'])
+
+def stage_whisper(paths, out_dir, opts):
+    from model_server import ModelClient
+    from transcription import write_transcript
+    server, address = start_model_server(opts['stub_latency'], opts['stub_per_item'], opts['max_batch'],
+                                         opts['max_wait'])
+    client = ModelClient(address)
+    try:
+        return run_items(lambda s: write_transcript(out_dir, s, client.transcribe(
+            os.path.join(paths['wav_dir'], f'{s}.wav'))), sample_ids(paths), opts['concurrency'])
+    finally:
+        server.shutdown()
+
+def stage_qwen_audio(paths, out_dir, opts):
+    from model_server import ModelClient
+
+    server, address = start_model_server(opts['stub_latency'], opts['stub_per_item'], opts['max_batch'],
+                                         opts['max_wait'])
+    client = ModelClient(address)
+
+    def describe(sample_id):
+        text = client.describe_audio(os.path.join(paths['wav_dir'], f'{sample_id}.wav'))
+        with open(os.path.join(out_dir, f'{sample_id}.txt'), 'w') as f:
+            f.write(text)
+
+    try:
+        return run_items(describe, sample_ids(paths), opts['concurrency'])
+    finally:
+        server.shutdown()
+
+def stage_blip2(paths, out_dir, opts):
+    from PIL import Image
+    from model_server import ModelClient
+    from au_extraction import find_peak_frame
+    from demux import frame_path
+    from prompts import VISION_PROMPT
+
+    server, address = start_model_server(opts['stub_latency'], opts['stub_per_item'], opts['max_batch'],
+                                         opts['max_wait'])
+    client = ModelClient(address)
+
+    def describe(sample_id):
+        peak, _ = find_peak_frame(os.path.join(paths['au_source'], f'{sample_id}.csv'))
+        image = Image.open(frame_path(paths['frames_dir'], sample_id, peak)).convert('RGB')
+        text = client.blip2(image, VISION_PROMPT)
+        with open(os.path.join(out_dir, f'{sample_id}.csv'), 'w', newline='') as f:
+            csv.writer(f).writerows([['peak_frame_index', 'description'], [peak, text]])
+
+    try:
+        return run_items(describe, sample_ids(paths), opts['concurrency'])
+    finally:
+        server.shutdown()
+
+def stage_gpt4o(paths, out_dir, opts):
+    server, base_url = start_openai_stub(opts['stub_latency'])
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    os.environ['OPENAI_BASE_URL'] = base_url
+    import openai
+    from async_describer import RateLimiter, describe_sample
+    from prompts import VISION_PROMPT
+
+    args = argparse.Namespace(frames_dir=paths['frames_dir'], payload={'format': 'png'}, cache=None,
+                              cache_max_distance=0, model='gpt-4o', prompt=VISION_PROMPT, max_tokens=500,
+                              max_retries=0, base_delay=1.0, max_delay=60.0, budgets=None, encoding=None)
+    jobs = [(s, os.path.join(paths['video_dir'], f'{s}.mp4'), os.path.join(paths['au_source'], f'{s}.csv'),
+             os.path.join(out_dir, f'{s}.csv')) for s in sample_ids(paths)]
+
+    async def run():
+        client = openai.AsyncOpenAI(base_url=base_url, max_retries=0, timeout=120)
+        limiter = RateLimiter()
+        semaphore = asyncio.Semaphore(opts['concurrency'])
+        # Latency is timed from the moment a request slot is free, like the thread-pool stages
+        slots = asyncio.Semaphore(opts['concurrency'])
+        failures, latencies = [], []
+
+        async def timed(job):
+            async with slots:
+                start = time.perf_counter()
+                await describe_sample(client, limiter, semaphore, job, args, failures)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(timed(job) for job in jobs))
+        finally:
+            await client.close()
+        if failures:
+            raise RuntimeError(f'{len(failures)} requests failed, e.g. {failures[0]["error"]}')
+        return latencies, time.perf_counter() - start
+
+    try:
+        return asyncio.run(run())
+    finally:
+        server.shutdown()
+
+def stage_combine(paths, out_dir, opts):
+    """first_step.json from the AU CSVs plus the final merge, as pipeline.run_combine does it."""
+    from au_extraction import summarize_video
+    import combine_all_results
+
+    combine_all_results.audio_desc_dir = paths['audio_dir']
+    combine_all_results.visual_obj_desc_dir = paths['visual_dir']
+    combine_all_results.caption_dir = paths['caption_dir']
+    start = time.perf_counter()
+    latencies, first_step = [], {}
+    for sample_id in sample_ids(paths):
+        item_start = time.perf_counter()
+        summary = summarize_video(os.path.join(paths['au_source'], f'{sample_id}.csv'))
+        summary['au_data'] = {au: float(v) for au, v in summary['au_data'].items()}
+        first_step[sample_id] = summary
+        latencies.append(time.perf_counter() - item_start)
+    first_step_path = os.path.join(out_dir, 'first_step.json')
+    with open(first_step_path, 'w') as f:
+        json.dump(first_step, f, indent=4)
+    combine_all_results.merge_annotations(first_step_path, os.path.join(out_dir, 'final_annotations.json'),
+                                          paths['labels'])
+    return latencies, time.perf_counter() - start
+
+STAGES = {
+    'mp4_to_wav': stage_mp4_to_wav,
+    'mp4_to_wav_moviepy': stage_mp4_to_wav_moviepy,
+    'openface': stage_openface,
+    'find_peak_frame': stage_find_peak_frame,
+    'whisper': stage_whisper,
+    'qwen_audio': stage_qwen_audio,
+    'blip2': stage_blip2,
+    'gpt4o': stage_gpt4o,
+    'combine': stage_combine,
+}
+DEFAULT_STAGES = [name for name in STAGES if name != 'mp4_to_wav_moviepy']
+
+
+# --- Runner ---
+def max_rss_mb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def _stage_process(stage, paths, opts, results):
+    out_dir = os.path.join(paths['root'], 'out', stage)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    result = {'status': 'ok'}
+    try:
+        # The stages' own progress prints would drown the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            latencies, wall = STAGES[stage](paths, out_dir, opts)
+        latencies = np.asarray(latencies) * 1000
+        result.update({
+            'clips': len(latencies),
+            'seconds': wall,
+            'clips_per_sec': len(latencies) / wall if wall > 0 else None,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+        })
+    except Skipped as e:
+        result = {'status': 'skipped', 'reason': str(e)}
+    except ImportError as e:
+        result = {'status': 'skipped', 'reason': f'missing dependency: {e.name or e}'}
+    except Exception as e:
+        result = {'status': 'error', 'reason': f'{e.__class__.__name__}: {e}'}
+    result['peak_rss_mb'] = max_rss_mb(resource.RUSAGE_SELF)
+    result['peak_child_rss_mb'] = max_rss_mb(resource.RUSAGE_CHILDREN)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    results.put(result)
+
+def run_stage(stage, paths, opts):
+    """Run one stage in a fresh process so its peak RSS is not mixed with other stages."""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_stage_process, args=(stage, paths, opts, results))
+    process.start()
+    try:
+        return results.get(timeout=opts['timeout'])
+    except Exception:
+        process.kill()
+        return {'status': 'error', 'reason': f'no result within {opts["timeout"]}s (exit code {process.exitcode})'}
+    finally:
+        process.join()
+
+def compare_to_baseline(results, baseline, max_regression):
+    """Stages whose throughput fell by more than max_regression (a fraction) against a previous report."""
+    previous = {(r['stage'], r['size']): r for r in baseline['results'] if r['status'] == 'ok'}
+    regressions = []
+    for r in results:
+        old = previous.get((r['stage'], r['size']))
+        if r['status'] != 'ok' or old is None or not old['clips_per_sec']:
+            continue
+        change = r['clips_per_sec'] / old['clips_per_sec'] - 1
+        if change < -max_regression:
+            regressions.append({'stage': r['stage'], 'size': r['size'], 'clips_per_sec': r['clips_per_sec'],
+                                'baseline_clips_per_sec': old['clips_per_sec'], 'change': change})
+    return regressions
+
+def format_row(r):
+    if r['status'] != 'ok':
+        return f"{r['stage']:<20}{r['size']:>7}  {r['status']}: {r['reason']}"
+    return (f"{r['stage']:<20}{r['size']:>7}{r['clips_per_sec']:>11.1f}{r['p50_ms']:>11.1f}{r['p95_ms']:>11.1f}"
+            f"{r['peak_rss_mb']:>11.0f}{r['peak_child_rss_mb']:>11.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-stage throughput, latency and memory on synthetic data')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=DEFAULT_STAGES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100], help='Dataset sizes in clips')
+    parser.add_argument('--work_dir', type=str, default=work_dir, help='Synthetic datasets are written (and reused) here')
+    parser.add_argument('--seconds', type=float, default=4.0, help='Length of every synthetic clip')
+    parser.add_argument('--video_size', type=str, default='320x240')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='Parallel clips for the local stages')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight for the model/API stages')
+    parser.add_argument('--stub_latency_ms', type=float, default=50, help='Fixed latency of every stub model/API call')
+    parser.add_argument('--stub_per_item_ms', type=float, default=5, help='Extra stub model latency per batched item')
+    parser.add_argument('--openface_latency_ms', type=float, default=0, help='Latency of the stub OpenFace binary')
+    parser.add_argument('--max_batch', type=int, default=8)
+    parser.add_argument('--max_wait_ms', type=float, default=50)
+    parser.add_argument('--openface_bin', type=str, help='Optional: benchmark the real OpenFace instead of the stub')
+    parser.add_argument('--ffmpeg', type=str, default='ffmpeg')
+    parser.add_argument('--timeout', type=float, default=3600, help='Seconds before a stage run is abandoned')
+    parser.add_argument('--output', type=str, help='Where to write the JSON report (default: <work_dir>/results.json)')
+    parser.add_argument('--baseline', type=str, help='Optional: earlier report to check for throughput regressions')
+    parser.add_argument('--max_regression', type=float, default=0.2,
+                        help='Allowed drop in clips/sec against the baseline, as a fraction')
+    args = parser.parse_args()
+
+    opts = {'workers': args.workers, 'concurrency': args.concurrency, 'ffmpeg': args.ffmpeg,
+            'openface_bin': args.openface_bin, 'stub_latency': args.stub_latency_ms / 1000,
+            'stub_per_item': args.stub_per_item_ms / 1000, 'max_batch': args.max_batch,
+            'max_wait': args.max_wait_ms / 1000, 'timeout': args.timeout}
+    # Stage processes with MER_TRACE_FILE set write their spans under one run id
+    telemetry.share_run_id()
+    results = []
+    print(f"{'stage':<20}{'clips':>7}{'clips/s':>11}{'p50 ms':>11}{'p95 ms':>11}{'RSS MB':>11}{'child MB':>11}")
+    for size in args.sizes:
+        start = time.time()
+        paths = generate_dataset(os.path.join(args.work_dir, f'size_{size}'), size, args.seconds, args.video_size,
+                                 args.seed, args.ffmpeg, args.openface_latency_ms / 1000)
+        print(f'# dataset of {size} clips ready in {time.time() - start:.1f}s')
+        for stage in args.stages:
+            result = {'stage': stage, 'size': size, **run_stage(stage, paths, opts)}
+            results.append(result)
+            print(format_row(result))
+
+    report = {'config': {**vars(args), 'python': sys.version.split()[0], 'cpus': os.cpu_count()},
+              'results': results}
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            report['regressions'] = compare_to_baseline(results, json.load(f), args.max_regression)
+    output = args.output or os.path.join(args.work_dir, 'results.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nReport written to {output}')
+
+    for r in report.get('regressions', []):
+        print(f"Regression: {r['stage']} at {r['size']} clips: {r['clips_per_sec']:.1f} clips/s "
+              f"vs {r['baseline_clips_per_sec']:.1f} ({r['change']:+.0%})")
+    if report.get('regressions'):
+        sys.exit(1)
@@ -0,0 +1,37 @@
+# Local BLIP-2 loading and captioning.
+#
+# Shared by peak_frame_description.py, model_server.py and cpu_inference.py.
+# Unlike peak_frame_description.py, importing this module creates no OpenAI
+# client, so the BLIP-2 model server and the CPU profile report run offline
+# without an API key.
+
+import torch
+from transformers import Blip2Processor, Blip2ForConditionalGeneration
+
+MODEL_NAME = "Salesforce/blip2-flan-t5-xl"
+
+
+def load_blip2(cpu_profile=None):
+    """BLIP-2 in float16 on a GPU; on CPU float32, or a cpu_inference.py profile (bf16, int8)."""
+    if cpu_profile and not torch.cuda.is_available():
+        from cpu_inference import load_blip2_cpu
+        return load_blip2_cpu(cpu_profile)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    processor = Blip2Processor.from_pretrained(MODEL_NAME)
+    model = Blip2ForConditionalGeneration.from_pretrained(
+        MODEL_NAME,
+        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+    ).to(device)
+    return processor, model, device
+
+def describe_with_blip2(image, prompt, processor, model, device):
+    # Pixel values follow the weights: float16 on GPU, float32 or bfloat16 on CPU
+    inputs = processor(images=image, text=prompt, return_tensors="pt").to(device, model.dtype)
+    generated_ids = model.generate(**inputs)
+    return processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
+
+def describe_batch_with_blip2(images, prompts, processor, model, device):
+    """describe_with_blip2 for several images in one generate call."""
+    inputs = processor(images=images, text=prompts, return_tensors="pt", padding=True).to(device, model.dtype)
+    generated_ids = model.generate(**inputs)
+    return [text.strip() for text in processor.batch_decode(generated_ids, skip_special_tokens=True)]
@@ -0,0 +1,158 @@
+# Token-budget variants of the frame descriptions from a single vision call.
+#
+# The 100/300/500-token ablations used to run peak_frame_description.py once per
+# max_tokens, uploading and describing every frame again each time. A response
+# cut off by max_tokens is the first max_tokens tokens of the longer completion.
+# So one call with the largest budget is enough: every smaller variant is that
+# response truncated to its budget with the model's tokenizer (tiktoken).
+#
+# Each variant is written to <out_dir>_<budget>tokens/<sample_id>.csv in the
+# usual description format, plus its `tokens` count and whether the budget
+# `truncated` it. The describers write variants as they go when `budgets` is set
+# (peak_frame_description.py budgets, async_describer.py and batch_jobs.py ingest
+# --budgets). `derive` does the same for descriptions that already exist.
+# `combine` writes one MER_final_annotations_with_<budget>tokens_peak_frame_desc.json
+# per budget.
+#
+# Usage:
+#   python scripts/budget_variants.py derive --budgets 100 300 500
+#   python scripts/budget_variants.py combine --budgets 100 300 500
+
+import os
+import csv
+import json
+import argparse
+
+DEFAULT_MODEL = 'gpt-4o'
+
+out_dir = './data/MER_test_subset/openai_test_subset_peak_frame_description'
+first_step_path = 'data/MER_test_subset/first_step.json'
+labels_path = 'data/MER_test_subset/test_labels_subset.csv'
+annotations_pattern = 'data/MER_test_subset/MER_final_annotations_with_{budget}tokens_peak_frame_desc.json'
+
+
+def load_encoding(model=DEFAULT_MODEL):
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Newer model names tiktoken does not know yet share GPT-4o's encoding
+        return tiktoken.get_encoding('o200k_base')
+
+def variant_dir(out_dir, budget):
+    return f'{os.path.normpath(out_dir)}_{int(budget)}tokens'
+
+def truncate_to_budgets(text, budgets, encoding):
+    """{budget: {'text', 'tokens', 'truncated'}}: the text cut to each token budget."""
+    tokens = encoding.encode_ordinary(text)
+    variants = {}
+    for budget in sorted(set(int(b) for b in budgets)):
+        kept = tokens[:budget]
+        variants[budget] = {
+            # Untruncated variants keep the exact response text
+            'text': encoding.decode(kept) if len(kept) < len(tokens) else text,
+            'tokens': len(kept),
+            # A response of exactly `budget` tokens most likely hit max_tokens too
+            'truncated': len(tokens) >= budget,
+        }
+    return variants
+
+def write_variant(out_path, frame_index, variant, frame_indices=None):
+    """Description CSV (same columns as vision_io.write_description) plus tokens and truncated."""
+    header = ['peak_frame_index', 'description']
+    row = [frame_index, variant['text']]
+    if frame_indices and len(frame_indices) > 1:
+        header.append('peak_frame_indices')
+        row.append(';'.join(str(i) for i in frame_indices))
+    header += ['tokens', 'truncated']
+    row += [variant['tokens'], int(variant['truncated'])]
+    tmp_path = f'{out_path}.tmp.{os.getpid()}'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerow(row)
+    os.replace(tmp_path, out_path)
+
+def write_variants(out_dir, sample_id, frame_index, text, budgets, encoding, frame_indices=None):
+    """Write every budget variant of one response. Returns {budget: token count}."""
+    counts = {}
+    for budget, variant in truncate_to_budgets(text, budgets, encoding).items():
+        directory = variant_dir(out_dir, budget)
+        os.makedirs(directory, exist_ok=True)
+        write_variant(os.path.join(directory, f'{sample_id}.csv'), frame_index, variant, frame_indices)
+        counts[budget] = variant['tokens']
+    return counts
+
+def read_description_row(path):
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            return row
+    return None
+
+def derive_from_dir(out_dir, budgets, encoding):
+    """Variants of every description CSV already in out_dir. Returns {budget: [token counts]}."""
+    counts = {int(b): [] for b in budgets}
+    for name in sorted(os.listdir(out_dir)):
+        if not name.endswith('.csv'):
+            continue
+        row = read_description_row(os.path.join(out_dir, name))
+        if row is None:
+            continue
+        frame_indices = [int(i) for i in row['peak_frame_indices'].split(';')] if row.get('peak_frame_indices') else None
+        written = write_variants(out_dir, name[:-len('.csv')], row['peak_frame_index'], row['description'].strip(),
+                                 budgets, encoding, frame_indices)
+        for budget, n in written.items():
+            counts[budget].append(n)
+    return counts
+
+def combine_budgets(out_dir, budgets, first_step_path, output_pattern, labels_path=None):
+    """One final annotation file per budget, from that budget's variant folder."""
+    import combine_all_results
+
+    original = combine_all_results.visual_obj_desc_dir
+    written = {}
+    try:
+        for budget in budgets:
+            combine_all_results.visual_obj_desc_dir = variant_dir(out_dir, budget)
+            output_path = output_pattern.format(budget=budget)
+            written[output_path] = combine_all_results.merge_annotations(first_step_path, output_path, labels_path)
+    finally:
+        combine_all_results.visual_obj_desc_dir = original
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Token-budget variants of frame descriptions from one response')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    derive = sub.add_parser('derive', help='Write variants of existing description CSVs')
+    derive.add_argument('--out_dir', type=str, default=out_dir, help='Descriptions made with the largest budget')
+    derive.add_argument('--budgets', nargs='+', type=int, required=True)
+    derive.add_argument('--model', type=str, default=DEFAULT_MODEL, help='Model whose tokenizer counts the budget')
+
+    combine = sub.add_parser('combine', help='Final annotations for every budget')
+    combine.add_argument('--out_dir', type=str, default=out_dir)
+    combine.add_argument('--budgets', nargs='+', type=int, required=True)
+    combine.add_argument('--first_step', type=str, default=first_step_path)
+    combine.add_argument('--labels', type=str, default=labels_path)
+    combine.add_argument('--output_pattern', type=str, default=annotations_pattern)
+
+    args = parser.parse_args()
+
+    if args.command == 'derive':
+        counts = derive_from_dir(args.out_dir, args.budgets, load_encoding(args.model))
+        summary = {}
+        for budget, values in counts.items():
+            summary[budget] = {'descriptions': len(values),
+                               'mean_tokens': sum(values) / len(values) if values else None,
+                               'at_budget': sum(1 for n in values if n >= budget)}
+            print(f"{variant_dir(args.out_dir, budget)}: {len(values)} descriptions, "
+                  f"{summary[budget]['mean_tokens'] or 0:.1f} tokens on average, "
+                  f"{summary[budget]['at_budget']} cut at the budget")
+        with open(os.path.join(args.out_dir, 'budget_variants.json'), 'w') as f:
+            json.dump({'model': args.model, 'budgets': summary}, f, indent=2)
+    else:
+        labels = args.labels if args.labels and os.path.exists(args.labels) else None
+        for path, n in combine_budgets(args.out_dir, args.budgets, args.first_step, args.output_pattern,
+                                       labels).items():
+            print(f'Wrote {n} records to {path}')
@@ -0,0 +1,224 @@
+# Coarse-to-fine OpenFace AU extraction.
+#
+# OpenFace is the most expensive CPU stage, yet only the peak frame is used. In
+# coarse mode a first pass runs OpenFace on every `stride`-th frame (optionally
+# downscaled), candidate peaks are picked on that curve, and a second pass runs
+# OpenFace densely only in windows of +-radius frames around them. Frames are
+# cut with one ffmpeg decode per pass and every window runs in a single OpenFace
+# call (one -fdir per window).
+#
+# The resulting <video>.csv is sparse: it holds the coarse rows plus the dense
+# window rows, with the original frame numbers in its `frame` column, which
+# find_peak_frame/summarize_video and the AU store read. `compare` reports how
+# often the refined peak matches the peak of a dense run.
+#
+# Usage:
+#   python scripts/coarse_au.py extract --stride 5 --windows 3 --openface_bin /path/to/FeatureExtraction
+#   python scripts/coarse_au.py compare --coarse_dir AU_labeling/coarse --dense_dir data/MER_test_subset/test_subset_au
+
+import os
+import glob
+import json
+import time
+import shutil
+import argparse
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+from au_store import compute_peaks, compute_top_peaks, FPS
+
+input_dir = 'data/MER_test_subset/test_subset'
+output_dir = 'AU_labeling/coarse'
+dense_dir = 'data/MER_test_subset/test_subset_au'
+
+DEFAULT_STRIDE = 5
+DEFAULT_WINDOWS = 3
+
+
+def cut_frames(video_path, out_dir, select, scale=None, ffmpeg_bin='ffmpeg'):
+    """Write the frames matching an ffmpeg select expression as numbered BMPs (1-based). Returns their count."""
+    os.makedirs(out_dir, exist_ok=True)
+    vf = f"select='{select}'"
+    if scale:
+        vf += f',scale=iw*{scale}:-2'
+    command = [ffmpeg_bin, '-hide_banner', '-loglevel', 'error', '-y', '-i', video_path, '-map', '0:v:0', '-an',
+               '-vf', vf, '-vsync', '0', '-start_number', '1', os.path.join(out_dir, '%06d.bmp')]
+    subprocess.run(command, check=True, capture_output=True)
+    return len(glob.glob(os.path.join(out_dir, '*.bmp')))
+
+def run_openface(frame_dirs, out_dir, openface_bin_path, timeout=None):
+    """One FeatureExtraction call over image sequences; returns the CSV path of each folder."""
+    command = [openface_bin_path]
+    for frame_dir in frame_dirs:
+        command += ['-fdir', frame_dir]
+    command += ['-aus', '-out_dir', out_dir]
+    subprocess.run(command, check=True, timeout=timeout, stdout=subprocess.DEVNULL)
+    return [os.path.join(out_dir, os.path.basename(os.path.normpath(d)) + '.csv') for d in frame_dirs]
+
+def read_openface_csv(csv_path, frames):
+    """OpenFace CSV of an image sequence with `frame` renumbered to the original (1-based) video frames."""
+    df = pd.read_csv(csv_path)
+    positions = df['frame'].to_numpy(dtype=np.int64) - 1
+    df['frame'] = np.asarray(frames, dtype=np.int64)[positions] + 1
+    return df
+
+
+def coarse_to_fine(video_path, output_dir, openface_bin_path, stride=DEFAULT_STRIDE, scale=None,
+                   windows=DEFAULT_WINDOWS, radius=None, ffmpeg_bin='ffmpeg', timeout=None, fps=FPS):
+    """Two-pass AU extraction for one video; writes <output_dir>/<video>.csv.
+
+    Returns a dict with the refined 'peak_frame' and 'peak_time', the coarse
+    'candidates' and 'openface_frames' (frames OpenFace actually processed).
+    """
+    radius = radius if radius is not None else 2 * stride
+    video_name = os.path.basename(video_path).split('.')[0]
+    work_dir = os.path.join(output_dir, '.work', video_name)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    try:
+        # Pass 1: every stride-th frame
+        coarse_dir = os.path.join(work_dir, 'coarse')
+        n_coarse = cut_frames(video_path, coarse_dir, f'not(mod(n\\,{stride}))', scale, ffmpeg_bin)
+        if n_coarse == 0:
+            raise RuntimeError(f'No frames decoded from {video_path}')
+        coarse_csv, = run_openface([coarse_dir], work_dir, openface_bin_path, timeout)
+        coarse = read_openface_csv(coarse_csv, np.arange(n_coarse) * stride)
+
+        # Candidate peaks on the coarse curve, far enough apart that windows do not overlap
+        picks = compute_top_peaks(coarse.to_numpy(dtype=float), list(coarse.columns), [len(coarse)], windows,
+                                  max(1, (2 * radius) // stride))[0]
+        candidates = [int(coarse['frame'].iloc[p]) - 1 for p in picks]
+
+        # Pass 2: dense windows around the candidates, decoded in one go and split per window
+        spans = [(max(0, c - radius), c + radius) for c in candidates]
+        select = '+'.join(f'between(n\\,{a}\\,{b})' for a, b in spans)
+        all_dir = os.path.join(work_dir, 'windows')
+        cut_frames(video_path, all_dir, select, None, ffmpeg_bin)
+        wanted = sorted({n for a, b in spans for n in range(a, b + 1)})
+        written = sorted(os.listdir(all_dir))
+        # ffmpeg numbers its outputs 1..n, so they map onto `wanted` in order only if no frame is
+        # missing. Frames up to the last coarse one exist; only those after it may lie past the end.
+        required = sum(1 for n in wanted if n <= (n_coarse - 1) * stride)
+        if not required <= len(written) <= len(wanted):
+            raise RuntimeError(f'ffmpeg wrote {len(written)} window frames of {video_path}, '
+                               f'expected {len(wanted)} (at least {required})')
+        frame_of_file = dict(zip(written, wanted))
+        window_dirs, window_frames = [], []
+        for i, (a, b) in enumerate(spans):
+            window_dir = os.path.join(work_dir, f'window{i}')
+            os.makedirs(window_dir)
+            frames = []
+            for name in written:
+                n = frame_of_file[name]
+                if a <= n <= b:
+                    shutil.copy(os.path.join(all_dir, name), os.path.join(window_dir, f'{len(frames) + 1:06d}.bmp'))
+                    frames.append(n)
+            if frames:
+                window_dirs.append(window_dir)
+                window_frames.append(frames)
+        window_csvs = run_openface(window_dirs, work_dir, openface_bin_path, timeout) if window_dirs else []
+        dense = [read_openface_csv(path, frames) for path, frames in zip(window_csvs, window_frames)]
+
+        # Window rows replace coarse rows of the same frame
+        merged = pd.concat(dense + [coarse], ignore_index=True)
+        merged = merged.drop_duplicates(subset='frame', keep='first').sort_values('frame', kind='stable')
+        merged['timestamp'] = (merged['frame'] - 1) / fps
+        merged = merged.reset_index(drop=True)
+
+        csv_path = os.path.join(output_dir, f'{video_name}.csv')
+        merged.to_csv(csv_path + '.tmp', index=False)
+        os.replace(csv_path + '.tmp', csv_path)
+
+        position = int(compute_peaks(merged.to_numpy(dtype=float), list(merged.columns), [len(merged)])[0])
+        peak_frame = int(merged['frame'].iloc[position]) - 1
+        return {
+            'peak_frame': peak_frame,
+            'peak_time': peak_frame / fps,
+            'candidates': candidates,
+            'openface_frames': n_coarse + sum(len(f) for f in window_frames),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare_peaks(coarse_dir, dense_dir, tolerance=2):
+    """Refined vs dense peak for every video present in both folders."""
+    from au_extraction import find_peak_frame
+
+    videos = []
+    for csv_path in sorted(glob.glob(os.path.join(coarse_dir, '*.csv'))):
+        video_name = os.path.splitext(os.path.basename(csv_path))[0]
+        dense_path = os.path.join(dense_dir, f'{video_name}.csv')
+        if not os.path.exists(dense_path):
+            continue
+        refined, _ = find_peak_frame(csv_path)
+        dense, _ = find_peak_frame(dense_path)
+        coarse_rows = len(pd.read_csv(csv_path, usecols=['frame']))
+        dense_rows = len(pd.read_csv(dense_path, usecols=['frame']))
+        videos.append({'video': video_name, 'refined_peak': refined, 'dense_peak': dense,
+                       'offset': refined - dense, 'rows': coarse_rows, 'dense_rows': dense_rows})
+    offsets = np.abs([v['offset'] for v in videos])
+    return {
+        'videos': len(videos),
+        'exact_match_rate': float(np.mean(offsets == 0)) if videos else None,
+        f'within_{tolerance}_frames_rate': float(np.mean(offsets <= tolerance)) if videos else None,
+        'row_fraction': (sum(v['rows'] for v in videos) / sum(v['dense_rows'] for v in videos)) if videos else None,
+        'per_video': videos,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coarse-to-fine OpenFace AU extraction')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    extract = sub.add_parser('extract', help='Run the two-pass extraction over a video folder')
+    extract.add_argument('--data_dir', type=str, default=input_dir)
+    extract.add_argument('--output_dir', type=str, default=output_dir)
+    extract.add_argument('--openface_bin', type=str, required=True)
+    extract.add_argument('--ffmpeg', type=str, default='ffmpeg')
+    extract.add_argument('--stride', type=int, default=DEFAULT_STRIDE, help='Coarse pass uses every stride-th frame')
+    extract.add_argument('--scale', type=float, help='Optional: downscale factor of the coarse pass, e.g. 0.5')
+    extract.add_argument('--windows', type=int, default=DEFAULT_WINDOWS, help='Candidate peaks refined densely')
+    extract.add_argument('--radius', type=int, help='Frames on each side of a candidate (default: 2 * stride)')
+    extract.add_argument('--timeout', type=float, help='Optional: per-OpenFace-call timeout in seconds')
+    extract.add_argument('--limit', type=int, help='Optional: Limit the number of files to process')
+
+    compare = sub.add_parser('compare', help='Match rate of refined peaks against dense OpenFace CSVs')
+    compare.add_argument('--coarse_dir', type=str, default=output_dir)
+    compare.add_argument('--dense_dir', type=str, default=dense_dir)
+    compare.add_argument('--tolerance', type=int, default=2, help='Frames of offset still counted as a match')
+    compare.add_argument('--report', type=str, help='Where to write the JSON report (default: <coarse_dir>/peak_match.json)')
+
+    args = parser.parse_args()
+
+    if args.command == 'extract':
+        os.makedirs(args.output_dir, exist_ok=True)
+        video_files = sorted(glob.glob(os.path.join(args.data_dir, '*.mp4')))
+        if args.limit:
+            video_files = video_files[:args.limit]
+        results = {}
+        start = time.time()
+        for video_path in video_files:
+            video_name = os.path.basename(video_path).split('.')[0]
+            try:
+                results[video_name] = coarse_to_fine(video_path, args.output_dir, args.openface_bin, args.stride,
+                                                     args.scale, args.windows, args.radius, args.ffmpeg, args.timeout)
+            except Exception as e:
+                print(f'Error processing {video_path}: {e}')
+                continue
+            print(f"{video_name}: peak frame {results[video_name]['peak_frame']} "
+                  f"({results[video_name]['openface_frames']} frames through OpenFace)")
+        from au_extraction import remove_work_dir
+        remove_work_dir(args.output_dir)
+        with open(os.path.join(args.output_dir, 'coarse_results.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nProcessed {len(results)}/{len(video_files)} videos in {time.time() - start:.1f}s')
+    else:
+        report = compare_peaks(args.coarse_dir, args.dense_dir, args.tolerance)
+        report_path = args.report or os.path.join(args.coarse_dir, 'peak_match.json')
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"{report['videos']} videos: exact match {report['exact_match_rate']}, "
+              f"within {args.tolerance} frames {report[f'within_{args.tolerance}_frames_rate']}, "
+              f"{report['row_fraction']} of the dense rows")
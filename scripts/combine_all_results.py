@@ -1,6 +1,7 @@
 import os
 import json
 import csv
+import textwrap
 
 # Input and output file paths
 input_path = 'data/MER_test_subset/first_step.json'
@@ -82,11 +83,95 @@ def add_discrete_and_valence_to_annotations(json_path, csv_path, output_path=Non
     with open(out_path, 'w') as f:
         json.dump(data, f, indent=4, ensure_ascii=False)
 
+# --- Single-pass merge ---
+# The functions above stat and open files per sample and rewrite the whole JSON
+# to attach labels. merge_annotations scans each source directory once, joins
+# the labels in the same pass and streams records out one at a time.
+
+def index_dir(directory, suffix):
+    """sample_id -> path for every file with the given suffix, from a single directory scan."""
+    index = {}
+    if not os.path.isdir(directory):
+        return index
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(suffix) and entry.is_file():
+                index[entry.name[:-len(suffix)]] = entry.path
+    return index
+
+def read_text(path):
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+def read_description(path):
+    with open(path, 'r') as f:
+        for row in csv.DictReader(f):
+            return row.get('description', '').strip()
+    return ''
+
+def load_labels(csv_path):
+    """video_id -> {'discrete', 'valence'} from the label CSV."""
+    label_map = {}
+    with open(csv_path, 'r') as f:
+        for row in csv.DictReader(f):
+            label_map[row['name'] + '.mp4'] = {'discrete': row['discrete'], 'valence': float(row['valence'])}
+    return label_map
+
+def iter_final_annotations(first_step, audio_index, visual_index, caption_index, label_map=None):
+    """Final annotation records in first_step order, same fields as convert_first_step_to_final_annotations."""
+    for sample_id, sample in first_step.items():
+        entry = {
+            'video_id': f'{sample_id}.mp4',
+            'peak_time': sample.get('peak_time', 0.0),
+            'visual_expression_description': sample.get('au_phrases', []),
+            'visual_objective_description': read_description(visual_index[sample_id]) if sample_id in visual_index else '',
+            'raw_AU_values_at_peak': sample.get('au_data', {}),
+            'coarse-grained_summary': '',
+            'fine-grained_summary': '',
+            'audio_description': read_text(audio_index[sample_id]) if sample_id in audio_index else '',
+            'caption': read_text(caption_index[sample_id]) if sample_id in caption_index else ''
+        }
+        if label_map and entry['video_id'] in label_map:
+            entry.update(label_map[entry['video_id']])
+        yield entry
+
+def write_records(records, output_path, output_format='jsonl'):
+    """Stream records to output_path. 'json' writes the same bytes as json.dump(list, indent=4)."""
+    tmp_path = f'{output_path}.tmp'
+    count = 0
+    with open(tmp_path, 'w') as f:
+        if output_format == 'jsonl':
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                count += 1
+        else:
+            for record in records:
+                f.write('[\n' if count == 0 else ',\n')
+                f.write(textwrap.indent(json.dumps(record, indent=4, ensure_ascii=False), '    '))
+                count += 1
+            f.write('\n]' if count else '[]')
+    os.replace(tmp_path, output_path)
+    return count
+
+def merge_annotations(input_path, output_path, labels_path=None, output_format=None):
+    """first_step.json + descriptions + captions (+ labels) -> final annotations, in one pass.
+
+    output_format is 'jsonl' or 'json'; by default it follows the output extension.
+    Returns the number of records written.
+    """
+    if output_format is None:
+        output_format = 'jsonl' if output_path.endswith('.jsonl') else 'json'
+    with open(input_path, 'r') as infile:
+        first_step = json.load(infile)
+    label_map = load_labels(labels_path) if labels_path else None
+    records = iter_final_annotations(first_step,
+                                     index_dir(audio_desc_dir, '.txt'),
+                                     index_dir(visual_obj_desc_dir, '.csv'),
+                                     index_dir(caption_dir, '.txt'),
+                                     label_map)
+    return write_records(records, output_path, output_format)
+
 if __name__ == '__main__':
-    convert_first_step_to_final_annotations(input_path, output_path)
-    # Uncomment the following line to run the update
-    add_discrete_and_valence_to_annotations(
-        'data/MER_test_subset/MER_final_annotations.json',
-        'data/MER_test_subset/test_labels_subset.csv'
-    )
-    pass
+    # Same result as convert_first_step_to_final_annotations followed by
+    # add_discrete_and_valence_to_annotations; use a .jsonl output_path for JSONL
+    merge_annotations(input_path, output_path, 'data/MER_test_subset/test_labels_subset.csv')
@@ -0,0 +1,270 @@
+# CPU inference profiles for BLIP-2 and Whisper (and Qwen-Audio in model_server.py).
+#
+# Without a GPU, load_blip2 falls back to float32 blip2-flan-t5-xl and Whisper
+# runs unquantized. A profile picks how the weights run on CPU:
+#   fp32  the baseline, unchanged
+#   bf16  bfloat16 weights for BLIP-2 and Qwen-Audio (half the memory). Whisper keeps its
+#         weights and runs under bfloat16 autocast, because its layers cast
+#         weights to the input dtype.
+#   int8  dynamic int8 quantization of every Linear layer (weights stored as
+#         int8, activations quantized on the fly)
+# configure_threads pins the intra-op thread count. Give several workers on one
+# node cpu_count // workers threads each instead of letting every process
+# start a thread per core.
+#
+# `compare` runs the same clips or frames through several profiles, each in a
+# fresh process. It reports speed and peak RSS, and how close each profile's
+# output is to the fp32 baseline (WER for Whisper, text similarity for BLIP-2).
+#
+# Usage:
+#   python scripts/cpu_inference.py compare whisper --profiles fp32 int8 bf16 --limit 50 --threads 8
+#   python scripts/cpu_inference.py compare blip2 --profiles fp32 int8 --batch_size 8 --limit 20
+
+import os
+import sys
+import json
+import time
+import queue
+import difflib
+import argparse
+import resource
+import contextlib
+import multiprocessing
+
+import torch
+
+PROFILES = ['fp32', 'bf16', 'int8']
+
+
+def configure_threads(threads=None, workers=1):
+    """Intra-op threads of this process: `threads`, or the node's cores split over `workers`."""
+    threads = threads or max(1, (os.cpu_count() or 1) // max(1, workers))
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1 if threads < 4 else 2)
+    except RuntimeError:
+        pass  # Only possible before the first parallel op; keep the default then
+    return threads
+
+def quantize_int8(model):
+    """Dynamic int8 quantization of every nn.Linear (including subclasses such as Whisper's)."""
+    for module in model.modules():
+        # quantize_dynamic only swaps exact nn.Linear modules; Whisper's Linear
+        # subclass only differs by casting weights to the input dtype
+        if isinstance(module, torch.nn.Linear) and type(module) is not torch.nn.Linear:
+            module.__class__ = torch.nn.Linear
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def precision_context(profile):
+    """Context manager the forward passes of a profile run in."""
+    if profile == 'bf16':
+        return lambda: torch.autocast('cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext
+
+def load_whisper(name='base', profile='fp32'):
+    import whisper
+    model = whisper.load_model(name, device='cpu').eval()
+    if profile == 'int8':
+        model = quantize_int8(model)
+    return model
+
+def load_blip2_cpu(profile='fp32', model_name='Salesforce/blip2-flan-t5-xl'):
+    """BLIP-2 for CPU inference in the given profile. Returns (processor, model, device) like load_blip2."""
+    from transformers import Blip2Processor, Blip2ForConditionalGeneration
+    processor = Blip2Processor.from_pretrained(model_name)
+    model = Blip2ForConditionalGeneration.from_pretrained(
+        model_name,
+        torch_dtype=torch.bfloat16 if profile == 'bf16' else torch.float32,
+        low_cpu_mem_usage=True,
+    ).eval()
+    if profile == 'int8':
+        model = quantize_int8(model)
+    return processor, model, torch.device('cpu')
+
+def load_qwen_audio_cpu(profile='fp32', model_name='Qwen/Qwen-Audio-Chat'):
+    """Qwen-Audio-Chat for CPU inference in the given profile. Returns (tokenizer, model) like
+    wav_to_qwen_description.load_model."""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from transformers.generation import GenerationConfig
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    # Qwen's remote code picks its dtype from these flags rather than torch_dtype
+    model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True, device_map='cpu',
+                                                 bf16=profile == 'bf16', fp32=profile != 'bf16').eval()
+    model.generation_config = GenerationConfig.from_pretrained(model_name, trust_remote_code=True)
+    if profile == 'int8':
+        model = quantize_int8(model)
+    return tokenizer, model
+
+
+# --- Quality against the fp32 baseline ---
+def word_error_rate(reference, hypothesis):
+    ref, hyp = reference.lower().split(), hypothesis.lower().split()
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    row = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        previous, row[0] = row[0], i
+        for j, h in enumerate(hyp, 1):
+            previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, previous + (r != h))
+    return row[-1] / len(ref)
+
+def token_f1(reference, hypothesis):
+    ref, hyp = reference.lower().split(), hypothesis.lower().split()
+    if not ref or not hyp:
+        return float(ref == hyp)
+    common = sum(min(ref.count(w), hyp.count(w)) for w in set(ref))
+    if common == 0:
+        return 0.0
+    precision, recall = common / len(hyp), common / len(ref)
+    return 2 * precision * recall / (precision + recall)
+
+def quality(baseline, outputs, kind):
+    """Agreement of one profile's outputs with the baseline outputs (same keys)."""
+    keys = [k for k in baseline if k in outputs]
+    if not keys:
+        return {}
+    mean = lambda values: sum(values) / len(values)
+    report = {'compared': len(keys), 'exact_match': mean([baseline[k].strip() == outputs[k].strip() for k in keys])}
+    if kind == 'whisper':
+        report['wer'] = mean([word_error_rate(baseline[k], outputs[k]) for k in keys])
+    else:
+        report['token_f1'] = mean([token_f1(baseline[k], outputs[k]) for k in keys])
+        report['similarity'] = mean([difflib.SequenceMatcher(None, baseline[k], outputs[k]).ratio() for k in keys])
+    return report
+
+
+# --- Runs, one process per profile ---
+def run_whisper(profile, opts):
+    from transcription import TranscriptionEngine, read_wav
+    wav_files = sorted(f for f in os.listdir(opts['wav_dir']) if f.endswith('.wav'))[:opts['limit']]
+    clips = [(os.path.splitext(f)[0], read_wav(os.path.join(opts['wav_dir'], f)), None) for f in wav_files]
+    start = time.perf_counter()
+    model = load_whisper(opts['model'], profile)
+    load_seconds = time.perf_counter() - start
+    engine = TranscriptionEngine(model, opts['batch_size'], opts['language'],
+                                 precision_context=precision_context(profile))
+    start = time.perf_counter()
+    outputs = engine.transcribe(clips)
+    return outputs, load_seconds, time.perf_counter() - start
+
+def run_blip2(profile, opts):
+    from au_extraction import find_peak_frame
+    from vision_io import load_frame
+    from blip2_model import describe_batch_with_blip2
+    from prompts import VISION_PROMPT
+    videos = sorted(f for f in os.listdir(opts['video_dir']) if f.endswith('.mp4'))
+    items = []
+    for video_file in videos:
+        sample_id = os.path.splitext(video_file)[0]
+        csv_path = os.path.join(opts['csv_dir'], f'{sample_id}.csv')
+        if os.path.exists(csv_path):
+            frame_index, _ = find_peak_frame(csv_path)
+            items.append((sample_id, load_frame(os.path.join(opts['video_dir'], video_file), frame_index,
+                                                opts['frames_dir'])))
+        if len(items) == opts['limit']:
+            break
+    start = time.perf_counter()
+    processor, model, device = load_blip2_cpu(profile)
+    load_seconds = time.perf_counter() - start
+    outputs = {}
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for i in range(0, len(items), opts['batch_size']):
+            batch = items[i:i + opts['batch_size']]
+            texts = describe_batch_with_blip2([image for _, image in batch], [VISION_PROMPT] * len(batch),
+                                              processor, model, device)
+            outputs.update((sample_id, text) for (sample_id, _), text in zip(batch, texts))
+    return outputs, load_seconds, time.perf_counter() - start
+
+RUNS = {'whisper': run_whisper, 'blip2': run_blip2}
+
+def _profile_process(kind, profile, opts, results):
+    try:
+        threads = configure_threads(opts['threads'])
+        outputs, load_seconds, seconds = RUNS[kind](profile, opts)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results.put({'profile': profile, 'status': 'ok', 'threads': threads, 'items': len(outputs),
+                     'load_seconds': load_seconds, 'seconds': seconds,
+                     'items_per_sec': len(outputs) / seconds if seconds > 0 else None,
+                     'peak_rss_mb': rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024,
+                     'outputs': outputs})
+    except Exception as e:
+        results.put({'profile': profile, 'status': 'error', 'error': f'{e.__class__.__name__}: {e}'})
+
+def run_profile(kind, profile, opts):
+    """One profile in a fresh process, so peak RSS and thread settings do not leak between profiles."""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_profile_process, args=(kind, profile, opts, results))
+    process.start()
+    deadline = time.monotonic() + opts['timeout']
+    try:
+        while True:
+            try:
+                return results.get(timeout=min(1.0, max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+            if not process.is_alive():
+                # A crash (e.g. the OOM killer) never puts a result on the queue; allow
+                # a moment for one written just before a normal exit
+                try:
+                    return results.get(timeout=1.0)
+                except queue.Empty:
+                    return {'profile': profile, 'status': 'error',
+                            'error': f'exited without a result (exit code {process.exitcode})'}
+            if time.monotonic() >= deadline:
+                process.kill()
+                process.join()
+                return {'profile': profile, 'status': 'error',
+                        'error': f'no result within {opts["timeout"]}s (exit code {process.exitcode})'}
+    finally:
+        process.join()
+
+def compare_profiles(kind, profiles, opts):
+    """Speed, memory and agreement with the first profile (normally fp32) for every profile."""
+    runs = []
+    for profile in profiles:
+        runs.append(run_profile(kind, profile, opts))
+        print(f"{profile}: {runs[-1].get('items_per_sec') or 0:.2f} items/s, "
+              f"{runs[-1].get('peak_rss_mb') or 0:.0f} MB" if runs[-1]['status'] == 'ok'
+              else f"{profile}: {runs[-1]['error']}")
+
+    baseline = runs[0].get('outputs') if runs and runs[0]['status'] == 'ok' else None
+    for run in runs:
+        if run['status'] == 'ok' and baseline is not None:
+            run['quality'] = quality(baseline, run['outputs'], kind)
+            run['speedup'] = runs[0]['seconds'] / run['seconds'] if run['seconds'] else None
+    return {'kind': kind, 'baseline': profiles[0], 'options': opts, 'runs': runs}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU inference profiles for Whisper and BLIP-2')
+    sub = parser.add_subparsers(dest='command', required=True)
+    compare = sub.add_parser('compare', help='Quality-versus-speed report of several profiles')
+    compare.add_argument('kind', choices=list(RUNS))
+    compare.add_argument('--profiles', nargs='+', choices=PROFILES, default=PROFILES,
+                         help='The first one is the baseline the others are compared with')
+    compare.add_argument('--threads', type=int, help='Intra-op threads (default: all cores)')
+    compare.add_argument('--batch_size', type=int, default=8)
+    compare.add_argument('--limit', type=int, default=50, help='Clips or frames to run')
+    compare.add_argument('--wav_dir', type=str, default='./data/MER_test_subset/test_subset_wav')
+    compare.add_argument('--model', type=str, default='base', help='Whisper model')
+    compare.add_argument('--language', type=str, help='Optional: Whisper language, skips detection')
+    compare.add_argument('--video_dir', type=str, default='./data/MER_test_subset/test_subset')
+    compare.add_argument('--csv_dir', type=str, default='./data/MER_test_subset/test_subset_au')
+    compare.add_argument('--frames_dir', type=str, help='Optional: frames written by demux.py')
+    compare.add_argument('--timeout', type=float, default=3600,
+                         help='Seconds to wait for one profile (including model loading) before giving up')
+    compare.add_argument('--output', type=str, help='Where to write the JSON report (default: cpu_<kind>_report.json)')
+    args = parser.parse_args()
+
+    opts = {k: v for k, v in vars(args).items() if k not in ('command', 'kind', 'profiles', 'output')}
+    report = compare_profiles(args.kind, args.profiles, opts)
+    output = args.output or f'cpu_{args.kind}_report.json'
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    for run in report['runs']:
+        if run['status'] == 'ok' and 'quality' in run:
+            print(f"{run['profile']}: {run['speedup']:.2f}x vs {report['baseline']}, "
+                  + ', '.join(f'{k} {v:.3f}' for k, v in run['quality'].items() if k != 'compared'))
+    print(f'Report written to {output}')
@@ -0,0 +1,153 @@
+# Single-decode demuxer: one ffmpeg pass per video writes the 16 kHz mono WAV
+# and any requested frames (e.g. the AU peak frame) at the same time.
+#
+# This replaces the moviepy path in mp4_to_wav.py (one Python subprocess per
+# clip) and the random cv2 seek in vision_io.extract_frame_by_index.
+#
+# Usage:
+#   python scripts/demux.py --workers 8
+#   python scripts/demux.py --frames_from_au data/MER_test_subset/test_subset_au
+
+import os
+import glob
+import shutil
+import tempfile
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import telemetry
+
+SAMPLE_RATE = 16000
+
+input_dir = 'data/MER_test_subset/test_subset'
+wav_dir = 'data/MER_test_subset/test_subset_wav'
+frames_dir = 'data/MER_test_subset/test_subset_frames'
+
+def frame_path(frames_dir, sample_id, frame_idx):
+    return os.path.join(frames_dir, sample_id, f'{int(frame_idx):06d}.png')
+
+def build_command(video_path, wav_path=None, frame_indices=(), frame_pattern=None, ffmpeg_bin='ffmpeg'):
+    command = [ffmpeg_bin, '-hide_banner', '-loglevel', 'error', '-y', '-i', video_path]
+    if wav_path:
+        command += ['-map', '0:a:0?', '-vn', '-ac', '1', '-ar', str(SAMPLE_RATE), '-c:a', 'pcm_s16le', wav_path]
+    if frame_indices:
+        # select=eq(n\,a)+eq(n\,b) keeps only the requested frame numbers (0-based, same as
+        # the OpenFace row index); the video stream is decoded once and never seeked.
+        select = '+'.join(f'eq(n\\,{int(i)})' for i in sorted(frame_indices))
+        command += ['-map', '0:v:0', '-an', '-vf', f"select='{select}'", '-vsync', '0',
+                    '-start_number', '0', frame_pattern]
+    return command
+
+def demux_video(video_path, wav_path=None, frame_indices=(), frames_dir=None, ffmpeg_bin='ffmpeg'):
+    """Decode one container once. Returns {'wav': path or None, 'frames': {index: path}}."""
+    sample_id = os.path.splitext(os.path.basename(video_path))[0]
+    frame_indices = sorted(set(int(i) for i in frame_indices))
+    result = {'wav': None, 'frames': {}}
+    if wav_path:
+        os.makedirs(os.path.dirname(wav_path) or '.', exist_ok=True)
+
+    tmp_dir = None
+    frame_pattern = None
+    if frame_indices:
+        # ffmpeg numbers selected frames sequentially; write them to a scratch
+        # folder first and rename them to their real frame index afterwards.
+        os.makedirs(os.path.join(frames_dir, sample_id), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f'.{sample_id}_', dir=os.path.join(frames_dir, sample_id))
+        frame_pattern = os.path.join(tmp_dir, '%06d.png')
+
+    try:
+        with telemetry.span('decode', sample_id, frames=len(frame_indices)):
+            command = build_command(video_path, wav_path, frame_indices, frame_pattern, ffmpeg_bin)
+            try:
+                subprocess.run(command, check=True, capture_output=True)
+            except subprocess.CalledProcessError as e:
+                # A video without an audio track leaves the WAV output empty, which ffmpeg
+                # treats as an error; retry for the frames only.
+                if not (frame_indices and b'does not contain any stream' in e.stderr):
+                    raise
+                wav_path = None
+                command = build_command(video_path, None, frame_indices, frame_pattern, ffmpeg_bin)
+                subprocess.run(command, check=True, capture_output=True)
+
+        if wav_path and os.path.exists(wav_path) and os.path.getsize(wav_path) > 0:
+            result['wav'] = wav_path
+        for n, frame_idx in enumerate(frame_indices):
+            tmp_path = os.path.join(tmp_dir, f'{n:06d}.png')
+            if os.path.exists(tmp_path):
+                out_path = frame_path(frames_dir, sample_id, frame_idx)
+                os.replace(tmp_path, out_path)
+                result['frames'][frame_idx] = out_path
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return result
+
+def peak_frames_from_au(csv_dir, sample_id, top_k=1, min_distance=30):
+    from au_extraction import find_peak_frame, find_peak_frames
+    csv_path = os.path.join(csv_dir, f'{sample_id}.csv')
+    if not os.path.exists(csv_path):
+        return []
+    if top_k > 1:
+        return find_peak_frames(csv_path, top_k, min_distance)
+    peak_index, _ = find_peak_frame(csv_path)
+    return [int(peak_index)]
+
+def demux_all(video_files, wav_dir, frames_dir=None, frame_requests=None, workers=4, ffmpeg_bin='ffmpeg'):
+    """Demux many videos with at most `workers` ffmpeg processes running at once.
+
+    frame_requests maps sample_id -> list of frame indices to extract.
+    """
+    frame_requests = frame_requests or {}
+    results = {}
+    os.makedirs(wav_dir, exist_ok=True)
+    # Each job is an ffmpeg child process, so a thread per in-flight job is
+    # enough to keep `workers` decoders busy.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for video_path in video_files:
+            sample_id = os.path.splitext(os.path.basename(video_path))[0]
+            wav_path = os.path.join(wav_dir, f'{sample_id}.wav')
+            futures[pool.submit(demux_video, video_path, wav_path, frame_requests.get(sample_id, ()),
+                                frames_dir, ffmpeg_bin)] = sample_id
+        for future in as_completed(futures):
+            sample_id = futures[future]
+            try:
+                results[sample_id] = future.result()
+                frames = results[sample_id]['frames']
+                print(f'Demuxed {sample_id}: wav={"yes" if results[sample_id]["wav"] else "no audio"}, frames={sorted(frames)}')
+            except subprocess.CalledProcessError as e:
+                print(f'Error processing {sample_id}: {e.stderr.decode(errors="replace").strip()}')
+            except Exception as e:
+                print(f'Error processing {sample_id}: {e}')
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode each video once into a 16 kHz WAV plus requested frames')
+    parser.add_argument('--input_dir', type=str, default=input_dir)
+    parser.add_argument('--wav_dir', type=str, default=wav_dir)
+    parser.add_argument('--frames_dir', type=str, default=frames_dir)
+    parser.add_argument('--frames_from_au', type=str,
+                        help='Optional: OpenFace CSV folder; also extract each video\'s AU peak frame')
+    parser.add_argument('--top_k', type=int, default=1, help='With --frames_from_au: extract this many peak frames')
+    parser.add_argument('--min_distance', type=int, default=30, help='Frames suppressed around each peak')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Maximum number of videos decoded in parallel')
+    parser.add_argument('--ffmpeg', type=str, default='ffmpeg', help='Path to the ffmpeg binary')
+    parser.add_argument('--limit', type=int, help='Optional: Limit the number of files to process')
+    args = parser.parse_args()
+
+    video_files = sorted(glob.glob(os.path.join(args.input_dir, '*.mp4')))
+    if args.limit:
+        video_files = video_files[:args.limit]
+
+    frame_requests = {}
+    if args.frames_from_au:
+        for video_path in video_files:
+            sample_id = os.path.splitext(os.path.basename(video_path))[0]
+            frame_requests[sample_id] = peak_frames_from_au(args.frames_from_au, sample_id, args.top_k,
+                                                           args.min_distance)
+
+    print(f'Found {len(video_files)} video files to process')
+    results = demux_all(video_files, args.wav_dir, args.frames_dir, frame_requests, args.workers, args.ffmpeg)
+    print(f'\nTotal videos demuxed: {len(results)}')
@@ -0,0 +1,145 @@
+# Compact image payloads for the vision requests.
+#
+# The original path sent the full-resolution peak frame as lossless PNG. Here a
+# frame can be cropped to the OpenFace face region, capped in resolution and
+# encoded as JPEG or WebP, and every payload reports its size and the image
+# tokens GPT-4o will bill for it.
+#
+# Usage:
+#   python scripts/image_payload.py frame.png --format jpeg --quality 80 --max_side 768
+
+import io
+import math
+import base64
+import argparse
+
+from PIL import Image
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# Same output as before: full frame, lossless PNG
+DEFAULT_PAYLOAD = {"format": "png", "quality": None, "max_side": None, "crop_face": False, "face_margin": 0.4,
+                   "detail": "auto"}
+
+
+def estimate_image_tokens(width, height, detail="auto"):
+    """Image input tokens GPT-4o charges for a width x height image.
+
+    Low detail is a flat 85 tokens. High detail fits the image in 2048x2048,
+    scales the short side down to 768, and charges 170 per 512px tile plus 85.
+    """
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def face_box_from_row(row, image_size, margin=0.4):
+    """Bounding box (left, top, right, bottom) around OpenFace's 2D landmarks, or None.
+
+    row is one frame of an OpenFace CSV produced with -2Dfp (x_0..x_67, y_0..y_67).
+    margin widens the box by that fraction of its size on each side so hair,
+    forehead and chin stay in view.
+    """
+    xs = [row[f"x_{i}"] for i in range(68) if f"x_{i}" in row]
+    ys = [row[f"y_{i}"] for i in range(68) if f"y_{i}" in row]
+    if not xs or not ys:
+        return None
+    if "success" in row and not row["success"]:
+        return None
+    left, right, top, bottom = min(xs), max(xs), min(ys), max(ys)
+    pad_x, pad_y = (right - left) * margin, (bottom - top) * margin
+    width, height = image_size
+    box = (max(0, int(left - pad_x)), max(0, int(top - pad_y)),
+           min(width, int(math.ceil(right + pad_x))), min(height, int(math.ceil(bottom + pad_y))))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return None
+    return box
+
+def face_box_from_csv(csv_path, frame_index, image_size, margin=0.4):
+    import pandas as pd
+    df = pd.read_csv(csv_path)
+    df.columns = df.columns.str.strip()
+    if "frame" in df.columns:
+        # 1-based video frame numbers; the sparse CSVs of coarse_au.py have no row per frame
+        rows = df[df["frame"] == frame_index + 1]
+        if rows.empty:
+            return None
+        return face_box_from_row(rows.iloc[0], image_size, margin)
+    if frame_index >= len(df):
+        return None
+    return face_box_from_row(df.iloc[frame_index], image_size, margin)
+
+
+def encode_image(image, format="png", quality=None, max_side=None, crop_box=None, detail="auto"):
+    """Encode a PIL image as a data URL.
+
+    Returns a dict with 'url', 'bytes' (encoded size), 'width', 'height' and
+    'image_tokens' (estimated GPT-4o input tokens at the given detail).
+    """
+    format = format.lower()
+    if format == "jpg":
+        format = "jpeg"
+    if format not in MIME_TYPES:
+        raise ValueError(f"Unsupported image format: {format}")
+
+    if crop_box is not None:
+        image = image.crop(crop_box)
+    if max_side and max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if format == "jpeg" and image.mode != "RGB":
+        image = image.convert("RGB")
+
+    save_kwargs = {}
+    if format in ("jpeg", "webp") and quality is not None:
+        save_kwargs["quality"] = quality
+    buffered = io.BytesIO()
+    image.save(buffered, format=format.upper(), **save_kwargs)
+    img_bytes = buffered.getvalue()
+    img_b64 = base64.b64encode(img_bytes).decode("utf-8")
+    return {
+        "url": f"data:{MIME_TYPES[format]};base64,{img_b64}",
+        "bytes": len(img_bytes),
+        "width": image.size[0],
+        "height": image.size[1],
+        "image_tokens": estimate_image_tokens(image.size[0], image.size[1], detail),
+    }
+
+def encode_frame(image, payload=None, csv_path=None, frame_index=None):
+    """encode_image with options from a payload dict (see DEFAULT_PAYLOAD).
+
+    With crop_face, the face box comes from the OpenFace CSV row of the frame;
+    frames without landmarks are sent uncropped.
+    """
+    payload = {**DEFAULT_PAYLOAD, **(payload or {})}
+    crop_box = None
+    if payload["crop_face"] and csv_path is not None and frame_index is not None:
+        crop_box = face_box_from_csv(csv_path, frame_index, image.size, payload["face_margin"])
+    result = encode_image(image, payload["format"], payload["quality"], payload["max_side"], crop_box,
+                          payload["detail"])
+    result["cropped"] = crop_box is not None
+    result["detail"] = payload["detail"]
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show payload size and image tokens for a frame")
+    parser.add_argument("image", type=str)
+    parser.add_argument("--format", type=str, default="png", choices=["png", "jpeg", "webp"])
+    parser.add_argument("--quality", type=int)
+    parser.add_argument("--max_side", type=int)
+    parser.add_argument("--detail", type=str, default="auto", choices=["auto", "low", "high"])
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    original = encode_image(image, detail=args.detail)
+    result = encode_image(image, args.format, args.quality, args.max_side, detail=args.detail)
+    print(f"original: {original['width']}x{original['height']} png, {original['bytes']} bytes, "
+          f"~{original['image_tokens']} image tokens")
+    print(f"encoded:  {result['width']}x{result['height']} {args.format}, {result['bytes']} bytes, "
+          f"~{result['image_tokens']} image tokens")
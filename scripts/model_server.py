@@ -0,0 +1,308 @@
+# Long-lived local inference server for Whisper, Qwen-Audio and BLIP-2.
+#
+# Loading the weights takes minutes, which dominates small incremental runs.
+# This server loads the requested models once and keeps them resident. Requests
+# from any number of client processes are queued per model and run in
+# micro-batches: a worker takes up to --max_batch requests, waiting at most
+# --max_wait_ms for the batch to fill. It listens on localhost HTTP or a Unix socket.
+#
+# Clients send file paths (the server runs on the same node), or a base64 PNG
+# for BLIP-2 frames. With --audio_cache, a WAV path whose file name is a cached
+# sample id is read from that audio_cache.py container instead of the file.
+# wav_to_subtitle.py, wav_to_qwen_description.py and peak_frame_description.py
+# use the server when their model_server setting is set. BLIP-2 comes from
+# blip2_model.py, so no OpenAI key is needed to serve it.
+#
+# Usage:
+#   python scripts/model_server.py --models whisper qwen --port 8765
+#   python scripts/model_server.py --models blip2 --socket /tmp/mer_models.sock
+#
+# Endpoints (JSON in, JSON out):
+#   GET  /health            loaded models and queue lengths
+#   POST /transcribe        {"wav_path": ...}                 -> {"text": ...}
+#   POST /describe_audio    {"wav_path": ..., "prompt": ...}  -> {"text": ...}
+#   POST /blip2             {"image": <base64 png>, "prompt": ...} -> {"text": ...}
+
+import io
+import os
+import json
+import time
+import queue
+import base64
+import socket
+import argparse
+import threading
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future
+
+import telemetry
+
+DEFAULT_PORT = 8765
+MODELS = ["whisper", "qwen", "blip2"]
+
+
+class MicroBatcher:
+    """Queue of requests for one model, drained by a single worker thread in batches."""
+
+    def __init__(self, name, handler, max_batch=8, max_wait=0.05):
+        self.name = name
+        self.handler = handler  # list of request dicts -> list of results, same order
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.requests = 0
+        self.thread = threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        future = Future()
+        self.queue.put((request, future))
+        return future.result()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with telemetry.span("model_server", model=self.name, batch_size=len(batch)):
+                    results = self.handler([request for request, _ in batch])
+                if len(results) != len(batch):
+                    # zip would leave the unmatched requests waiting forever
+                    raise RuntimeError(f"{self.name} handler returned {len(results)} results "
+                                       f"for {len(batch)} requests")
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.batches += 1
+            self.requests += len(batch)
+
+
+# --- Model handlers: load once, then run a whole batch per call ---
+def _read_audio(wav_path, audio_cache=None):
+    from transcription import read_wav
+    sample_id = os.path.splitext(os.path.basename(wav_path))[0]
+    if audio_cache is not None and sample_id in audio_cache:
+        return audio_cache.get(sample_id)
+    return read_wav(wav_path)
+
+def whisper_handler(model_name, cpu_profile=None, audio_cache=None):
+    from transcription import TranscriptionEngine
+    if cpu_profile:
+        from cpu_inference import load_whisper, precision_context
+        engine = TranscriptionEngine(load_whisper(model_name, cpu_profile),
+                                     precision_context=precision_context(cpu_profile))
+    else:
+        from wav_to_subtitle import load_model
+        engine = TranscriptionEngine(load_model(model_name))
+
+    def handle(requests):
+        clips = [(str(i), _read_audio(r["wav_path"], audio_cache), None) for i, r in enumerate(requests)]
+        results = engine.transcribe(clips)
+        return [results[str(i)] for i in range(len(requests))]
+    return handle
+
+def qwen_handler(model_name, cpu_profile=None, audio_cache=None):
+    import contextlib
+    from wav_to_qwen_description import load_model, describe_batch, cached_audio
+    from prompts import AUDIO_DESCRIPTION_PROMPT
+    if cpu_profile:
+        from cpu_inference import load_qwen_audio_cpu
+        tokenizer, model = load_qwen_audio_cpu(cpu_profile, model_name)
+    else:
+        tokenizer, model = load_model(model_name)
+
+    def handle(requests):
+        results = [None] * len(requests)
+        # One generate call per distinct prompt in the batch
+        by_prompt = {}
+        for i, r in enumerate(requests):
+            by_prompt.setdefault(r.get("prompt") or AUDIO_DESCRIPTION_PROMPT, []).append(i)
+        with cached_audio(tokenizer, audio_cache) if audio_cache is not None else contextlib.nullcontext():
+            for prompt, idx in by_prompt.items():
+                responses = describe_batch(tokenizer, model, [requests[i]["wav_path"] for i in idx], prompt)
+                for i, response in zip(idx, responses):
+                    results[i] = response
+        return results
+    return handle
+
+def blip2_handler(model_name=None, cpu_profile=None):
+    from PIL import Image
+    from blip2_model import load_blip2, describe_batch_with_blip2
+    processor, model, device = load_blip2(cpu_profile)
+
+    def handle(requests):
+        images = [Image.open(io.BytesIO(base64.b64decode(r["image"]))).convert("RGB") for r in requests]
+        return describe_batch_with_blip2(images, [r["prompt"] for r in requests], processor, model, device)
+    return handle
+
+HANDLERS = {"whisper": whisper_handler, "qwen": qwen_handler, "blip2": blip2_handler}
+ENDPOINTS = {"/transcribe": "whisper", "/describe_audio": "qwen", "/blip2": "blip2"}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    batchers = {}
+
+    def _send(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        self._send(200, {"models": {name: {"queued": b.queue.qsize(), "batches": b.batches, "requests": b.requests}
+                                    for name, b in self.batchers.items()}})
+
+    def do_POST(self):
+        name = ENDPOINTS.get(self.path)
+        if name is None:
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        if name not in self.batchers:
+            return self._send(503, {"error": f"Model {name} is not loaded on this server"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            text = self.batchers[name].submit(request)
+        except Exception as e:
+            return self._send(500, {"error": f"{e.__class__.__name__}: {e}"})
+        self._send(200, {"text": text})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("local", 0)
+
+
+# --- Client ---
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ModelClient:
+    """Client of a running model_server. address is "host:port" or the path of a Unix socket.
+
+    Each call opens its own connection, so one client can be shared by threads;
+    requests sent concurrently are batched together on the server.
+    """
+
+    def __init__(self, address, timeout=600):
+        self.address = address
+        self.timeout = timeout
+
+    def _connection(self):
+        if os.path.sep in self.address or self.address.endswith(".sock"):
+            return _UnixConnection(self.address, self.timeout)
+        host, _, port = self.address.rpartition(":")
+        return http.client.HTTPConnection(host or "127.0.0.1", int(port), timeout=self.timeout)
+
+    def _call(self, method, path, data=None):
+        conn = self._connection()
+        try:
+            body = json.dumps(data).encode("utf-8") if data is not None else None
+            conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            result = json.loads(response.read())
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError(f"model_server {path} failed ({response.status}): {result.get('error')}")
+        return result
+
+    def health(self):
+        return self._call("GET", "/health")
+
+    def transcribe(self, wav_path):
+        return self._call("POST", "/transcribe", {"wav_path": os.path.abspath(wav_path)})["text"]
+
+    def describe_audio(self, wav_path, prompt=None):
+        return self._call("POST", "/describe_audio", {"wav_path": os.path.abspath(wav_path), "prompt": prompt})["text"]
+
+    def blip2(self, image, prompt):
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        return self._call("POST", "/blip2", {"image": base64.b64encode(buffered.getvalue()).decode("utf-8"),
+                                             "prompt": prompt})["text"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep Whisper, Qwen-Audio and BLIP-2 loaded and serve batched requests")
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=["whisper", "qwen"])
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--socket", type=str, help="Optional: serve on this Unix socket instead of HTTP on a port")
+    parser.add_argument("--whisper_model", type=str, default="base")
+    parser.add_argument("--qwen_model", type=str, default="Qwen/Qwen-Audio-Chat")
+    parser.add_argument("--max_batch", type=int, default=8, help="Most requests run in one model call")
+    parser.add_argument("--max_wait_ms", type=float, default=50, help="How long a batch waits to fill up")
+    parser.add_argument("--cpu_profile", type=str, choices=["fp32", "bf16", "int8"],
+                        help="Optional: Whisper, Qwen-Audio and BLIP-2 weights on CPU (see cpu_inference.py)")
+    parser.add_argument("--threads", type=int, help="Optional: intra-op CPU threads of the server")
+    parser.add_argument("--audio_cache", type=str,
+                        help="Optional: read Whisper and Qwen-Audio clips from this audio_cache.py container")
+    args = parser.parse_args()
+
+    if args.cpu_profile or args.threads:
+        from cpu_inference import configure_threads
+        print(f"Using {configure_threads(args.threads)} CPU threads")
+    model_names = {"whisper": args.whisper_model, "qwen": args.qwen_model, "blip2": None}
+    audio_cache = None
+    if args.audio_cache:
+        from audio_cache import AudioCache
+        audio_cache = AudioCache(args.audio_cache)
+    for name in args.models:
+        start = time.time()
+        options = {"audio_cache": audio_cache} if name in ("whisper", "qwen") else {}
+        handler = HANDLERS[name](model_names[name], args.cpu_profile, **options)
+        RequestHandler.batchers[name] = MicroBatcher(name, handler, args.max_batch, args.max_wait_ms / 1000)
+        print(f"Loaded {name} in {time.time() - start:.1f}s")
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, RequestHandler)
+        print(f"Serving {', '.join(args.models)} on {args.socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        print(f"Serving {', '.join(args.models)} on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -1,144 +1,269 @@
 # NOTE: used this file to extract the data in the test_subset_peak_frame_description folder
 
-import cv2
-from PIL import Image
 import torch
-from transformers import Blip2Processor, Blip2ForConditionalGeneration
-import pandas as pd
 import os
-import csv
 import openai
-import base64
-import io
 import warnings
 from dotenv import load_dotenv
 
+import telemetry
+from prompts import VISION_PROMPT, multi_frame_prompt
+from au_extraction import find_peak_frame, find_peak_frames
+from image_payload import encode_frame, DEFAULT_PAYLOAD
+from vision_io import load_frame, load_frames, build_vision_messages, write_description
+from response_cache import ResponseCache, cached_describe
+from blip2_model import load_blip2, describe_with_blip2, describe_batch_with_blip2
+
 load_dotenv()  # Load environment variables from .env file
 openai.api_key = os.getenv("OPENAI_API_KEY")
 client = openai.OpenAI()  # Uses api_key from env
 
-def find_peak_frame(au_data_path):
-    # === LOAD AU DATA ===
-    df = pd.read_csv(au_data_path)
-
-    # Extract AU presence and intensity columns
-    au_presence_cols = [col for col in df.columns if "_c" in col]
-    au_intensity_cols = [col for col in df.columns if "_r" in col]
-
-    # Step 1: Identify most frequently occurring AUs
-    au_frequencies = df[au_presence_cols].sum().sort_values(ascending=False)
-    most_frequent_aus = au_frequencies.head(3).index.str.replace("_c", "")
-
-    # Step 2: Sum the intensity values of these AUs for each frame
-    relevant_intensity_cols = [au + "_r" for au in most_frequent_aus]
-    df["emotion_sum"] = df[relevant_intensity_cols].sum(axis=1)
-
-    # Step 3: Find emotional peak frame
-    peak_frame_index = df["emotion_sum"].idxmax()
-    return peak_frame_index, peak_frame_index/30
-
-# --- Step 1: Extract specific frame ---
-def extract_frame_by_index(video_path, frame_idx):
-    cap = cv2.VideoCapture(video_path)
-    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-    ret, frame = cap.read()
-    cap.release()
-
-    if not ret:
-        raise ValueError(f"Could not read frame at index {frame_idx}.")
-    
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    return Image.fromarray(frame_rgb)
-
-# --- Step 2: Load BLIP-2 model ---
-def load_blip2():
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    processor = Blip2Processor.from_pretrained("Salesforce/blip2-flan-t5-xl")
-    model = Blip2ForConditionalGeneration.from_pretrained(
-        "Salesforce/blip2-flan-t5-xl",
-        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-    ).to(device)
-    return processor, model, device
-
-def describe_image_with_openai(image, prompt):
+def describe_image_with_openai(image, prompt, model="gpt-4o", max_tokens=500, encoded=None):
     """
     Describe an image using OpenAI's GPT-4 Vision API.
     Args:
-        image (PIL.Image): The image to describe.
+        image (PIL.Image or list): The image to describe, or several frames sent in one request.
         prompt (str): The prompt to send to the model.
+        model (str): The OpenAI model name.
+        max_tokens (int): Completion token budget.
+        encoded (dict or list): Optional payload(s) from image_payload.encode_frame; defaults to full-size PNGs.
     Returns:
         str: The generated description.
     """
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    img_bytes = buffered.getvalue()
-    img_b64 = base64.b64encode(img_bytes).decode("utf-8")
-
+    images = image if isinstance(image, list) else [image]
+    if encoded is None:
+        encoded = [encode_frame(i) for i in images]
+    encoded = encoded if isinstance(encoded, list) else [encoded]
     response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img_b64}"}}
-                ]
-            }
-        ],
-        max_tokens=500,
+        model=model,
+        messages=build_vision_messages([e["url"] for e in encoded], prompt, encoded[0].get("detail", "auto")),
+        max_tokens=max_tokens,
     )
+    telemetry.record_usage(response.model or model, response.usage)
     return response.choices[0].message.content
 
+def describe_video(video_path, csv_path, out_path, prompt=VISION_PROMPT, use_openai=True, blip2=None,
+                   model="gpt-4o", max_tokens=500, frames_dir=None, frame_index=None, payload=None,
+                   cache=None, cache_max_distance=0, model_server=None, top_k=1, min_distance=30,
+                   frame_indices=None, budgets=None):
+    """Describe the AU peak frame of one video and save the result to out_path.
+
+    Pass frame_index (e.g. from au_store.AUStore.peaks) to skip re-reading csv_path.
+    With top_k > 1, GPT-4o gets the top_k peaks of the clip (non-maximum
+    suppression within min_distance frames, see au_store.top_k_peaks) in one
+    request, decoded in a single pass; pass frame_indices to skip the CSV.
+    With a response_cache.ResponseCache, frames already described with the same
+    model, prompt, max_tokens and payload are not sent again. With a
+    model_server.ModelClient, BLIP-2 runs on the warm model server. With budgets
+    (e.g. [100, 300, 500]) GPT-4o is called once with the largest one and every
+    budget's variant is written next to out_dir (see budget_variants.py).
+    """
+    if budgets and use_openai:
+        max_tokens = max(budgets)
+    sample_id = os.path.splitext(os.path.basename(video_path))[0]
+    with telemetry.span("frame", sample_id):
+        if top_k > 1 and use_openai and frame_indices is None:
+            frame_indices = find_peak_frames(csv_path, top_k, min_distance)
+        if top_k > 1 and use_openai and frame_indices:
+            frame_index = frame_indices[0]
+            images = load_frames(video_path, frame_indices, frames_dir)
+        else:
+            # A single peak, also when no top-k peaks were found
+            if frame_index is None:
+                frame_index, time = find_peak_frame(csv_path)
+            frame_indices = [frame_index]
+            images = [load_frame(video_path, frame_index, frames_dir)]
+    image = images[0]
+    if use_openai:
+        request_prompt = multi_frame_prompt(prompt, len(images))
+        def describe():
+            with telemetry.span("gpt4o", sample_id, frames=len(images)):
+                encoded = [encode_frame(img, payload, csv_path, idx) for img, idx in zip(images, frame_indices)]
+                print(f"Payload: {len(encoded)} x {encoded[0]['width']}x{encoded[0]['height']}, "
+                      f"{sum(e['bytes'] for e in encoded)} bytes, ~{sum(e['image_tokens'] for e in encoded)} image tokens")
+                return describe_image_with_openai(images, request_prompt, model=model, max_tokens=max_tokens,
+                                                  encoded=encoded)
+        extra = {**DEFAULT_PAYLOAD, **(payload or {})}
+        if len(images) > 1:
+            # The cache is keyed by the first frame; the context frames are part of the request too
+            from response_cache import dhash
+            extra["context_frames"] = [dhash(img) for img in images[1:]]
+        generated_text = cached_describe(cache, image, describe, model, request_prompt, max_tokens,
+                                         extra=extra, max_distance=cache_max_distance, clip=sample_id)
+    elif model_server is not None:
+        with telemetry.span("blip2", sample_id, server=True):
+            generated_text = model_server.blip2(image, prompt)
+    else:
+        if blip2 is None or None in blip2:
+            raise RuntimeError("BLIP-2 model is not available.")
+        with telemetry.span("blip2", sample_id):
+            generated_text = describe_with_blip2(image, prompt, *blip2)
+    # Save result to CSV
+    write_description(out_path, frame_index, generated_text, frame_indices)
+    if budgets and use_openai:
+        from budget_variants import load_encoding, write_variants
+        write_variants(os.path.dirname(out_path), sample_id, frame_index, generated_text, budgets,
+                       load_encoding(model), frame_indices)
+    return generated_text
+
+def describe_videos_with_blip2(jobs, prompt, blip2, frames_dir=None, batch_size=8):
+    """Local BLIP-2 for many videos, batch_size peak frames per generate call.
+
+    jobs are (video_path, csv_path, out_path, frame_index or None) tuples; each
+    description is written like describe_video does. Returns the out_paths written.
+    """
+    if blip2 is None or None in blip2:
+        raise RuntimeError("BLIP-2 model is not available.")
+    written = []
+    for start in range(0, len(jobs), batch_size):
+        frames = []
+        for video_path, csv_path, out_path, frame_index in jobs[start:start + batch_size]:
+            sample_id = os.path.splitext(os.path.basename(video_path))[0]
+            try:
+                with telemetry.span("frame", sample_id):
+                    if frame_index is None:
+                        frame_index, _ = find_peak_frame(csv_path)
+                    frames.append((sample_id, out_path, frame_index, load_frame(video_path, frame_index, frames_dir)))
+            except Exception as e:
+                print(f"Error processing {video_path}: {e}")
+        if not frames:
+            continue
+        try:
+            with telemetry.span("blip2", samples=[f[0] for f in frames], batch_size=len(frames)), \
+                    torch.inference_mode():
+                texts = describe_batch_with_blip2([f[3] for f in frames], [prompt] * len(frames), *blip2)
+        except Exception as e:
+            # e.g. out of memory at this batch size: describe the batch's frames one at a time instead
+            print(f"Batch of {len(frames)} failed ({e.__class__.__name__}: {e}); describing frames one by one")
+            texts = []
+            for sample_id, _, _, image in frames:
+                try:
+                    with telemetry.span("blip2", sample_id), torch.inference_mode():
+                        texts.append(describe_with_blip2(image, prompt, *blip2).strip())
+                except Exception as e:
+                    print(f"Error processing {sample_id}: {e}")
+                    texts.append(None)
+        for (sample_id, out_path, frame_index, _), text in zip(frames, texts):
+            if text is None:
+                continue
+            try:
+                write_description(out_path, frame_index, text)
+            except OSError as e:
+                print(f"Error processing {sample_id}: {e}")
+                continue
+            written.append(out_path)
+    return written
+
 # --- Config ---
 video_dir = "./data/MER_test_subset/test_subset"
 csv_dir = "./data/MER_test_subset/test_subset_au"
 out_dir = "./data/MER_test_subset/openai_test_subset_peak_frame_description"
-prompt = "Describe what is happening in this video frame as if you're narrating it to someone who cannot see it. Focus only on visible details such as people's actions, facial expressions, gestures, body language, clothing, objects, and the physical setting. Be specific about how people are positioned and how they interact with each other and their surroundings. Write descriptively—do not simply list objects. Include visual cues that might suggest emotional states, but don't speculate beyond what's visible."
+frames_dir = "./data/MER_test_subset/test_subset_frames"  # written by demux.py --frames_from_au
+au_store_dir = "./data/MER_test_subset/au_store"  # written by au_store.py build
+prompt = VISION_PROMPT
 
-os.makedirs(out_dir, exist_ok=True)
+# --- Image payload sent to GPT-4o (see image_payload.DEFAULT_PAYLOAD) ---
+# e.g. {"format": "jpeg", "quality": 85, "max_side": 768, "crop_face": True}; face crops need
+# OpenFace landmarks (au_extraction.py --landmarks)
+payload = {"format": "png"}
 
-video_files = [f for f in os.listdir(video_dir) if f.endswith('.mp4')]
+# --- Response cache; set cache_read_only for reproducible runs that never call the API for cached frames ---
+response_cache_path = "./data/MER_test_subset/response_cache.sqlite"  # None disables the cache
+cache_read_only = False
+cache_max_distance = 0  # opt-in: also reuse frames of the same clip whose perceptual hash differs in up to this many bits (0: identical frames only)
 
-# Only process the first 2 videos for testing
-# video_files = video_files[:2]
+# --- Peak frames per video sent to GPT-4o together (1 = only the AU peak, as before) ---
+top_k = 1
+min_distance = 30  # frames suppressed around each picked peak
+
+# --- Token budgets derived from one call, e.g. [100, 300, 500]; None describes with max_tokens only ---
+budgets = None
 
 # --- Parameter to control which model to use ---
 use_openai = True  # Set to False to use BLIP-2
+model_server = None  # e.g. "127.0.0.1:8765" to use BLIP-2 on a running model_server.py instead of loading it
+cpu_profile = None  # without a GPU: "fp32", "bf16" or "int8" BLIP-2 weights (see cpu_inference.py)
+cpu_threads = None  # intra-op threads for local BLIP-2 (None: torch's default)
+blip2_batch_size = 8  # peak frames per local BLIP-2 generate call
 
-# Load BLIP-2 only if needed
-if not use_openai:
-    try:
-        processor, model, device = load_blip2()
-    except Exception as e:
-        warnings.warn(f"BLIP-2 model could not be loaded: {e}")
-        processor = model = device = None
-
-for video_file in video_files:
-    base_name = os.path.splitext(video_file)[0]
-    video_path = os.path.join(video_dir, video_file)
-    csv_path = os.path.join(csv_dir, base_name + ".csv")
-    out_path = os.path.join(out_dir, base_name + ".csv")
-
-    if not os.path.exists(csv_path):
-        print(f"CSV not found for {video_file}, skipping.")
-        continue
-
-    try:
-        frame_index, time = find_peak_frame(csv_path)
-        image = extract_frame_by_index(video_path, frame_index)
-        if use_openai:
-            generated_text = describe_image_with_openai(image, prompt)
-        else:
-            if processor is None or model is None or device is None:
-                raise RuntimeError("BLIP-2 model is not available.")
-            inputs = processor(images=image, text=prompt, return_tensors="pt").to(device, torch.float16 if torch.cuda.is_available() else torch.float32)
-            generated_ids = model.generate(**inputs)
-            generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        # Save result to CSV
-        with open(out_path, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(["peak_frame_index", "description"])
-            writer.writerow([frame_index, generated_text])
-        print(f"Saved: {out_path}")
-    except Exception as e:
-        print(f"Error processing {video_file}: {e}")
\ No newline at end of file
+# --- "sync" calls the API per video; "batch" only writes OpenAI Batch API files (see batch_jobs.py) ---
+mode = "sync"
+batch_dir = "./data/MER_test_subset/batch"
+
+if __name__ == "__main__" and mode == "batch":
+    from batch_jobs import build_batch_files
+    manifest = build_batch_files(video_dir, csv_dir, batch_dir, prompt, frames_dir=frames_dir, payload=payload)
+    print(f"Wrote {sum(len(s['custom_ids']) for s in manifest['shards'])} requests to {batch_dir}; "
+          f"run `python scripts/batch_jobs.py ingest` on the results")
+
+elif __name__ == "__main__":
+    os.makedirs(out_dir, exist_ok=True)
+
+    video_files = [f for f in os.listdir(video_dir) if f.endswith('.mp4')]
+
+    # Only process the first 2 videos for testing
+    # video_files = video_files[:2]
+
+    # Load BLIP-2 only if needed
+    blip2 = None
+    server = None
+    if not use_openai and model_server:
+        from model_server import ModelClient
+        server = ModelClient(model_server)
+    elif not use_openai:
+        if cpu_profile or cpu_threads:
+            from cpu_inference import configure_threads
+            print(f"Using {configure_threads(cpu_threads)} CPU threads")
+        try:
+            blip2 = load_blip2(cpu_profile)
+        except Exception as e:
+            warnings.warn(f"BLIP-2 model could not be loaded: {e}")
+
+    cache = None
+    if use_openai and response_cache_path and (not cache_read_only or os.path.exists(response_cache_path)):
+        cache = ResponseCache(response_cache_path, read_only=cache_read_only)
+
+    # Peak frames for every video in one call when the AU store has been built
+    peak_frames = {}
+    if os.path.exists(os.path.join(au_store_dir, "index.json")):
+        from au_store import AUStore
+        au_store = AUStore(au_store_dir)
+        peaks = au_store.peaks()
+        peak_frames = {v: int(p) for v, p in zip(peaks['video_ids'], peaks['peak_frame']) if p >= 0}
+        top_frames = au_store.top_peaks(k=top_k, min_distance=min_distance) if top_k > 1 else {}
+    else:
+        top_frames = {}
+
+    blip2_jobs = []
+    for video_file in video_files:
+        base_name = os.path.splitext(video_file)[0]
+        video_path = os.path.join(video_dir, video_file)
+        csv_path = os.path.join(csv_dir, base_name + ".csv")
+        out_path = os.path.join(out_dir, base_name + ".csv")
+
+        if base_name not in peak_frames and not os.path.exists(csv_path):
+            print(f"CSV not found for {video_file}, skipping.")
+            continue
+
+        if blip2 is not None:
+            # Local BLIP-2 describes several frames per generate call below
+            blip2_jobs.append((video_path, csv_path, out_path, peak_frames.get(base_name)))
+            continue
+
+        try:
+            describe_video(video_path, csv_path, out_path, prompt, use_openai=use_openai, blip2=blip2,
+                           frames_dir=frames_dir, frame_index=peak_frames.get(base_name), payload=payload,
+                           cache=cache, cache_max_distance=cache_max_distance, model_server=server,
+                           top_k=top_k, min_distance=min_distance, frame_indices=top_frames.get(base_name) or None,
+                           budgets=budgets)
+            print(f"Saved: {out_path}")
+        except Exception as e:
+            print(f"Error processing {video_file}: {e}")
+
+    if blip2_jobs:
+        for path in describe_videos_with_blip2(blip2_jobs, prompt, blip2, frames_dir, blip2_batch_size):
+            print(f"Saved: {path}")
+
+    if cache is not None:
+        stats = cache.stats()["session"]
+        print(f"Cache: {stats['hits']} hits, {stats['near_hits']} near hits, {stats['misses']} misses")
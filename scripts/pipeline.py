@@ -0,0 +1,380 @@
+# Content-addressed, resumable runner that chains every stage in scripts/.
+#
+# Each (stage, sample) pair gets a key that hashes the input video, the stage
+# parameters (model names, prompts, token budgets) and the outputs of the
+# upstream stages it depends on. After a sample finishes a stage we write a
+# small stamp file with that key; on the next run the stage is skipped when the
+# stamp still matches, so a crash only loses the sample that was in flight and
+# changing e.g. the GPT-4o prompt only re-runs the vision-description stage.
+#
+# Usage:
+#   python scripts/pipeline.py --openface_bin /path/to/FeatureExtraction
+#   python scripts/pipeline.py --stages visual_description combine --dry_run
+
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import telemetry
+from prompts import VISION_PROMPT, AUDIO_DESCRIPTION_PROMPT
+
+DATA_ROOT = 'data/MER_test_subset'
+STATE_DIR_NAME = '.pipeline'
+
+# Stage graph. Output paths are relative to the data root and follow the folders
+# the individual scripts already write to.
+STAGES = {
+    'wav': {
+        'deps': [],
+        'output': 'test_subset_wav/{sample_id}.wav',
+        'params': {'decoder': 'ffmpeg', 'sample_rate': 16000, 'channels': 1, 'codec': 'pcm_s16le'},
+    },
+    'subtitle': {
+        'deps': ['wav'],
+        'output': 'test_subtitles/{sample_id}.txt',
+        'params': {'whisper_model': 'base', 'engine': 'batched'},
+    },
+    'audio_description': {
+        'deps': ['wav'],
+        'output': 'test_subset_gwen_description/{sample_id}.txt',
+        'params': {'model': 'Qwen/Qwen-Audio-Chat', 'prompt': AUDIO_DESCRIPTION_PROMPT},
+    },
+    'au': {
+        'deps': [],
+        'output': 'test_subset_au/{sample_id}.csv',
+        'params': {'openface_flags': ['-aus']},
+    },
+    'visual_description': {
+        'deps': ['au'],
+        'output': 'openai_test_subset_peak_frame_description/{sample_id}.csv',
+        'params': {'model': 'gpt-4o', 'prompt': VISION_PROMPT, 'max_tokens': 500, 'payload': {'format': 'png'}},
+    },
+}
+STAGE_ORDER = ['wav', 'subtitle', 'audio_description', 'au', 'visual_description']
+
+# The combine stage is not per-sample: it depends on every sample's outputs.
+COMBINE_DEPS = ['subtitle', 'audio_description', 'au', 'visual_description']
+COMBINE_OUTPUT = 'MER_final_annotations.json'
+
+
+# --- Hashing helpers ---
+def sha256_file(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def sha256_json(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def atomic_write_json(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp.{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def load_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+class VideoHashCache:
+    """Remembers video content hashes by (size, mtime) so unchanged videos are not re-read every run."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_json(path, {})
+        self.dirty = False
+
+    def get(self, video_path):
+        st = os.stat(video_path)
+        key = os.path.abspath(video_path)
+        entry = self.entries.get(key)
+        if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return entry['sha256']
+        digest = sha256_file(video_path)
+        self.entries[key] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': digest}
+        self.dirty = True
+        return digest
+
+    def save(self):
+        if self.dirty:
+            atomic_write_json(self.path, self.entries)
+            self.dirty = False
+
+
+# --- Stage implementations ---
+# Each runner gets (ctx, sample_id, video_path, output_path). Heavy imports and
+# model loading happen lazily, the first time a stage actually has work to do.
+
+def run_wav(ctx, sample_id, video_path, output_path):
+    from demux import demux_video
+    if not demux_video(video_path, output_path, ffmpeg_bin=ctx['ffmpeg_bin'])['wav']:
+        raise RuntimeError(f'No audio track found in {video_path}')
+
+def run_subtitle(ctx, sample_id, video_path, output_path):
+    if 'whisper' not in ctx['models']:
+        from wav_to_subtitle import load_model
+        from transcription import TranscriptionEngine
+        ctx['models']['whisper'] = TranscriptionEngine(load_model(ctx['params']['subtitle']['whisper_model']))
+    from transcription import read_wav, write_transcript
+    # The WAV stage already wrote 16 kHz PCM, so it is read directly instead of through ffmpeg
+    results = ctx['models']['whisper'].transcribe([(sample_id, read_wav(stage_output(ctx, 'wav', sample_id)), None)])
+    write_transcript(os.path.dirname(output_path), sample_id, results[sample_id])
+
+def run_audio_description(ctx, sample_id, video_path, output_path):
+    params = ctx['params']['audio_description']
+    if 'qwen' not in ctx['models']:
+        from wav_to_qwen_description import load_model
+        ctx['models']['qwen'] = load_model(params['model'])
+    from wav_to_qwen_description import describe_audio
+    tokenizer, model = ctx['models']['qwen']
+    describe_audio(tokenizer, model, stage_output(ctx, 'wav', sample_id), output_path, prompt=params['prompt'])
+
+def run_au(ctx, sample_id, video_path, output_path):
+    from au_extraction import extract_au_isolated
+    if not ctx['openface_bin']:
+        raise RuntimeError('--openface_bin is required to run the au stage')
+    extract_au_isolated(video_path, os.path.dirname(output_path), ctx['openface_bin'])
+    if not os.path.exists(output_path):
+        raise RuntimeError(f'OpenFace did not write {output_path}')
+
+def run_visual_description(ctx, sample_id, video_path, output_path):
+    from peak_frame_description import describe_video
+    params = ctx['params']['visual_description']
+    describe_video(video_path, stage_output(ctx, 'au', sample_id), output_path, prompt=params['prompt'],
+                   model=params['model'], max_tokens=params['max_tokens'], payload=params['payload'])
+
+RUNNERS = {
+    'wav': run_wav,
+    'subtitle': run_subtitle,
+    'audio_description': run_audio_description,
+    'au': run_au,
+    'visual_description': run_visual_description,
+}
+
+def run_combine(ctx, sample_ids, output_path):
+    from au_extraction import summarize_video
+    import combine_all_results
+
+    # Rebuild first_step.json from the per-sample AU CSVs
+    first_step = {}
+    for sample_id in sample_ids:
+        csv_path = stage_output(ctx, 'au', sample_id)
+        if not os.path.exists(csv_path):
+            continue
+        summary = summarize_video(csv_path)
+        summary['au_data'] = {au: float(v) for au, v in summary['au_data'].items()}
+        first_step[sample_id] = summary
+    first_step_path = os.path.join(ctx['data_root'], 'first_step.json')
+    atomic_write_json(first_step_path, first_step)
+
+    combine_all_results.audio_desc_dir = os.path.dirname(stage_output(ctx, 'audio_description', ''))
+    combine_all_results.visual_obj_desc_dir = os.path.dirname(stage_output(ctx, 'visual_description', ''))
+    combine_all_results.caption_dir = os.path.dirname(stage_output(ctx, 'subtitle', ''))
+    labels = ctx['labels'] if ctx['labels'] and os.path.exists(ctx['labels']) else None
+    combine_all_results.merge_annotations(first_step_path, output_path, labels)
+
+
+# --- Graph bookkeeping ---
+def stage_output(ctx, stage, sample_id):
+    return os.path.join(ctx['data_root'], STAGES[stage]['output'].format(sample_id=sample_id))
+
+def stamp_path(ctx, stage, sample_id):
+    return os.path.join(ctx['state_dir'], stage, f'{sample_id}.json')
+
+def stage_key(ctx, stage, sample_id, video_hash):
+    """Key of a stage for one sample, or None if an upstream stage has not completed yet."""
+    upstream = {}
+    for dep in STAGES[stage]['deps']:
+        stamp = load_json(stamp_path(ctx, dep, sample_id))
+        if stamp is None or stamp.get('key') != ctx['keys'].get((dep, sample_id)):
+            return None
+        upstream[dep] = stamp['output_sha256']
+    return sha256_json({
+        'stage': stage,
+        'params': ctx['params'][stage],
+        'video': video_hash,
+        'upstream': upstream,
+    })
+
+def is_fresh(ctx, stage, sample_id, key):
+    if stage in ctx['force']:
+        return False
+    stamp = load_json(stamp_path(ctx, stage, sample_id))
+    return stamp is not None and stamp.get('key') == key and os.path.exists(stage_output(ctx, stage, sample_id))
+
+def run_stage(ctx, stage, samples, dry_run=False):
+    """Run one per-sample stage over all samples. Returns (ran, skipped, failed) counts."""
+    ran = skipped = failed = 0
+    for sample_id, video_path in samples:
+        key = stage_key(ctx, stage, sample_id, ctx['video_hashes'][sample_id])
+        if key is None:
+            if dry_run and any((dep, sample_id) in ctx['pending'] for dep in STAGES[stage]['deps']):
+                print(f'[{stage}] would run {sample_id} after upstream')
+                ctx['pending'].add((stage, sample_id))
+                ran += 1
+            else:
+                print(f'[{stage}] {sample_id}: upstream not ready, skipping')
+                failed += 1
+            continue
+        ctx['keys'][(stage, sample_id)] = key
+        if is_fresh(ctx, stage, sample_id, key):
+            skipped += 1
+            continue
+        output_path = stage_output(ctx, stage, sample_id)
+        if dry_run:
+            print(f'[{stage}] would run {sample_id}')
+            ctx['pending'].add((stage, sample_id))
+            ran += 1
+            continue
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        start = time.time()
+        try:
+            with telemetry.span(stage, sample_id):
+                RUNNERS[stage](ctx, sample_id, video_path, output_path)
+        except Exception as e:
+            print(f'[{stage}] Error processing {sample_id}: {e}')
+            failed += 1
+            continue
+        atomic_write_json(stamp_path(ctx, stage, sample_id), {
+            'key': key,
+            'output_sha256': sha256_file(output_path),
+            'seconds': round(time.time() - start, 3),
+            'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+        print(f'[{stage}] {sample_id} done in {time.time() - start:.1f}s')
+        ran += 1
+    return ran, skipped, failed
+
+def combine_key(ctx, samples):
+    upstream = {}
+    for stage in COMBINE_DEPS:
+        for sample_id, _ in samples:
+            stamp = load_json(stamp_path(ctx, stage, sample_id))
+            upstream[f'{stage}/{sample_id}'] = stamp['output_sha256'] if stamp else None
+    labels = sha256_file(ctx['labels']) if ctx['labels'] and os.path.exists(ctx['labels']) else None
+    return sha256_json({'stage': 'combine', 'upstream': upstream, 'labels': labels})
+
+
+def list_samples(video_dir):
+    return [(os.path.splitext(f)[0], os.path.join(video_dir, f))
+            for f in sorted(os.listdir(video_dir)) if f.endswith('.mp4')]
+
+def build_params(args):
+    params = {stage: dict(spec['params']) for stage, spec in STAGES.items()}
+    params['subtitle']['whisper_model'] = args.whisper_model
+    params['visual_description']['model'] = args.vision_model
+    params['visual_description']['max_tokens'] = args.vision_max_tokens
+    if args.vision_prompt_file:
+        with open(args.vision_prompt_file, 'r') as f:
+            params['visual_description']['prompt'] = f.read().strip()
+    return params
+
+def build_context(args):
+    state_dir = os.path.join(args.data_root, STATE_DIR_NAME)
+    return {
+        'data_root': args.data_root,
+        'state_dir': state_dir,
+        'params': build_params(args),
+        'openface_bin': args.openface_bin,
+        'ffmpeg_bin': args.ffmpeg,
+        'labels': args.labels if args.labels is not None else os.path.join(args.data_root, 'test_labels_subset.csv'),
+        'force': set(args.force or []),
+        'models': {},
+        'keys': {},
+        'pending': set(),
+        'video_hashes': {},
+    }
+
+def run_stages(ctx, samples, selected, dry_run=False):
+    """Run the selected per-sample stages in graph order. Returns {stage: (ran, skipped, failed)}."""
+    # Keys of stages that are not selected are still needed by their dependents,
+    # so every stage computes its key; only the selected ones actually run.
+    summary = {}
+    for stage in STAGE_ORDER:
+        if stage in selected:
+            summary[stage] = run_stage(ctx, stage, samples, dry_run=dry_run)
+        else:
+            for sample_id, _ in samples:
+                key = stage_key(ctx, stage, sample_id, ctx['video_hashes'][sample_id])
+                if key is not None:
+                    ctx['keys'][(stage, sample_id)] = key
+    return summary
+
+def combine_stage(ctx, samples, dry_run=False):
+    """Combine every sample's outputs unless the combine stamp is still fresh. Returns (ran, skipped, failed)."""
+    key = combine_key(ctx, samples)
+    output_path = os.path.join(ctx['data_root'], COMBINE_OUTPUT)
+    stamp = load_json(stamp_path(ctx, 'combine', 'all'))
+    if 'combine' not in ctx['force'] and stamp and stamp.get('key') == key and os.path.exists(output_path):
+        return 0, 1, 0
+    if dry_run:
+        print('[combine] would run')
+        return 1, 0, 0
+    # A count, not the ids: combine covers the whole dataset in one span
+    with telemetry.span('combine', batch_size=len(samples)):
+        run_combine(ctx, [sample_id for sample_id, _ in samples], output_path)
+    atomic_write_json(stamp_path(ctx, 'combine', 'all'), {'key': key, 'output_sha256': sha256_file(output_path)})
+    return 1, 0, 0
+
+def main(args):
+    if args.trace or args.metrics:
+        telemetry.configure(args.trace, args.metrics)
+    ctx = build_context(args)
+
+    samples = list_samples(os.path.join(args.data_root, args.video_subdir))
+    if args.limit:
+        samples = samples[:args.limit]
+    print(f'Found {len(samples)} videos')
+
+    hash_cache = VideoHashCache(os.path.join(ctx['state_dir'], 'video_hashes.json'))
+    for sample_id, video_path in samples:
+        ctx['video_hashes'][sample_id] = hash_cache.get(video_path)
+    hash_cache.save()
+
+    selected = args.stages or STAGE_ORDER + ['combine']
+    summary = run_stages(ctx, samples, selected, dry_run=args.dry_run)
+    if 'combine' in selected:
+        summary['combine'] = combine_stage(ctx, samples, dry_run=args.dry_run)
+
+    print('\nSummary (ran / skipped / failed):')
+    for stage, (ran, skipped, failed) in summary.items():
+        print(f'  {stage}: {ran} / {skipped} / {failed}')
+    return summary
+
+def add_arguments(parser):
+    """Options shared by this runner and the work-queue workers (work_queue.py)."""
+    parser.add_argument('--data_root', type=str, default=DATA_ROOT,
+                        help='Dataset folder containing the video subfolder and stage outputs')
+    parser.add_argument('--video_subdir', type=str, default='test_subset',
+                        help='Subfolder of data_root with the .mp4 files')
+    parser.add_argument('--stages', nargs='+', choices=STAGE_ORDER + ['combine'],
+                        help='Only run these stages (default: all)')
+    parser.add_argument('--force', nargs='+', choices=STAGE_ORDER + ['combine'],
+                        help='Re-run these stages even if their stamps are up to date')
+    parser.add_argument('--openface_bin', type=str,
+                        help='Path to OpenFace FeatureExtraction binary (needed by the au stage)')
+    parser.add_argument('--ffmpeg', type=str, default='ffmpeg', help='Path to the ffmpeg binary')
+    parser.add_argument('--whisper_model', type=str, default='base')
+    parser.add_argument('--vision_model', type=str, default='gpt-4o')
+    parser.add_argument('--vision_max_tokens', type=int, default=500)
+    parser.add_argument('--vision_prompt_file', type=str,
+                        help='Optional: text file overriding the GPT-4o prompt')
+    parser.add_argument('--labels', type=str,
+                        help='Label CSV joined in the combine stage (default: <data_root>/test_labels_subset.csv)')
+    parser.add_argument('--trace', type=str, help='Optional: append per-sample stage spans to this JSONL file')
+    parser.add_argument('--metrics', type=str, help='Optional: Prometheus text-format metrics file, e.g. runs/mer.prom')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the MER captioning stages, skipping work whose inputs have not changed')
+    add_arguments(parser)
+    parser.add_argument('--limit', type=int, help='Optional: Limit the number of videos')
+    parser.add_argument('--dry_run', action='store_true', help='Only print what would run')
+    main(parser.parse_args())
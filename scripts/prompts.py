@@ -0,0 +1,14 @@
+# Prompts shared by the description scripts and the pipeline runner.
+# Keep them here so that changing a prompt is visible to the runner's content hashes.
+
+VISION_PROMPT = "Describe what is happening in this video frame as if you're narrating it to someone who cannot see it. Focus only on visible details such as people's actions, facial expressions, gestures, body language, clothing, objects, and the physical setting. Be specific about how people are positioned and how they interact with each other and their surroundings. Write descriptively—do not simply list objects. Include visual cues that might suggest emotional states, but don't speculate beyond what's visible."
+
+AUDIO_DESCRIPTION_PROMPT = "Describe the speaker’s vocal delivery in this audio. Focus only on how they sound, not what they are saying. Include detailed observations about: \n- Prosody: pitch, intonation, pacing, loudness, rhythm, and pauses or hesitation \n- Voice quality: breathiness, tension, harshness, smoothness, or creakiness \n- Articulation: clarity, enunciation, and any slurring, stuttering, or irregular speech patterns \nAlso describe how expressive or monotone the speaker sounds. Be as descriptive as possible and explain what these vocal features might suggest about their emotional tone, without interpreting the actual words."
+
+# Prepended to the vision prompt when several peak frames of one clip are sent together
+MULTI_FRAME_NOTE = "The following images are {count} frames from the same video clip, taken at its strongest facial expressions and ordered from strongest to weakest. Describe the first frame, and use the other frames as context for how the scene and expressions change."
+
+def multi_frame_prompt(prompt, count):
+    if count <= 1:
+        return prompt
+    return MULTI_FRAME_NOTE.format(count=count) + " " + prompt
@@ -0,0 +1,242 @@
+# Persistent cache of model responses for frame descriptions.
+#
+# Entries are keyed by a SHA-256 of the frame's pixels plus a hash of the
+# request parameters (model, prompt, max_tokens, payload options), so a hit is
+# always the exact same request, whichever clip it came from. Each entry also
+# stores a 64-bit perceptual hash (dHash) and the clip (sample id) the frame
+# belongs to. Lookups can opt in to reusing near-duplicate frames within a
+# Hamming distance, e.g. the neighbouring frame picked after a peak heuristic
+# tweak. Different clips can share a dHash, so near matches are only searched
+# among frames of the same clip. The cache is a single SQLite file with
+# size-bounded LRU eviction, persistent hit/miss counters and a read-only mode
+# for reproducible runs.
+#
+# Usage:
+#   python scripts/response_cache.py stats --cache data/MER_test_subset/response_cache.sqlite
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+cache_path = 'data/MER_test_subset/response_cache.sqlite'
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+HASH_BITS = 64
+BANDS = 4  # 16-bit bands; two hashes within distance < BANDS share at least one band
+
+
+def dhash(image, hash_size=8):
+    """64-bit difference hash of a PIL image: robust to re-encoding, resizing and small shifts."""
+    from PIL import Image
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+def content_hash(image):
+    """SHA-256 of a PIL image's mode, size and pixels; equal only for identical frames."""
+    h = hashlib.sha256(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("utf-8"))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+def params_key(model, prompt, max_tokens, extra=None):
+    """Hash of everything besides the image that determines the response."""
+    data = {"model": model, "prompt": prompt, "max_tokens": max_tokens, "extra": extra}
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def _to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+def _bands(value):
+    width = HASH_BITS // BANDS
+    return [(value >> (i * width)) & ((1 << width) - 1) for i in range(BANDS)]
+
+
+class ResponseCache:
+    def __init__(self, path=cache_path, max_bytes=DEFAULT_MAX_BYTES, read_only=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        if read_only:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self._create_tables()
+        # Running size of the responses; re-counted only when it suggests eviction
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        # Counters of this session; persisted totals live in the stats table
+        self.session = {"hits": 0, "near_hits": 0, "misses": 0, "puts": 0, "evictions": 0}
+
+    def _create_tables(self):
+        band_cols = ", ".join(f"band{i} INTEGER" for i in range(BANDS))
+        with self.conn:
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(responses)")]
+            if columns and "content_hash" not in columns:
+                # Entries keyed by the dHash alone may belong to a different clip; they cannot be trusted
+                self.conn.execute("DROP TABLE responses")
+            self.conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS responses (
+                    id INTEGER PRIMARY KEY,
+                    params_key TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    clip TEXT,
+                    phash INTEGER NOT NULL,
+                    {band_cols},
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    UNIQUE (params_key, content_hash)
+                )""")
+            if columns and "clip" not in columns:
+                # Entries from before clips were stored stay exact-match only (clip IS NULL)
+                self.conn.execute("ALTER TABLE responses ADD COLUMN clip TEXT")
+            for i in range(BANDS):
+                self.conn.execute(f"DROP INDEX IF EXISTS idx_band{i}")
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_clip_band{i} "
+                                  f"ON responses (params_key, clip, band{i})")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _count(self, name, n=1):
+        self.session[name] += n
+        if not self.read_only:
+            self.conn.execute("INSERT INTO stats (name, value) VALUES (?, ?) "
+                              "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, n))
+
+    def _candidates(self, key, clip, phash, max_distance):
+        if max_distance < BANDS:
+            # Pigeonhole: a hash within distance < BANDS matches at least one band exactly
+            where = " OR ".join(f"band{i} = ?" for i in range(BANDS))
+            return self.conn.execute(f"SELECT id, phash, response FROM responses "
+                                     f"WHERE params_key = ? AND clip = ? AND ({where})",
+                                     (key, clip, *_bands(phash))).fetchall()
+        return self.conn.execute("SELECT id, phash, response FROM responses WHERE params_key = ? AND clip = ?",
+                                 (key, clip)).fetchall()
+
+    def get(self, content_key, image_hash, key, max_distance=0, clip=None):
+        """Cached response for a frame (content_hash and dHash) and params key, or None.
+
+        By default only the identical frame is a hit, from any clip. With
+        max_distance > 0 and a clip (sample id), the closest cached frame of that
+        clip within that many differing dHash bits is returned when there is no
+        identical one.
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT id, response FROM responses WHERE params_key = ? AND content_hash = ?",
+                                    (key, content_key)).fetchone()
+            if row is not None:
+                self._count("hits")
+                if not self.read_only:
+                    self.conn.execute("UPDATE responses SET last_access = ? WHERE id = ?", (time.time(), row[0]))
+                return row[1]
+            best = None
+            near = max_distance > 0 and clip is not None
+            for row_id, phash, response in self._candidates(key, clip, image_hash, max_distance) if near else []:
+                distance = hamming(_to_unsigned(phash), image_hash)
+                if distance <= max_distance and (best is None or distance < best[0]):
+                    best = (distance, row_id, response)
+            if best is None:
+                self._count("misses")
+                return None
+            self._count("near_hits")
+            if not self.read_only:
+                self.conn.execute("UPDATE responses SET last_access = ? WHERE id = ?", (time.time(), best[1]))
+            return best[2]
+
+    def put(self, content_key, image_hash, key, response, clip=None):
+        if self.read_only or response is None:
+            # None: a refused or filtered request, which must be asked again next time
+            return
+        size = len(response.encode("utf-8"))
+        now = time.time()
+        with self.lock, self.conn:
+            old = self.conn.execute("SELECT size FROM responses WHERE params_key = ? AND content_hash = ?",
+                                    (key, content_key)).fetchone()
+            self.conn.execute(
+                f"INSERT INTO responses (params_key, content_hash, clip, phash, "
+                f"{', '.join(f'band{i}' for i in range(BANDS))}, response, size, created, last_access) "
+                f"VALUES (?, ?, ?, ?, {', '.join('?' * BANDS)}, ?, ?, ?, ?) "
+                "ON CONFLICT(params_key, content_hash) DO UPDATE SET response = excluded.response, "
+                "clip = excluded.clip, size = excluded.size, last_access = excluded.last_access",
+                (key, content_key, clip, _to_signed(image_hash), *_bands(image_hash), response, size, now, now))
+            self.total_bytes += size - (old[0] if old else 0)
+            self._count("puts")
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes may share the file, so the running total is only a trigger
+        total = self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for row_id, size in self.conn.execute("SELECT id, size FROM responses ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM responses WHERE id = ?", (row_id,))
+            total -= size
+            evicted += 1
+        self.total_bytes = total
+        self._count("evictions", evicted)
+
+    def stats(self):
+        with self.lock:
+            totals = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = sum(totals.get(k, 0) for k in ("hits", "near_hits", "misses"))
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "totals": totals,
+            "hit_rate": (totals.get("hits", 0) + totals.get("near_hits", 0)) / lookups if lookups else None,
+            "session": dict(self.session),
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def cached_describe(cache, image, describe, model, prompt, max_tokens, extra=None, max_distance=0, clip=None):
+    """Return describe() for the image, served from the cache when possible.
+
+    clip (the sample id) scopes near-duplicate matches to frames of the same clip.
+    """
+    if cache is None:
+        return describe()
+    content_key, image_hash = content_hash(image), dhash(image)
+    key = params_key(model, prompt, max_tokens, extra)
+    response = cache.get(content_key, image_hash, key, max_distance, clip)
+    if response is None:
+        response = describe()
+        cache.put(content_key, image_hash, key, response, clip)
+    return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the frame description response cache")
+    parser.add_argument("command", choices=["stats"])
+    parser.add_argument("--cache", type=str, default=cache_path)
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.cache, read_only=True)
+    print(json.dumps(cache.stats(), indent=2))
@@ -0,0 +1,306 @@
+# Structured per-sample timings, token usage and cost metrics.
+#
+# Hot paths (decode, OpenFace, Whisper, Qwen-Audio, GPT-4o, the pipeline
+# stages) run inside spans. A span ends as one JSON line in the trace file with
+# its stage, sample(s), duration, status, and for OpenAI calls the prompt and
+# completion tokens and their cost. The same numbers are aggregated into a
+# Prometheus text-format file for node_exporter's textfile collector. That file
+# holds per-stage duration histograms, in-progress and last-finished gauges,
+# and token and cost counters. It is rewritten at most every metrics_interval
+# seconds and at exit.
+#
+# Both outputs are off unless configured. Set them for any script with
+# environment variables, or with pipeline.py --trace/--metrics. A "{pid}" in the
+# metrics path keeps parallel processes from overwriting each other's file.
+# Processes started after configure() or share_run_id() inherit the run id
+# through MER_RUN_ID, so their spans belong to the same run.
+#
+# Usage:
+#   MER_TRACE_FILE=runs/trace.jsonl MER_METRICS_FILE=runs/mer_{pid}.prom python scripts/async_describer.py
+#   python scripts/telemetry.py summary runs/trace.jsonl --project 100000
+
+import os
+import json
+import time
+import atexit
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# USD per million (prompt, completion) tokens; versioned names match by prefix.
+# Override with MER_PRICES='{"gpt-4o": [2.5, 10.0]}'.
+PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1': (2.00, 8.00),
+}
+BATCH_DISCOUNT = 0.5  # Batch API requests cost half
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+DEFAULT_METRICS_INTERVAL = 15.0
+
+_current = contextvars.ContextVar('telemetry_span', default=None)
+
+
+class Telemetry:
+    """Trace writer and in-memory metrics of one process."""
+
+    def __init__(self, trace_path=None, metrics_path=None, run_id=None, metrics_interval=DEFAULT_METRICS_INTERVAL,
+                 prices=None):
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path.replace('{pid}', str(os.getpid())) if metrics_path else None
+        self.run_id = run_id or time.strftime('%Y%m%dT%H%M%S')
+        self.metrics_interval = metrics_interval
+        self.prices = dict(PRICES, **(prices or {}))
+        self.lock = threading.Lock()
+        self.histograms = {}   # (stage, status) -> [bucket counts..., sum, count]
+        self.in_progress = {}  # stage -> open spans
+        self.last_finished = {}
+        self.tokens = {}       # (model, kind) -> tokens
+        self.cost = {}         # model -> USD
+        self.flushed = 0.0
+        for path in (trace_path, self.metrics_path):
+            if path:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    # --- Trace ---
+    def emit(self, record):
+        if not self.trace_path:
+            return
+        line = json.dumps({'run': self.run_id, 'pid': os.getpid(), **record}, ensure_ascii=False) + '\n'
+        # One write per line on an O_APPEND file, so lines from several processes do not interleave
+        with self.lock, open(self.trace_path, 'a') as f:
+            f.write(line)
+
+    # --- Metrics ---
+    def started(self, stage):
+        with self.lock:
+            self.in_progress[stage] = self.in_progress.get(stage, 0) + 1
+
+    def finished(self, stage, status, seconds):
+        with self.lock:
+            self.in_progress[stage] -= 1
+            self.last_finished[stage] = time.time()
+            counts = self.histograms.setdefault((stage, status), [0] * (len(DURATION_BUCKETS) + 2))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-2] += seconds
+            counts[-1] += 1
+        self.maybe_flush()
+
+    def price(self, model):
+        for name in sorted(self.prices, key=len, reverse=True):
+            if model and model.startswith(name):
+                return self.prices[name]
+        return None
+
+    def add_usage(self, model, prompt_tokens, completion_tokens, batch=False):
+        """Count the tokens of one request; returns its cost in USD, or None for an unpriced model."""
+        price = self.price(model)
+        cost = None
+        if price is not None:
+            cost = (prompt_tokens * price[0] + completion_tokens * price[1]) / 1e6
+            if batch:
+                cost *= BATCH_DISCOUNT
+        with self.lock:
+            for kind, n in (('prompt', prompt_tokens), ('completion', completion_tokens)):
+                self.tokens[(model, kind)] = self.tokens.get((model, kind), 0) + n
+            if cost is not None:
+                self.cost[model] = self.cost.get(model, 0.0) + cost
+        return cost
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            lines += ['# HELP mer_stage_duration_seconds Time spent per sample (or batch) in a stage.',
+                      '# TYPE mer_stage_duration_seconds histogram']
+            for (stage, status), counts in sorted(self.histograms.items()):
+                labels = f'stage="{stage}",status="{status}"'
+                for bound, n in zip(DURATION_BUCKETS, counts):
+                    lines.append(f'mer_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {n}')
+                lines.append(f'mer_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {counts[-1]}')
+                lines.append(f'mer_stage_duration_seconds_sum{{{labels}}} {counts[-2]:.6f}')
+                lines.append(f'mer_stage_duration_seconds_count{{{labels}}} {counts[-1]}')
+            lines += ['# HELP mer_stage_in_progress Spans of a stage currently running.',
+                      '# TYPE mer_stage_in_progress gauge']
+            lines += [f'mer_stage_in_progress{{stage="{s}"}} {n}' for s, n in sorted(self.in_progress.items())]
+            lines += ['# HELP mer_stage_last_finished_timestamp_seconds When a span of the stage last ended.',
+                      '# TYPE mer_stage_last_finished_timestamp_seconds gauge']
+            lines += [f'mer_stage_last_finished_timestamp_seconds{{stage="{s}"}} {t:.3f}'
+                      for s, t in sorted(self.last_finished.items())]
+            lines += ['# HELP mer_tokens_total OpenAI tokens used.', '# TYPE mer_tokens_total counter']
+            lines += [f'mer_tokens_total{{model="{m}",kind="{k}"}} {n}' for (m, k), n in sorted(self.tokens.items())]
+            lines += ['# HELP mer_cost_usd_total Estimated OpenAI cost.', '# TYPE mer_cost_usd_total counter']
+            lines += [f'mer_cost_usd_total{{model="{m}"}} {c:.6f}' for m, c in sorted(self.cost.items())]
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        if not self.metrics_path or not (self.histograms or self.tokens or self.in_progress):
+            return
+        self.flushed = time.monotonic()
+        tmp_path = f'{self.metrics_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        # The collector must never see a half-written file
+        os.replace(tmp_path, self.metrics_path)
+
+    def maybe_flush(self):
+        if self.metrics_path and time.monotonic() - self.flushed >= self.metrics_interval:
+            self.flush()
+
+
+def _from_environment():
+    prices = os.environ.get('MER_PRICES')
+    # Set by the process that started this one (see share_run_id), or a new run
+    run_id = os.environ.get('MER_RUN_ID')
+    return Telemetry(os.environ.get('MER_TRACE_FILE'), os.environ.get('MER_METRICS_FILE'), run_id,
+                     float(os.environ.get('MER_METRICS_INTERVAL', DEFAULT_METRICS_INTERVAL)),
+                     {k: tuple(v) for k, v in json.loads(prices).items()} if prices else None)
+
+_telemetry = _from_environment()
+atexit.register(lambda: _telemetry.flush())
+
+def configure(trace_path=None, metrics_path=None, run_id=None, metrics_interval=DEFAULT_METRICS_INTERVAL):
+    """Replace the environment configuration, e.g. from command-line flags.
+
+    Without run_id the inherited MER_RUN_ID is kept, if any. The resulting run id
+    is shared with processes started from now on.
+    """
+    global _telemetry
+    _telemetry.flush()
+    _telemetry = Telemetry(trace_path, metrics_path, run_id or os.environ.get('MER_RUN_ID'), metrics_interval,
+                           _telemetry.prices)
+    share_run_id()
+    return _telemetry
+
+def share_run_id():
+    """Export this process's run id as MER_RUN_ID, for child processes (workers, benchmark stages)."""
+    os.environ['MER_RUN_ID'] = _telemetry.run_id
+
+def get():
+    return _telemetry
+
+
+@contextmanager
+def span(stage, sample_id=None, samples=None, **attrs):
+    """Time a block of work on one sample (or a batch of samples) and record it.
+
+    Yields a dict; fields added to it (e.g. attempts) end up in the trace line.
+    Exceptions are recorded with status "error" and re-raised; setting an
+    "error" field marks a span as failed without raising.
+    """
+    telemetry = _telemetry
+    parent = _current.get()
+    record = {'stage': stage, 'sample': sample_id, **attrs}
+    if samples is not None:
+        record['samples'] = list(samples)
+    if parent is not None:
+        record['parent'] = parent['stage']
+    token = _current.set(record)
+    telemetry.started(stage)
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = f'{e.__class__.__name__}: {e}'
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        status = 'error' if 'error' in record else 'ok'
+        _current.reset(token)
+        telemetry.finished(stage, status, seconds)
+        telemetry.emit({'ts': round(start_time, 3), **record, 'seconds': round(seconds, 6), 'status': status})
+
+def record_usage(model, usage, batch=False, sample_id=None):
+    """Count the token usage of an OpenAI response (object or dict) and attach it to the current span.
+
+    Outside a span a separate "usage" line is written to the trace.
+    """
+    if usage is None:
+        return None
+    get_field = usage.get if isinstance(usage, dict) else lambda name: getattr(usage, name, None)
+    prompt_tokens = get_field('prompt_tokens') or 0
+    completion_tokens = get_field('completion_tokens') or 0
+    cost = _telemetry.add_usage(model, prompt_tokens, completion_tokens, batch)
+    current = _current.get()
+    if current is not None:
+        # Retried or multi-request spans add up
+        current['model'] = model
+        current['prompt_tokens'] = current.get('prompt_tokens', 0) + prompt_tokens
+        current['completion_tokens'] = current.get('completion_tokens', 0) + completion_tokens
+        if cost is not None:
+            current['cost_usd'] = round(current.get('cost_usd', 0.0) + cost, 8)
+    else:
+        _telemetry.emit({'ts': round(time.time(), 3), 'event': 'usage', 'sample': sample_id, 'model': model,
+                         'batch': batch, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                         'cost_usd': round(cost, 8) if cost is not None else None})
+    return cost
+
+
+# --- Trace analysis ---
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def summarize_trace(paths, run_id=None, project=None):
+    """Per-stage timings and totals of token usage and cost from trace files."""
+    stages, models = {}, {}
+    billed_samples = set()
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if run_id and record.get('run') != run_id:
+                    continue
+                if record.get('event') != 'usage':
+                    stats = stages.setdefault(record['stage'], {'spans': 0, 'errors': 0, 'samples': 0,
+                                                                'seconds': []})
+                    stats['spans'] += 1
+                    stats['errors'] += record['status'] == 'error'
+                    stats['samples'] += len(record['samples']) if 'samples' in record else record.get('batch_size', 1)
+                    stats['seconds'].append(record['seconds'])
+                if 'prompt_tokens' in record:
+                    usage = models.setdefault(record['model'], {'requests': 0, 'prompt_tokens': 0,
+                                                                'completion_tokens': 0, 'cost_usd': 0.0})
+                    usage['requests'] += 1
+                    usage['prompt_tokens'] += record['prompt_tokens']
+                    usage['completion_tokens'] += record['completion_tokens']
+                    usage['cost_usd'] += record.get('cost_usd') or 0.0
+                    billed_samples.add(record.get('sample'))
+
+    summary = {'stages': {}, 'models': models}
+    for stage, stats in sorted(stages.items()):
+        seconds = stats.pop('seconds')
+        stats.update({'total_seconds': sum(seconds), 'p50_seconds': _percentile(seconds, 50),
+                      'p95_seconds': _percentile(seconds, 95), 'max_seconds': max(seconds)})
+        summary['stages'][stage] = stats
+    total_cost = sum(m['cost_usd'] for m in models.values())
+    summary['cost_usd'] = total_cost
+    if billed_samples:
+        summary['cost_per_sample_usd'] = total_cost / len(billed_samples)
+        if project:
+            summary[f'projected_cost_usd_{project}_samples'] = summary['cost_per_sample_usd'] * project
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize telemetry trace files')
+    sub = parser.add_subparsers(dest='command', required=True)
+    summary = sub.add_parser('summary', help='Per-stage timings, token usage and cost')
+    summary.add_argument('paths', nargs='+', help='Trace JSONL files')
+    summary.add_argument('--run', type=str, help='Optional: only spans of this run id')
+    summary.add_argument('--project', type=int, help='Optional: projected cost for this many samples')
+    args = parser.parse_args()
+
+    report = summarize_trace(args.paths, args.run, args.project)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,285 @@
+# Batched Whisper transcription over pre-decoded audio.
+#
+# wav_to_subtitle.py calls model.transcribe(path) per file, which shells out to
+# ffmpeg to decode every WAV again and runs the model one clip at a time. Here
+# clips are read straight from 16 kHz PCM WAVs (or from the memory-mapped
+# container of audio_cache.py with --audio_cache), sorted by length and pushed through the encoder and
+# decoder in batches. Language detection runs once per speaker/dataset group
+# and is cached, and each transcript is written as soon as its batch finishes.
+#
+# Usage:
+#   python scripts/transcription.py --batch_size 16
+#   python scripts/transcription.py --language en
+
+import os
+import json
+import wave
+import argparse
+
+import numpy as np
+
+import telemetry
+
+SAMPLE_RATE = 16000
+MAX_SECONDS = 30  # Whisper's window; longer clips fall back to model.transcribe
+LANGUAGE_CLIPS = 3  # longest clips of a group whose language probabilities are combined
+
+# model.transcribe's defaults for retrying at a higher temperature and for dropping silence
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+
+input_dir = "./data/MER_test_subset/test_subset_wav"
+output_dir = "./data/MER_test_subset/test_subtitles"
+
+
+def read_wav(path):
+    """16 kHz float32 mono samples of a PCM WAV without going through ffmpeg.
+
+    Files that are not 16-bit PCM at 16 kHz (e.g. the 44.1 kHz stereo output of
+    the old moviepy converter) are decoded with whisper.load_audio instead.
+    """
+    with wave.open(path, "rb") as f:
+        if f.getsampwidth() == 2 and f.getframerate() == SAMPLE_RATE:
+            data = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+            if f.getnchannels() > 1:
+                data = data.reshape(-1, f.getnchannels()).mean(axis=1)
+            return data.astype(np.float32) / 32768.0
+    import whisper
+    return whisper.load_audio(path)
+
+
+class LanguageCache:
+    """Detected language per group key (speaker, dataset, ...), optionally kept in a JSON file."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.languages = {}
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                self.languages = json.load(f)
+
+    def get(self, key):
+        return self.languages.get(key)
+
+    def set(self, key, language):
+        self.languages[key] = language
+        if self.path:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.languages, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class TranscriptionEngine:
+    def __init__(self, model, batch_size=16, language=None, language_cache=None, precision_context=None):
+        import contextlib
+        import torch
+        self.model = model
+        self.batch_size = batch_size
+        self.language = language
+        self.language_cache = language_cache or LanguageCache()
+        self.fp16 = next(model.parameters()).device.type == "cuda"
+        # e.g. bfloat16 autocast from cpu_inference.precision_context
+        self.precision_context = precision_context or contextlib.nullcontext
+        self.torch = torch
+
+    def _mel(self, audio):
+        import whisper
+        # One clip at a time: log_mel_spectrogram normalises by the maximum of
+        # its whole input, so a stacked call would mix clips together.
+        # pad_or_trim copies, so read-only views from the audio cache are never written to
+        audio = whisper.pad_or_trim(np.asarray(audio, dtype=np.float32))
+        return whisper.log_mel_spectrogram(audio, n_mels=self.model.dims.n_mels)
+
+    def _detect(self, items, mels=None):
+        """{key: language} for (key, audio) items; the probabilities of items sharing
+        a key are combined, weighted by how much of Whisper's window each clip fills.
+
+        mels optionally holds the items' log-mel spectrograms, already on the device.
+        """
+        scores = {}
+        for start in range(0, len(items), self.batch_size):
+            chunk = items[start:start + self.batch_size]
+            if mels is None:
+                chunk_mels = self.torch.stack([self._mel(audio) for _, audio in chunk]).to(self.model.device)
+            else:
+                chunk_mels = mels[start:start + self.batch_size]
+            _, probs = self.model.detect_language(chunk_mels)
+            for (key, audio), p in zip(chunk, probs):
+                weight = min(len(audio), MAX_SECONDS * SAMPLE_RATE)
+                combined = scores.setdefault(key, {})
+                for language, prob in p.items():
+                    combined[language] = combined.get(language, 0.0) + prob * weight
+        return {key: max(combined, key=combined.get) for key, combined in scores.items()}
+
+    def detect_group_languages(self, clips):
+        """Detect and cache the language of every uncached group before any decoding.
+
+        A group's language comes from its LANGUAGE_CLIPS longest clips in the whole
+        input: a short clip (a laugh, one word) alone is easily misdetected, and
+        batches of length-sorted clips would otherwise see a group's shortest first.
+        """
+        if self.language or not self.model.is_multilingual:
+            return
+        by_group = {}
+        for _, audio, group in clips:
+            if group is not None and self.language_cache.get(group) is None:
+                by_group.setdefault(group, []).append(audio)
+        items = [(group, audio) for group, audios in by_group.items()
+                 for audio in sorted(audios, key=len, reverse=True)[:LANGUAGE_CLIPS]]
+        for group, language in self._detect(items).items():
+            self.language_cache.set(group, language)
+
+    def _languages(self, clips, mels):
+        """Language per (sample_id, audio, group) clip with their stacked mels; groups not
+        cached yet are detected from these clips (transcribe detects them from the whole
+        input beforehand)."""
+        if self.language:
+            return [self.language] * len(clips)
+        if not self.model.is_multilingual:
+            return ["en"] * len(clips)
+        self.detect_group_languages(clips)
+        # Clips without a group are detected on their own
+        alone = [i for i, (_, _, group) in enumerate(clips) if group is None]
+        detected = self._detect([(i, clips[i][1]) for i in alone], mels[alone]) if alone else {}
+        return [detected[i] if group is None else self.language_cache.get(group)
+                for i, (_, _, group) in enumerate(clips)]
+
+    def transcribe_batch(self, clips):
+        """Transcribe [(sample_id, audio, group)] clips of at most 30 s. Returns {sample_id: text}."""
+        import whisper
+        mels = self.torch.stack([self._mel(audio) for _, audio, _ in clips]).to(self.model.device)
+        languages = self._languages(clips, mels)
+
+        results = {}
+        # decode() takes a single language, so split the batch by language
+        for language in sorted(set(languages)):
+            idx = [i for i, lang in enumerate(languages) if lang == language]
+            options = whisper.DecodingOptions(task="transcribe", language=language, without_timestamps=True,
+                                              fp16=self.fp16)
+            decoded = whisper.decode(self.model, mels[idx], options)
+            for i, result in zip(idx, decoded):
+                sample_id, audio, _ = clips[i]
+                # Same checks model.transcribe makes: silence is dropped rather than retried,
+                # other low-quality results are retried at higher temperature
+                silent = result.no_speech_prob > NO_SPEECH_THRESHOLD
+                if silent and result.avg_logprob < LOGPROB_THRESHOLD:
+                    results[sample_id] = ""
+                elif not silent and (result.compression_ratio > COMPRESSION_RATIO_THRESHOLD
+                                     or result.avg_logprob < LOGPROB_THRESHOLD):
+                    results[sample_id] = self.model.transcribe(audio, language=language, fp16=self.fp16)["text"]
+                else:
+                    results[sample_id] = result.text
+        return results
+
+    def transcribe(self, clips, on_result=None):
+        """Transcribe an iterable of (sample_id, audio, group) clips.
+
+        Clips are ordered by length so each batch holds similar durations; clips
+        longer than Whisper's 30 s window go through model.transcribe. on_result is
+        called with (sample_id, text) as soon as each transcript is ready.
+        """
+        clips = sorted(clips, key=lambda clip: len(clip[1]))
+        with self.precision_context():
+            self.detect_group_languages(clips)
+        short = [c for c in clips if len(c[1]) <= MAX_SECONDS * SAMPLE_RATE]
+        long = [c for c in clips if len(c[1]) > MAX_SECONDS * SAMPLE_RATE]
+        results = {}
+        for start in range(0, len(short), self.batch_size):
+            clips_in_batch = short[start:start + self.batch_size]
+            with telemetry.span("whisper", samples=[sample_id for sample_id, _, _ in clips_in_batch]), \
+                    self.precision_context():
+                batch = self.transcribe_batch(clips_in_batch)
+            for sample_id, text in batch.items():
+                results[sample_id] = text
+                if on_result:
+                    on_result(sample_id, text)
+        for sample_id, audio, group in long:
+            with telemetry.span("whisper", sample_id, long=True), self.precision_context():
+                languages = self._languages([(sample_id, audio, group)],
+                                            self._mel(audio).unsqueeze(0).to(self.model.device))
+                text = self.model.transcribe(audio, language=languages[0], fp16=self.fp16)["text"]
+            results[sample_id] = text
+            if on_result:
+                on_result(sample_id, text)
+        return results
+
+
+def write_transcript(output_dir, sample_id, text):
+    output_path = os.path.join(output_dir, f"{sample_id}.txt")
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, output_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched Whisper transcription of 16 kHz WAV files")
+    parser.add_argument("--input_dir", type=str, default=input_dir)
+    parser.add_argument("--output_dir", type=str, default=output_dir)
+    parser.add_argument("--model", type=str, default="base")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--language", type=str, help="Optional: skip detection and use this language")
+    parser.add_argument("--speakers", type=str,
+                        help="Optional: CSV with name and Speaker columns; language is detected once per speaker "
+                             "instead of once per dataset")
+    parser.add_argument("--language_cache", type=str, help="Optional: JSON file to keep detected languages in")
+    parser.add_argument("--overwrite", action="store_true", help="Re-transcribe files that already have a subtitle")
+    parser.add_argument("--audio_cache", type=str,
+                        help="Optional: read the clips of input_dir from an audio_cache.py container instead of "
+                             "the WAV files (every cached clip if input_dir does not exist)")
+    parser.add_argument("--cpu_profile", type=str, choices=["fp32", "bf16", "int8"],
+                        help="Optional: run on CPU with this cpu_inference.py profile")
+    parser.add_argument("--threads", type=int, help="Optional: intra-op CPU threads of this process")
+    args = parser.parse_args()
+
+    from wav_to_subtitle import load_model
+
+    speakers = {}
+    if args.speakers:
+        import csv
+        with open(args.speakers, "r") as f:
+            for row in csv.DictReader(f):
+                speakers[row["name"]] = row["Speaker"]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    dataset = os.path.basename(os.path.normpath(args.input_dir))
+    cache = None
+    if args.audio_cache:
+        from audio_cache import AudioCache
+        cache = AudioCache(args.audio_cache)
+    if cache is not None and not os.path.isdir(args.input_dir):
+        # A cache built straight from the videos needs no WAV folder
+        print(f"{args.input_dir} does not exist; transcribing every clip in {args.audio_cache}")
+        sample_ids = sorted(cache.sample_ids())
+    else:
+        sample_ids = [os.path.splitext(filename)[0] for filename in sorted(os.listdir(args.input_dir))
+                      if filename.endswith(".wav")]
+    clips = []
+    for sample_id in sample_ids:
+        if not args.overwrite and os.path.exists(os.path.join(args.output_dir, f"{sample_id}.txt")):
+            continue
+        if cache is not None and sample_id in cache:
+            # Zero-copy view into the memory-mapped container
+            audio = cache.get(sample_id)
+        else:
+            audio = read_wav(os.path.join(args.input_dir, f"{sample_id}.wav"))
+        clips.append((sample_id, audio, speakers.get(sample_id, dataset)))
+    print(f"Found {len(clips)} files to transcribe")
+
+    if args.cpu_profile or args.threads:
+        from cpu_inference import configure_threads, load_whisper, precision_context
+        print(f"Using {configure_threads(args.threads)} CPU threads")
+    if args.cpu_profile:
+        model, context = load_whisper(args.model, args.cpu_profile), precision_context(args.cpu_profile)
+    else:
+        model, context = load_model(args.model), None
+    engine = TranscriptionEngine(model, batch_size=args.batch_size, language=args.language,
+                                 language_cache=LanguageCache(args.language_cache), precision_context=context)
+
+    def save(sample_id, text):
+        write_transcript(args.output_dir, sample_id, text)
+        print(f"Transcribed {sample_id}.wav -> {sample_id}.txt")
+
+    engine.transcribe(clips, on_result=save)
@@ -0,0 +1,109 @@
+# Frame loading, vision request messages and description CSVs.
+#
+# Shared by peak_frame_description.py, async_describer.py and batch_jobs.py.
+# Nothing here imports torch, transformers or the OpenAI client, and OpenCV is
+# only imported when a frame actually has to be decoded from a video. So the
+# async describer and offline batch ingestion run without the BLIP-2 stack or
+# an API key.
+
+import os
+import csv
+
+from PIL import Image
+
+# --- Frames ---
+def extract_frame_by_index(video_path, frame_idx):
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+    ret, frame = cap.read()
+    cap.release()
+
+    if not ret:
+        raise ValueError(f"Could not read frame at index {frame_idx}.")
+    
+    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(frame_rgb)
+
+def extract_frames_by_indices(video_path, frame_indices):
+    """Several frames from one forward decode, without seeking.
+
+    Frames are grabbed in order up to the last requested index and only the
+    requested ones are converted. Returns {frame_idx: PIL.Image}.
+    """
+    import cv2
+    wanted = set(int(i) for i in frame_indices)
+    frames = {}
+    if not wanted:
+        return frames
+    last = max(wanted)
+    cap = cv2.VideoCapture(video_path)
+    try:
+        for idx in range(last + 1):
+            if not cap.grab():
+                break
+            if idx in wanted:
+                ret, frame = cap.retrieve()
+                if ret:
+                    frames[idx] = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    finally:
+        cap.release()
+    missing = wanted - frames.keys()
+    if missing:
+        raise ValueError(f"Could not read frames at indices {sorted(missing)}.")
+    return frames
+
+def load_frame(video_path, frame_idx, frames_dir=None):
+    """Use the frame written by demux.py if it exists, otherwise seek in the video."""
+    if frames_dir:
+        from demux import frame_path
+        sample_id = os.path.splitext(os.path.basename(video_path))[0]
+        path = frame_path(frames_dir, sample_id, frame_idx)
+        if os.path.exists(path):
+            return Image.open(path).convert("RGB")
+    return extract_frame_by_index(video_path, frame_idx)
+
+def load_frames(video_path, frame_indices, frames_dir=None):
+    """load_frame for several indices: frames written by demux.py, the rest from one sequential decode."""
+    frames = {}
+    if frames_dir:
+        from demux import frame_path
+        sample_id = os.path.splitext(os.path.basename(video_path))[0]
+        for idx in frame_indices:
+            path = frame_path(frames_dir, sample_id, idx)
+            if os.path.exists(path):
+                frames[idx] = Image.open(path).convert("RGB")
+    missing = [idx for idx in frame_indices if idx not in frames]
+    if missing:
+        frames.update(extract_frames_by_indices(video_path, missing))
+    return [frames[idx] for idx in frame_indices]
+
+# --- Vision requests and outputs ---
+def build_vision_messages(data_url, prompt, detail="auto"):
+    """One user message with the prompt and one image, or several when data_url is a list."""
+    content = [{"type": "text", "text": prompt}]
+    for url in (data_url if isinstance(data_url, list) else [data_url]):
+        image_url = {"url": url}
+        if detail != "auto":
+            image_url["detail"] = detail
+        content.append({"type": "image_url", "image_url": image_url})
+    return [
+        {
+            "role": "user",
+            "content": content
+        }
+    ]
+
+def write_description(out_path, frame_index, generated_text, frame_indices=None):
+    # Write to a temporary file first so an interrupted run never leaves a half-written CSV
+    tmp_path = f"{out_path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        if frame_indices and len(frame_indices) > 1:
+            # Multi-peak descriptions also record every frame that was sent
+            writer.writerow(["peak_frame_index", "description", "peak_frame_indices"])
+            writer.writerow([frame_index, generated_text, ";".join(str(i) for i in frame_indices)])
+        else:
+            writer.writerow(["peak_frame_index", "description"])
+            writer.writerow([frame_index, generated_text])
+    os.replace(tmp_path, out_path)
@@ -5,6 +5,11 @@ import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers.generation import GenerationConfig
 import os
+import sys
+from contextlib import contextmanager
+
+import telemetry
+from prompts import AUDIO_DESCRIPTION_PROMPT
 
 # Set the following seed to reproduce results if needed
 # torch.manual_seed(1234)
@@ -12,40 +17,206 @@ import os
 # Use CPU if CUDA is not available
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-# Load tokenizer
-tokenizer = AutoTokenizer.from_pretrained("Qwen/Qwen-Audio-Chat", trust_remote_code=True)
+MODEL_NAME = "Qwen/Qwen-Audio-Chat"
+SYSTEM_PROMPT = "You are a helpful assistant."  # model.chat's default system message
+
+# Clips per generate call; 1 keeps the original one-model.chat-per-file path
+batch_size = 8
 
-# Load model to the appropriate device
-model = AutoModelForCausalLM.from_pretrained("Qwen/Qwen-Audio-Chat", trust_remote_code=True).to(device).eval()
+# e.g. "127.0.0.1:8765" to describe on a running model_server.py instead of loading Qwen-Audio here
+model_server = None
 
-# Load generation configuration
-model.generation_config = GenerationConfig.from_pretrained("Qwen/Qwen-Audio-Chat", trust_remote_code=True)
+# e.g. "./data/MER_test_subset/audio_cache" to read the clips of input_dir from audio_cache.py instead of the
+# WAV files (every cached clip if input_dir does not exist). With model_server it only selects the clips: the
+# server reads audio itself, from the cache it was started with (model_server.py --audio_cache)
+audio_cache_dir = None
 
 # Define input and output directories
 input_dir = "./data/MER_test_subset/test_subset_wav"
 output_dir = "./data/MER_test_subset/test_subset_gwen_description"
 
-# Create output directory if it doesn't exist
-os.makedirs(output_dir, exist_ok=True)
+def load_model(model_name=MODEL_NAME):
+    # Load tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
 
-# List all .wav files in the input directory
-wav_files = [f for f in os.listdir(input_dir) if f.endswith('.wav')]
+    # Load model to the appropriate device
+    model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True).to(device).eval()
 
-for wav_file in wav_files:
-    wav_path = os.path.join(input_dir, wav_file)
+    # Load generation configuration
+    model.generation_config = GenerationConfig.from_pretrained(model_name, trust_remote_code=True)
+    return tokenizer, model
+
+def describe_audio(tokenizer, model, wav_path, output_path, prompt=AUDIO_DESCRIPTION_PROMPT):
     # Format the query for each file
     query = tokenizer.from_list_format([
         {"audio": wav_path},
-        {"text": "Describe the speaker’s vocal delivery in this audio. Focus only on how they sound, not what they are saying. Include detailed observations about: \n- Prosody: pitch, intonation, pacing, loudness, rhythm, and pauses or hesitation \n- Voice quality: breathiness, tension, harshness, smoothness, or creakiness \n- Articulation: clarity, enunciation, and any slurring, stuttering, or irregular speech patterns \nAlso describe how expressive or monotone the speaker sounds. Be as descriptive as possible and explain what these vocal features might suggest about their emotional tone, without interpreting the actual words."}
+        {"text": prompt}
     ])
     # Generate the response
-    response, history = model.chat(tokenizer, query=query, history=None)
+    with telemetry.span("qwen_audio", os.path.splitext(os.path.basename(wav_path))[0]):
+        response, history = model.chat(tokenizer, query=query, history=None)
     # Save the response to a .txt file with the same base name
-    output_file = os.path.splitext(wav_file)[0] + ".txt"
-    output_path = os.path.join(output_dir, output_file)
     with open(output_path, 'w') as f:
         f.write(response)
+    return response
+
+def _remote_utils(model):
+    # make_context, decode_tokens and get_stop_words_ids ship with the model's
+    # remote code (qwen_generation_utils) and are imported into its modeling module
+    return sys.modules[type(model).__module__]
+
+@contextmanager
+def cached_audio(tokenizer, cache):
+    """Serve clips from an audio_cache.AudioCache while the tokenizer processes queries.
+
+    Qwen-Audio's tokenizer decodes each audio path with its own load_audio
+    (ffmpeg, like whisper.load_audio). Inside this block paths whose file name
+    is a cached sample id come from the memory-mapped cache instead; other paths
+    are decoded as before.
+    """
+    module = sys.modules[type(tokenizer).__module__]
+    original = module.load_audio
+
+    def load_audio(path, *args, **kwargs):
+        sample_id = os.path.splitext(os.path.basename(path))[0]
+        if sample_id in cache:
+            return cache.get(sample_id)
+        return original(path, *args, **kwargs)
+
+    module.load_audio = load_audio
+    try:
+        yield
+    finally:
+        module.load_audio = original
+
+def build_context(tokenizer, model, wav_path, prompt=AUDIO_DESCRIPTION_PROMPT):
+    """Token ids of the same single-turn chat query model.chat builds for one clip."""
+    utils = _remote_utils(model)
+    config = model.generation_config
+    query = tokenizer.from_list_format([
+        {"audio": wav_path},
+        {"text": prompt}
+    ])
+    return utils.make_context(tokenizer, query, history=[], system=SYSTEM_PROMPT,
+                              max_window_size=config.max_window_size, chat_format=config.chat_format)
+
+def describe_batch(tokenizer, model, wav_paths, prompt=AUDIO_DESCRIPTION_PROMPT):
+    """Describe several clips with one generate call. Returns the responses in order.
+
+    Queries are left-padded to the longest one and their audio features are
+    concatenated in row order, which is the order Qwen-Audio splices them into
+    the audio placeholder tokens. Rotary position embeddings only see relative
+    positions, so left padding under the attention mask does not change a row.
+    """
+    utils = _remote_utils(model)
+    config = model.generation_config
+    contexts = [build_context(tokenizer, model, wav_path, prompt) for wav_path in wav_paths]
+
+    width = max(len(tokens) for _, tokens, _ in contexts)
+    pad_id = tokenizer.eod_id
+    input_ids = torch.tensor([[pad_id] * (width - len(tokens)) + tokens for _, tokens, _ in contexts],
+                             device=model.device)
+    attention_mask = torch.tensor([[0] * (width - len(tokens)) + [1] * len(tokens) for _, tokens, _ in contexts],
+                                  device=model.device)
+    audio_info = {
+        "input_audios": torch.cat([info["input_audios"] for _, _, info in contexts]),
+        "input_audio_lengths": torch.cat([info["input_audio_lengths"] for _, _, info in contexts]),
+        "audio_span_tokens": [n for _, _, info in contexts for n in info["audio_span_tokens"]],
+        "audio_urls": [url for _, _, info in contexts for url in info["audio_urls"]],
+    }
+
+    outputs = model.generate(
+        input_ids,
+        attention_mask=attention_mask,
+        stop_words_ids=utils.get_stop_words_ids(config.chat_format, tokenizer),
+        return_dict_in_generate=False,
+        generation_config=config,
+        audio_info=audio_info,
+    )
+
+    responses = []
+    for row, (raw_text, tokens, info) in zip(outputs, contexts):
+        responses.append(utils.decode_tokens(
+            row[width - len(tokens):], tokenizer, raw_text_len=len(raw_text), context_length=len(tokens),
+            chat_format=config.chat_format, verbose=False, errors="replace", audio_info=info))
+    return responses
+
+def describe_files(tokenizer, model, wav_paths, output_paths, prompt=AUDIO_DESCRIPTION_PROMPT, batch_size=batch_size,
+                   lengths=None):
+    """Describe every WAV, batch_size clips per generate call, writing each batch as it finishes.
+
+    lengths optionally gives each clip's length (default: the WAV file size) for grouping.
+    """
+    if batch_size <= 1:
+        for wav_path, output_path in zip(wav_paths, output_paths):
+            describe_audio(tokenizer, model, wav_path, output_path, prompt)
+        return
+    # Similar durations give similar audio span lengths, so little padding per batch
+    if lengths is None:
+        lengths = [os.path.getsize(wav_path) for wav_path in wav_paths]
+    jobs = [job for _, job in sorted(zip(lengths, zip(wav_paths, output_paths)), key=lambda item: item[0])]
+    for start in range(0, len(jobs), batch_size):
+        batch = jobs[start:start + batch_size]
+        with telemetry.span("qwen_audio", samples=[os.path.splitext(os.path.basename(wav_path))[0]
+                                                   for wav_path, _ in batch]):
+            responses = describe_batch(tokenizer, model, [wav_path for wav_path, _ in batch], prompt)
+        for (_, output_path), response in zip(batch, responses):
+            with open(output_path, 'w') as f:
+                f.write(response)
+
+def list_wav_files(input_dir, cache=None):
+    """WAV file names of input_dir, or of every cached clip when input_dir does not exist."""
+    if cache is not None and not os.path.isdir(input_dir):
+        # A cache built straight from the videos needs no WAV folder; the paths only name the clips
+        print(f"{input_dir} does not exist; describing every clip in {cache.cache_dir}")
+        return [sample_id + ".wav" for sample_id in sorted(cache.sample_ids())]
+    return [f for f in os.listdir(input_dir) if f.endswith('.wav')]
+
+if __name__ == "__main__" and model_server:
+    from concurrent.futures import ThreadPoolExecutor
+    from model_server import ModelClient
+    client = ModelClient(model_server)
+    os.makedirs(output_dir, exist_ok=True)
+    if audio_cache_dir:
+        from audio_cache import AudioCache
+        wav_files = list_wav_files(input_dir, AudioCache(audio_cache_dir))
+    else:
+        wav_files = list_wav_files(input_dir)
+
+    def describe_one(wav_file):
+        response = client.describe_audio(os.path.join(input_dir, wav_file), AUDIO_DESCRIPTION_PROMPT)
+        with open(os.path.join(output_dir, os.path.splitext(wav_file)[0] + ".txt"), 'w') as f:
+            f.write(response)
+
+    # Keep a batch worth of requests in flight so the server can group them
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        list(executor.map(describe_one, wav_files))
+    print(f"Processed {len(wav_files)} files. Descriptions saved to {output_dir}.")
+
+elif __name__ == "__main__":
+    tokenizer, model = load_model()
+
+    # Create output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
 
-print(f"Processed {len(wav_files)} files. Descriptions saved to {output_dir}.")
+    if audio_cache_dir:
+        from audio_cache import AudioCache
+        cache = AudioCache(audio_cache_dir)
+    else:
+        cache = None
+    wav_files = list_wav_files(input_dir, cache)
 
+    wav_paths = [os.path.join(input_dir, wav_file) for wav_file in wav_files]
+    output_paths = [os.path.join(output_dir, os.path.splitext(wav_file)[0] + ".txt") for wav_file in wav_files]
+    if cache is not None:
+        # Clips missing from the cache are decoded from their WAV files; 16-bit PCM is 2 bytes per sample
+        lengths = []
+        for wav_file, wav_path in zip(wav_files, wav_paths):
+            sample_id = os.path.splitext(wav_file)[0]
+            lengths.append(cache.clips[sample_id][1] if sample_id in cache else os.path.getsize(wav_path) // 2)
+        with cached_audio(tokenizer, cache):
+            describe_files(tokenizer, model, wav_paths, output_paths, lengths=lengths)
+    else:
+        describe_files(tokenizer, model, wav_paths, output_paths)
 
+    print(f"Processed {len(wav_files)} files. Descriptions saved to {output_dir}.")
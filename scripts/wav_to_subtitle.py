@@ -11,24 +11,58 @@ import os
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
-model = whisper.load_model("base").to(DEVICE)
-
 # Set input and output directories
 input_dir = "./data/MER_test_subset/test_subset_wav"
 output_dir = "./data/MER_test_subset/test_subtitles"
 
-# Ensure output directory exists
-os.makedirs(output_dir, exist_ok=True)
+# e.g. "127.0.0.1:8765" to transcribe on a running model_server.py instead of loading Whisper here
+model_server = None
+
+def load_model(name="base"):
+    return whisper.load_model(name).to(DEVICE)
+
+def transcribe_file(model, file_path, output_path):
+    result = model.transcribe(file_path)
+    subtitle_text = result["text"]
+    # Save to .txt file with the same base name
+    with open(output_path, "w") as f:
+        f.write(subtitle_text)
+    return subtitle_text
+
+# For many files, transcription.py batches clips and skips the per-file ffmpeg decode.
+def transcribe_with_server(client, file_path, output_path):
+    subtitle_text = client.transcribe(file_path)
+    with open(output_path, "w") as f:
+        f.write(subtitle_text)
+    return subtitle_text
+
+if __name__ == "__main__" and model_server:
+    from concurrent.futures import ThreadPoolExecutor
+    from model_server import ModelClient
+    client = ModelClient(model_server)
+    os.makedirs(output_dir, exist_ok=True)
+    wav_files = [f for f in os.listdir(input_dir) if f.endswith(".wav")]
 
-# Loop through all .wav files in the input directory
-for filename in os.listdir(input_dir):
-    if filename.endswith(".wav"):
-        file_path = os.path.join(input_dir, filename)
-        result = model.transcribe(file_path)
-        subtitle_text = result["text"]
-        # Save to .txt file with the same base name
+    def transcribe_one(filename):
         output_filename = os.path.splitext(filename)[0] + ".txt"
-        output_path = os.path.join(output_dir, output_filename)
-        with open(output_path, "w") as f:
-            f.write(subtitle_text)
-        print(f"Transcribed {filename} -> {output_filename}")
\ No newline at end of file
+        transcribe_with_server(client, os.path.join(input_dir, filename), os.path.join(output_dir, output_filename))
+        print(f"Transcribed {filename} -> {output_filename}")
+
+    # Several requests in flight so the server can batch them
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(transcribe_one, wav_files))
+
+elif __name__ == "__main__":
+    model = load_model("base")
+
+    # Ensure output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Loop through all .wav files in the input directory
+    for filename in os.listdir(input_dir):
+        if filename.endswith(".wav"):
+            file_path = os.path.join(input_dir, filename)
+            output_filename = os.path.splitext(filename)[0] + ".txt"
+            output_path = os.path.join(output_dir, output_filename)
+            transcribe_file(model, file_path, output_path)
+            print(f"Transcribed {filename} -> {output_filename}")
@@ -0,0 +1,410 @@
+# Work-queue execution of the pipeline stages over many worker processes or nodes.
+#
+# `enqueue` puts one task per video into a SQLite queue. A task is assigned to a
+# shard by a hash of its video_id, so a node can be given a fixed share of the
+# dataset with --shards. A task also records which per-sample stages of
+# pipeline.py it covers (--stages at enqueue time, default all of them). Any
+# number of `worker` processes then lease tasks and run those stages on them; a
+# task is done only when all of its stages are. Stamps work the same way as a
+# plain pipeline.py run, so a sample that was already done is skipped.
+# A worker keeps its lease alive with heartbeats while a sample runs. When a
+# worker dies, its lease expires after --lease seconds and another worker picks
+# the task up. A failed task is retried after --retry_delay seconds, up to
+# --max_attempts times, and is then marked failed. `reduce` runs the combine
+# stage over the finished samples once the queue is drained.
+#
+# All workers share the data root and the queue file, so for several nodes both
+# must be on a filesystem with working POSIX locks (local disk, NFSv4, Lustre).
+#
+# Usage:
+#   python scripts/work_queue.py enqueue --num_shards 64
+#   python scripts/work_queue.py worker --processes 8 --openface_bin /path/to/FeatureExtraction
+#   python scripts/work_queue.py worker --shards 0 1 2 3   # one node's share
+#   python scripts/work_queue.py enqueue --stages wav subtitle --requeue   # only some stages per task
+#   python scripts/work_queue.py status
+#   python scripts/work_queue.py reduce
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+import hashlib
+import argparse
+import threading
+import multiprocessing
+
+import pipeline
+import telemetry
+
+QUEUE_FILE = 'queue.sqlite'
+
+DEFAULT_SHARDS = 16
+DEFAULT_LEASE = 600  # seconds a lease lasts without a heartbeat
+DEFAULT_HEARTBEAT = 60
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_DELAY = 60  # seconds, times the attempt number
+
+
+def shard_of(sample_id, num_shards):
+    """Stable shard of a video_id, the same on every node and Python version."""
+    return int(hashlib.sha1(sample_id.encode('utf-8')).hexdigest()[:8], 16) % num_shards
+
+def default_queue_path(data_root):
+    return os.path.join(data_root, pipeline.STATE_DIR_NAME, QUEUE_FILE)
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class WorkQueue:
+    def __init__(self, path, lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=DEFAULT_RETRY_DELAY):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Autocommit; claims take the write lock up front with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA busy_timeout = 60000')
+        self._create_tables()
+
+    def _create_tables(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                sample_id TEXT PRIMARY KEY,
+                video_path TEXT NOT NULL,
+                shard INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                not_before REAL NOT NULL DEFAULT 0,
+                error TEXT,
+                seconds REAL,
+                stages TEXT,
+                updated REAL NOT NULL
+            )""")
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(tasks)')}
+        if 'stages' not in columns:
+            # Queues from before per-task stages ran every stage (stages IS NULL)
+            self.conn.execute('ALTER TABLE tasks ADD COLUMN stages TEXT')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_status_shard ON tasks (status, shard)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def num_shards(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'num_shards'").fetchone()
+        return int(row[0]) if row else None
+
+    def enqueue(self, samples, num_shards=DEFAULT_SHARDS, requeue=False, stages=None):
+        """Add (sample_id, video_path) tasks. Returns the number added or reset to pending.
+
+        stages are the per-sample stages a task covers (None: all of them).
+        Samples already in the queue are kept as they are, unless requeue resets
+        their attempts and stages (e.g. after changing a stage parameter).
+        """
+        existing = self.num_shards()
+        if existing is not None and existing != num_shards:
+            raise ValueError(f'{self.path} is split into {existing} shards, not {num_shards}')
+        now = time.time()
+        stages = ' '.join(stages) if stages else None
+        changed = 0
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('num_shards', ?)", (str(num_shards),))
+            for sample_id, video_path in samples:
+                cursor = self.conn.execute(
+                    'INSERT OR IGNORE INTO tasks (sample_id, video_path, shard, stages, updated) '
+                    'VALUES (?, ?, ?, ?, ?)', (sample_id, video_path, shard_of(sample_id, num_shards), stages, now))
+                if not cursor.rowcount and requeue:
+                    # Tasks under lease finish their current attempt first
+                    cursor = self.conn.execute(
+                        "UPDATE tasks SET status = 'pending', attempts = 0, not_before = 0, error = NULL, "
+                        "video_path = ?, stages = ?, updated = ? WHERE sample_id = ? AND status != 'leased'",
+                        (video_path, stages, now, sample_id))
+                changed += cursor.rowcount
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return changed
+
+    def _shard_filter(self, shards):
+        if not shards:
+            return '', ()
+        return f" AND shard IN ({', '.join('?' * len(shards))})", tuple(shards)
+
+    def claim(self, worker, shards=None):
+        """Lease the next runnable task. Returns (sample_id, video_path, attempt, stages) or None.
+
+        stages is the list of per-sample stages the task covers, or None for all of them.
+        """
+        now = time.time()
+        where, params = self._shard_filter(shards)
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Leases that ran out on their last attempt will not be picked up again
+            self.conn.execute(
+                "UPDATE tasks SET status = 'failed', error = 'lease expired', updated = ? "
+                "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, self.max_attempts))
+            row = self.conn.execute(
+                "SELECT sample_id, video_path, attempts, stages FROM tasks "
+                "WHERE ((status = 'pending' AND not_before <= ?) OR (status = 'leased' AND lease_until < ?)) "
+                f"AND attempts < ?{where} ORDER BY shard, sample_id LIMIT 1",
+                (now, now, self.max_attempts, *params)).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE tasks SET status = 'leased', worker = ?, attempts = attempts + 1, lease_until = ?, "
+                    "updated = ? WHERE sample_id = ?", (worker, now + self.lease, now, row[0]))
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return None if row is None else (row[0], row[1], row[2] + 1, row[3].split() if row[3] else None)
+
+    def heartbeat(self, worker, sample_id):
+        """Extend the lease. False if the task was given to another worker in the meantime."""
+        now = time.time()
+        cursor = self.conn.execute(
+            "UPDATE tasks SET lease_until = ?, updated = ? WHERE sample_id = ? AND worker = ? AND status = 'leased'",
+            (now + self.lease, now, sample_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, worker, sample_id, seconds=None):
+        """Mark the task done. False if this worker no longer holds its lease.
+
+        A lease that expired but was not taken over yet still counts as held; once
+        another worker claims the task, or it is failed for the expired lease, it does not.
+        """
+        cursor = self.conn.execute(
+            "UPDATE tasks SET status = 'done', error = NULL, seconds = ?, lease_until = NULL, updated = ? "
+            "WHERE sample_id = ? AND worker = ? AND status = 'leased'", (seconds, time.time(), sample_id, worker))
+        return cursor.rowcount == 1
+
+    def fail(self, worker, sample_id, error):
+        """Put the task back for a later retry, or mark it failed after max_attempts."""
+        now = time.time()
+        cursor = self.conn.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "not_before = ? + ? * attempts, error = ?, lease_until = NULL, updated = ? "
+            "WHERE sample_id = ? AND worker = ? AND status = 'leased'",
+            (self.max_attempts, now, self.retry_delay, error, now, sample_id, worker))
+        return cursor.rowcount == 1
+
+    def open_tasks(self, shards=None):
+        """Tasks that may still run: pending (possibly backing off) or leased."""
+        where, params = self._shard_filter(shards)
+        return self.conn.execute(f"SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased'){where}",
+                                 params).fetchone()[0]
+
+    def counts(self):
+        """{status: count} over all tasks and {shard: {status: count}}."""
+        totals, by_shard = {}, {}
+        for shard, status, n in self.conn.execute('SELECT shard, status, COUNT(*) FROM tasks GROUP BY shard, status'):
+            totals[status] = totals.get(status, 0) + n
+            by_shard.setdefault(shard, {})[status] = n
+        return totals, by_shard
+
+    def samples(self, status=None):
+        """(sample_id, video_path) of every task, or of the tasks in one status, in sample order."""
+        if status is None:
+            return self.conn.execute('SELECT sample_id, video_path FROM tasks ORDER BY sample_id').fetchall()
+        return self.conn.execute('SELECT sample_id, video_path FROM tasks WHERE status = ? ORDER BY sample_id',
+                                 (status,)).fetchall()
+
+    def failures(self):
+        return self.conn.execute("SELECT sample_id, attempts, error FROM tasks WHERE status = 'failed' "
+                                 "ORDER BY sample_id").fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+class Heartbeat:
+    """Background thread that keeps the lease of the task in progress alive."""
+
+    def __init__(self, queue_path, worker, interval, lease):
+        self.queue_path = queue_path
+        self.worker = worker
+        self.interval = interval
+        self.lease = lease
+        self.sample_id = None
+        self.lost = False
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # SQLite connections stay in the thread that opened them
+        queue = WorkQueue(self.queue_path, lease=self.lease)
+        try:
+            while not self.stop_event.wait(self.interval):
+                with self.lock:
+                    if self.sample_id is not None and not queue.heartbeat(self.worker, self.sample_id):
+                        self.lost = True
+        finally:
+            queue.close()
+
+    def watch(self, sample_id):
+        with self.lock:
+            self.sample_id = sample_id
+            self.lost = False
+
+    def release(self):
+        with self.lock:
+            self.sample_id = None
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def work(args):
+    """Lease and process tasks until none are left (or forever with --wait). Returns the number done."""
+    if args.trace or args.metrics:
+        telemetry.configure(args.trace, args.metrics)
+    queue_path = args.queue or default_queue_path(args.data_root)
+    queue = WorkQueue(queue_path, args.lease, args.max_attempts, args.retry_delay)
+    worker = worker_name()
+    heartbeat = Heartbeat(queue_path, worker, args.heartbeat, args.lease)
+    ctx = pipeline.build_context(args)
+    hash_cache = pipeline.VideoHashCache(os.path.join(ctx['state_dir'], 'video_hashes.json'))
+    done = 0
+    try:
+        while True:
+            task = queue.claim(worker, args.shards)
+            if task is None:
+                if not args.wait and queue.open_tasks(args.shards) == 0:
+                    break
+                # Others still hold leases (or retries are backing off); one of them may come back
+                time.sleep(args.poll)
+                continue
+            sample_id, video_path, attempt, stages = task
+            selected = [stage for stage in (stages or pipeline.STAGE_ORDER) if stage != 'combine']
+            print(f'[{worker}] {sample_id} (attempt {attempt})')
+            heartbeat.watch(sample_id)
+            start = time.time()
+            error = None
+            try:
+                ctx['video_hashes'] = {sample_id: hash_cache.get(video_path)}
+                ctx['keys'] = {}
+                summary = pipeline.run_stages(ctx, [(sample_id, video_path)], selected)
+                failed = [stage for stage, (_, _, n) in summary.items() if n]
+                if failed:
+                    error = f"failed stages: {', '.join(failed)}"
+            except Exception as e:
+                error = f'{e.__class__.__name__}: {e}'
+            finally:
+                heartbeat.release()
+            if heartbeat.lost:
+                print(f'[{worker}] {sample_id}: lease was taken over by another worker')
+            elif error:
+                queue.fail(worker, sample_id, error)
+                print(f'[{worker}] {sample_id}: {error}')
+            elif not queue.complete(worker, sample_id, round(time.time() - start, 3)):
+                # The lease expired between heartbeats and the task was reset or handed out again
+                print(f'[{worker}] {sample_id}: lease was lost before the task could be marked done')
+            else:
+                done += 1
+                if done % 100 == 0:
+                    hash_cache.save()
+    finally:
+        heartbeat.stop()
+        hash_cache.save()
+        queue.close()
+    return done
+
+def _work_process(args):
+    print(f'[{worker_name()}] finished {work(args)} samples')
+
+def reduce(args):
+    """Combine stage over the finished samples. Returns (ran, skipped, failed), or None if the queue is not drained."""
+    queue = WorkQueue(args.queue or default_queue_path(args.data_root))
+    totals, _ = queue.counts()
+    unfinished = sum(n for status, n in totals.items() if status != 'done')
+    if unfinished and not args.partial:
+        print(f'{unfinished} tasks are not done ({totals}); wait for the workers or pass --partial')
+        return None
+    samples = [tuple(row) for row in queue.samples('done')]
+    queue.close()
+    if args.trace or args.metrics:
+        telemetry.configure(args.trace, args.metrics)
+    print(f'Combining {len(samples)} samples')
+    return pipeline.combine_stage(pipeline.build_context(args), samples, dry_run=args.dry_run)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline stages from a sharded SQLite work queue')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    enqueue = sub.add_parser('enqueue', help='Add one task per video')
+    enqueue.add_argument('--data_root', type=str, default=pipeline.DATA_ROOT)
+    enqueue.add_argument('--video_subdir', type=str, default='test_subset')
+    enqueue.add_argument('--num_shards', type=int, default=DEFAULT_SHARDS)
+    enqueue.add_argument('--requeue', action='store_true', help='Reset tasks that are already done or failed')
+    enqueue.add_argument('--stages', nargs='+', choices=pipeline.STAGE_ORDER,
+                         help='Per-sample stages each task covers (default: all); combine runs in reduce')
+    enqueue.add_argument('--limit', type=int, help='Optional: Limit the number of videos')
+
+    worker = sub.add_parser('worker', help='Process tasks until the queue is drained')
+    pipeline.add_arguments(worker)
+    worker.add_argument('--processes', type=int, default=1, help='Worker processes on this node')
+    worker.add_argument('--shards', nargs='+', type=int, help='Optional: only take tasks of these shards')
+    worker.add_argument('--lease', type=float, default=DEFAULT_LEASE)
+    worker.add_argument('--heartbeat', type=float, default=DEFAULT_HEARTBEAT)
+    worker.add_argument('--max_attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    worker.add_argument('--retry_delay', type=float, default=DEFAULT_RETRY_DELAY)
+    worker.add_argument('--poll', type=float, default=5, help='Seconds between claims while waiting for tasks')
+    worker.add_argument('--wait', action='store_true', help='Keep polling for new tasks instead of exiting')
+
+    status = sub.add_parser('status', help='Task counts per status and shard, and failed tasks')
+    status.add_argument('--data_root', type=str, default=pipeline.DATA_ROOT)
+    status.add_argument('--shards', action='store_true', help='Also print counts per shard')
+
+    reducer = sub.add_parser('reduce', help='Combine stage over the finished samples')
+    pipeline.add_arguments(reducer)
+    reducer.add_argument('--partial', action='store_true', help='Combine even if some tasks are not done')
+    reducer.add_argument('--dry_run', action='store_true', help='Only print whether combine would run')
+
+    for subparser in (enqueue, worker, status, reducer):
+        subparser.add_argument('--queue', type=str,
+                               help=f'Queue file (default: <data_root>/{pipeline.STATE_DIR_NAME}/{QUEUE_FILE})')
+    args = parser.parse_args()
+
+    if args.command == 'enqueue':
+        samples = pipeline.list_samples(os.path.join(args.data_root, args.video_subdir))
+        if args.limit:
+            samples = samples[:args.limit]
+        queue = WorkQueue(args.queue or default_queue_path(args.data_root))
+        added = queue.enqueue(samples, args.num_shards, requeue=args.requeue, stages=args.stages)
+        print(f'Queued {added} of {len(samples)} videos in {queue.num_shards()} shards')
+    elif args.command == 'worker':
+        if args.stages:
+            # Task status is per sample, so a partial run would mark the task done for every stage
+            parser.error('worker runs the stages each task was enqueued with; pass --stages to enqueue instead')
+        if args.processes == 1:
+            _work_process(args)
+        else:
+            # All worker processes write their spans under one run id
+            telemetry.share_run_id()
+            context = multiprocessing.get_context('spawn')
+            processes = [context.Process(target=_work_process, args=(args,)) for _ in range(args.processes)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+    elif args.command == 'status':
+        queue = WorkQueue(args.queue or default_queue_path(args.data_root))
+        totals, by_shard = queue.counts()
+        print(', '.join(f'{status}: {n}' for status, n in sorted(totals.items())) or 'Queue is empty')
+        if args.shards:
+            for shard, counts in sorted(by_shard.items()):
+                print(f'  shard {shard}: ' + ', '.join(f'{status}: {n}' for status, n in sorted(counts.items())))
+        for sample_id, attempts, error in queue.failures():
+            print(f'  failed {sample_id} after {attempts} attempts: {error}')
+    else:
+        result = reduce(args)
+        if result is None:
+            sys.exit(1)
+        print(f'combine (ran / skipped / failed): {" / ".join(str(n) for n in result)}')